@@ -585,18 +585,23 @@ def signals_to_master_signal_comparison(signals, master_signal, density = False)
 
 #%%
 
-def create_all_ifgs(ifgs_r2, ifg_dates, max_n_all_ifgs = 1000):
+def create_all_ifgs(ifgs_r2, ifg_dates, max_n_all_ifgs = 1000, return_lazy = False):
     """Given a rank 2 of incremental ifgs, calculate all the possible ifgs that still step forward in time (i.e. if deformation is positive in all incremental ifgs, 
     it remains positive in all the returned ifgs.)  If acquisition dates are provided, the tmeporal baselines of all the possible ifgs can also be found.  
     Inputs:
         ifgs_r2 | rank 2 array | Interferograms as row vectors.  
         ifg_dates | list of strings | dates in the form YYYYMMDD_YYYYMMDD.  As the interferograms are incremental, this should be the same length as the number of ifgs
+        max_n_all_ifgs | int | If more ifgs than this could be made, this many are chosen randomly.  
+        return_lazy | boolean | If True, the ifgs are returned as a lazy_ifgs_all, which only stores the deformation at each acquisition (i.e. the 
+                                cumulative ifgs) and behaves like (but never makes) the rank 2 array of all the ifgs.  
     Returns:
-        ifgs_r2 | rank 2 array | Only the ones that are non-zero (the diagonal in ifgs_r3) and in the lower left corner (so deformation isn't reversed.  )
+        ifgs_r2 | rank 2 array or lazy_ifgs_all | Only the ones that are non-zero (the diagonal in ifgs_r3) and in the lower left corner (so deformation isn't reversed.  )
     History:
         2021_04_13 | MEG | Written
         2021_04_19 | MEG | add funcionality to calculate the temporal baselines of all possible ifgs.  
         2021_04_29 | MEG | Add functionality to handle networks with breaks in them.  
+        2026_10_18 | AG | Make the ifgs as differences of the cumulative ones (rather than from a cube of all of them), and add return_lazy.  
+        2026_10_18 | AG | Make the (start, end) acquisitions of the ifgs and their dates with array operations, and sample these without replacement in batches.  
     """
     import numpy as np
     import datetime as dt
@@ -623,63 +628,31 @@ def create_all_ifgs(ifgs_r2, ifg_dates, max_n_all_ifgs = 1000):
                 
         return ifg_dates_continuous, ifgs_r2_continuous
     
-    def create_all_possible_ifgs(networks):
+    def lower_triangle_pairs(n_acq, pair_args = None):
+        """ Get the (start, end) acquisitions of the ifgs that step forward in time, which are the lower left triangle (below the diagonal) of 
+        an n_acq x n_acq square of end acquisitions (rows) and start acquisitions (columns), in row order.  If pair_args is provided, only these 
+        ifgs (as indexes of the ifgs in the triangle, in row order) are returned.  
         """
-        """
-        n_networks = len(networks)
-        ifgs_all_r2 = []
-        dates_all_r1 = []
-        for n_network, network in enumerate(networks):                                                         # loop through each network.  
-            ifgs_r2_temp = network['ifgs_r2']
-            ifg_dates_temp = network['ifg_dates']
-            n_acq = ifgs_r2_temp.shape[0] + 1
-            
-            # 2a: convert from daisy chain of incremental to a relative to a single master at the start of the time series.  
-            acq1_def = np.zeros((1, n_pixs))                                                     # deformation is 0 at the first acquisition
-            ifgs_cs = np.cumsum(ifgs_r2_temp, axis = 0)                                          # convert from incremental to cumulative.  
-            ifgs_cs = np.vstack((acq1_def, ifgs_cs))                                             # add the 0 at first time ifg to the other cumulative ones. 
-            
-            # 2b: create all possible ifgs
-            ifgs_cube = np.zeros((n_acq, n_acq, n_pixs))                                    # cube to store all possible ifgs in
-            for i in range(n_acq):                                                          # used to loop through each column
-                ifgs_cube[:,i,] = ifgs_cs - ifgs_cs[i,]                                     # make one column (ie all the rows) by taking all the ifgs and subtracting one time from it
-               
-            # 2c: Get only the positive ones (ie the lower left quadrant)    
-            lower_left_indexes = triange_lower_left_indexes(n_acq)                              # get the indexes of the ifgs in the lower left corner (ie. non 0, and with unreveresed deformation.  )
-            ifgs_all_r2.append(ifgs_cube[lower_left_indexes[:,0], lower_left_indexes[:,1], :])        # get those ifgs and store as row vectors.  
-            
-            # 2d: Calculate the dates that the new ifgs run between.  
-            acq_dates = acquisitions_from_ifg_dates(ifg_dates_temp)                                                         # get the acquisitions from the ifg dates.  
-            ifg_dates_all_r2 = np.empty([n_acq, n_acq], dtype='U17')                                                        # initate an array that can hold unicode strings.  
-            for row_n, date1 in enumerate(acq_dates):                                                                       # loop through rows
-                for col_n, date2 in enumerate(acq_dates):                                                                   # loop through columns
-                    ifg_dates_all_r2[row_n, col_n] = f"{date2}_{date1}"
-            ifg_dates_all_r1 = list(ifg_dates_all_r2[lower_left_indexes[:,0], lower_left_indexes[:,1]])             # just get the lower left corner (like for the ifgs)
-    
-            dates_all_r1.append(ifg_dates_all_r1)
-    
-        # 3: convert lists back to a single matrix of all interferograms.  
-        ifgs_all_r2 = np.vstack(ifgs_all_r2)                                                                            # now one big array of n_ifgs x n_pixels
-        dates_all_r1 = [item for sublist in dates_all_r1 for item in sublist]                                           # dates_all_r1 is a list (one for each connected network) of lists (each ifg date).  The turns them to a singe list.  
-        
-        return ifgs_all_r2, dates_all_r1
+        if pair_args is None:
+            acq_ends, acq_starts = np.tril_indices(n_acq, -1)                                       # all of the triangle, in row order.  
+        else:
+            acq_ends = ((1 + np.sqrt(1 + 8 * pair_args)) / 2).astype(np.int64)                     # row acq_end of the triangle starts at index acq_end * (acq_end - 1) / 2
+            acq_ends -= (acq_ends * (acq_ends - 1) // 2) > pair_args                                # correct any floating point errors in the square root
+            acq_ends += ((acq_ends + 1) * acq_ends // 2) <= pair_args
+            acq_starts = pair_args - acq_ends * (acq_ends - 1) // 2
+        return np.stack((acq_starts, acq_ends), axis = 1)
     
     
-    def triange_lower_left_indexes(side_length):
-        """ For a square matrix of size side_length, get the index of all the values that are in the lower
-        left quadrant (i.e. all to the lower left of the diagonals).  
-        Inputs:
-            side_length | int | side length of the square.  e.g. 5 for a 5x5
-        Returns:
-            lower_left_indexes | rank 2 array | indexes of all elements below the diagonal.  
-        History:
-            2021_04_13 | MEG | Written.  
+    def sample_without_replacement(n_population, n_samples):
+        """ Get n_samples different random integers between 0 and n_population - 1 (in the order they were drawn).  These are drawn in batches, 
+        so this scales with n_samples (rather than n_population).  
         """
-        import numpy as np
-        zeros_array = np.ones((side_length, side_length))                                                               # initate as ones so none will be selected.  
-        zeros_array = np.triu(zeros_array)                                                                              # set the lower left to 0s
-        lower_left_indexes = np.argwhere(zeros_array == 0)                                                              # select only the lower lefts
-        return lower_left_indexes
+        samples = np.zeros(0, dtype = np.int64)
+        while len(samples) < n_samples:
+            samples = np.concatenate((samples, np.random.randint(0, n_population, 2 * (n_samples - len(samples)))))
+            _, sample_args = np.unique(samples, return_index = True)                                  # remove repeats, keeping the first time each was drawn
+            samples = samples[np.sort(sample_args)]
+        return samples[:n_samples]
 
     
     ########### begin main function
@@ -706,46 +679,40 @@ def create_all_ifgs(ifgs_r2, ifg_dates, max_n_all_ifgs = 1000):
         networks.append(network_dict)
         n_ifgs_all_total += network_dict['n_ifgs_all']                                                          # add to the running total of the total number of ifgs
            
-    #3: determine if we can make all ifgs, or if we need to make only some of them.  
-    if n_ifgs_all_total < max_n_all_ifgs:                                                               # if we can just make all ifgs, 
-        ifgs_all_r2, dates_all_r1 = create_all_possible_ifgs(networks)
+    #3: determine if we can make all ifgs, or if we need to make only some of them, and make the (start, end) acquisitions of these for each network.  
+    acq_def_r2 = []                                                                                                     # deformation at each acquisition, list with entry for each network
+    acq_pairs = []                                                                                                      # (start, end) acquisitions of each ifg, list with entry for each network
+    dates_all_r1 = []                                                                                                   # list for all networks
+    n_acq_previous = 0                                                                                                  # the number of acquisitions in the previous networks
+    for network in networks:
+        n_acq = network['n_ifgs'] + 1
         
-    else:    
-        ifgs_all_r2 = []                                                                                                # list with entry for each entwork
-        dates_all_r1 = []                                                                                               # list for all networks
-        for network in networks:
+        # a: convert from daisy chain of incremental to relative to a single master at the start of the time series.  
+        acq1_def = np.zeros((1, n_pixs), dtype = network['ifgs_r2'].dtype)                                               # deformation is 0 at the first acquisition
+        acq_def_r2.append(np.vstack((acq1_def, np.cumsum(network['ifgs_r2'], axis = 0))))                               # add the 0 at first time ifg to the cumulative ones.  
+        
+        # b: get the acquisitions of either all the ifgs, or a random selection of them
+        if n_ifgs_all_total < max_n_all_ifgs:                                                                           # if we can just make all ifgs, 
+            network_pairs = lower_triangle_pairs(n_acq)
+        else:
             n_ifgs_from_network = int(max_n_all_ifgs * (network['n_ifgs_all'] / n_ifgs_all_total))                    # get the fraction of ifgs that each network will provide ot the total.  e.g. network 1 = 800, network 2 = 800, but 1000 in total, 500 from each network
-
-            # 0: get some info about the ifgs
-            n_pixs = network['ifgs_r2'].shape[1]
-            n_acq = network['n_ifgs'] + 1
-
-            # 1: Make the cumulative ifgs
-            acq1_def = np.zeros((1, n_pixs))                                                     # deformation is 0 at the first acquisition
-            ifgs_cs = np.cumsum(network['ifgs_r2'], axis = 0)                                          # convert from incremental to cumulative.  
-            ifgs_cs = np.vstack((acq1_def, ifgs_cs))                                             # add the 0 at first time ifg to the other cumulative ones.     
-                   
-            # 2: get the acquisition dates:
-            acq_dates = acquisitions_from_ifg_dates(network['ifg_dates'])                                                         # get the acquisitions from the ifg dates.  
-
-            # 3: create the list of acquisiton dates that is the correct (for this network) length
-            ifg_acq_start_acq_ends = []                                                                                  # list of tuples of acquisitions each ifg will be between
-            while len(ifg_acq_start_acq_ends) < n_ifgs_from_network:                                                     # until we have enough...
-                acq_start = np.random.randint(0, n_acq)                                                                 # random start acq
-                acq_end = np.random.randint(0, n_acq)                                                                   # random end acq
-                if (acq_start < acq_end) and ((acq_start, acq_end) not in ifg_acq_start_acq_ends):                       # if start is before end (ie only in lower left of all acquisitions square) and not already in list of pairs
-                    ifg_acq_start_acq_ends.append((acq_start, acq_end))                                                  # add to pair
-            
-            # 4: make the ifgs for those acquisition dates.  
-            for ifg_acq_start_acq_end in ifg_acq_start_acq_ends:                                                        # iterate through all the pairs we need to get 
-                ifgs_all_r2.append(ifgs_cs[ifg_acq_start_acq_end[1],] - ifgs_cs[ifg_acq_start_acq_end[0],])               # subtract one ifg from the other (end - start)
-                dates_all_r1.append(f"{acq_dates[ifg_acq_start_acq_end[0]]}_{acq_dates[ifg_acq_start_acq_end[1]]}")         # get teh dates that that ifg spans
-                
-        # 5: convert lists back to a single matrix of all interferograms.  
-        ifgs_all_r2 = np.vstack(ifgs_all_r2)                                                                            # now one big array of n_ifgs x n_pixels
+            network_pairs = lower_triangle_pairs(n_acq, sample_without_replacement(network['n_ifgs_all'], n_ifgs_from_network))
+        acq_pairs.append(n_acq_previous + network_pairs)
+        n_acq_previous += n_acq
+        
+        # c: Calculate the dates that the new ifgs run between.  
+        acq_dates = np.array(acquisitions_from_ifg_dates(network['ifg_dates']))                                          # get the acquisitions from the ifg dates.  
+        dates_all_r1.extend(np.char.add(np.char.add(acq_dates[network_pairs[:, 0]], '_'), acq_dates[network_pairs[:, 1]]).tolist())     # YYYYMMDD_YYYYMMDD
+    
+    # 4: convert lists back to single arrays for all the networks.  
+    acq_def_r2 = np.vstack(acq_def_r2)                                                                                  # n_acquisitions x n_pixels
+    acq_pairs = np.vstack(acq_pairs)                                                                                    # n_ifgs x 2
                     
+    ifgs_all_r2 = lazy_ifgs_all(acq_def_r2, acq_pairs)                                                                  # all the ifgs, but only the cumulative ones are stored.  
     print(f"When creating all interferograms, {ifgs_r2.shape[0]} were passed to the function, and these were found to make {n_network+1} connected networks.  "
           f"From these, {ifgs_all_r2.shape[0]} interferograms were created.  ")
+    if not return_lazy:
+        ifgs_all_r2 = ifgs_all_r2.toarray()
     
     return ifgs_all_r2, dates_all_r1    
     
@@ -898,6 +865,7 @@ def maps_tcs_rescale(maps, tcs):
         tcs_scaled | array | TCs scaled so that new maps x new tcs equals maps x tcs
     
     2017/05/15 | written
+    2026_10_18 | AG | Keep the precision of the maps (e.g. float32).  
     
     """
     import numpy as np
@@ -915,7 +883,7 @@ def maps_tcs_rescale(maps, tcs):
         """
         import numpy as np
         
-        signals_rescale = np.ones(signals.shape)                                    # initiate rescaled array
+        signals_rescale = np.ones(signals.shape, dtype = np.result_type(signals, np.float32))        # initiate rescaled array (float32 signals stay float32)
         signals_factor = np.ones((np.size(signals, axis=0) , 1))                    # initiate array to record scaling factor for each row
            
         for i in np.arange(np.size(signals, axis = 0)):
@@ -934,7 +902,98 @@ def maps_tcs_rescale(maps, tcs):
 #%%
   
     
-def bss_components_inversion(sources, interferograms):
+class bss_inversion():
+    """ Least squares fitting of interferograms using components learned by BSS (i.e. how strongly each component is needed to 
+    reconstruct each interferogram).  The Gram matrix of the sources (g.T @ g) is computed and factored (Cholesky, in float64) 
+    once, so any number of sets of interferograms can then be fit with it, and all the interferograms are solved for in one call.  
+    If g.T @ g isn't positive definite (e.g. there are more sources than dimensions in the data, as when HDBSCAN finds more clusters 
+    than n_comp), its pseudo-inverse is used instead, which gives the minimum norm least squares solution.  
+    The misfit is computed from products with the sources, so the model and residual (which are the size of the interferograms)
+    are only made if they're asked for.  
+    Inputs:
+        sources | rank 2 array | n_sources x pixels (ie architecture I).  Mean centered.  
+    History:
+        2026_10_18 | AG | Written.  g.T @ g is factored (Cholesky) once, so each set of interferograms is fit with a cho_solve, and the misfits come from sums of squares.  
+        2026_10_18 | AG | Use the pseudo-inverse of g.T @ g if the Cholesky factorisation fails (i.e. the sources aren't independent).  
+        2026_10_18 | AG | Use lazy_ifgs_all.sum_squares, rather than the trace of its Gram matrix.  
+    """
+    def __init__(self, sources):
+        import numpy as np
+        from scipy import linalg
+        from icasar.blind_signal_separation import gram_matrix
+        self.sources = sources
+        self.gtg = gram_matrix(sources)                                                     # g.T @ g, in float64
+        try:
+            self.gtg_factor = linalg.cho_factor(self.gtg)                                  # which is symmetric and positive definite (if the sources are independent)
+            self.gtg_pinv = None
+        except linalg.LinAlgError:                                                          # but if the sources aren't, it's singular (or close to it)
+            self.gtg_factor = None
+            self.gtg_pinv = linalg.pinvh(self.gtg)                                          # so use its pseudo-inverse (the minimum norm solution)
+        self.source_sums = np.sum(sources, axis = 1, dtype = np.float64)                    # so the interferograms don't need mean centering
+        
+    def fit(self, interferograms, return_model = False, return_residual = False):
+        """ Fit some sets of interferograms.  
+        Inputs:
+            interferograms | list of rank 2 arrays | each n_ifgs x pixels.  Don't have to be mean centered (the mean of all of each is removed before fitting, but 
+                                                     they aren't changed).  Can also be lazy_ifgs_all.  
+            return_model | boolean | if True, the model (the interferograms reconstructed from the sources) is returned for each (pixels x n_ifgs).  
+            return_residual | boolean | if True, the residual (the mean centered interferograms minus the model) is returned for each (pixels x n_ifgs).  
+        Returns:
+            inversion_results | list of dicts | for each set of interferograms, with keys:
+                                                tcs | rank 2 array | n_sources x n_ifgs, the strengths with which to use each source to reconstruct each ifg.  
+                                                model | rank 2 array or None | see return_model.  
+                                                residual | rank 2 array or None | see return_residual.  
+                                                l2_norm | float | the misfit between the ifgs and the ifgs reconstructed from the sources (the norm of the residual / n_pixels)
+            If an item of interferograms is a lazy_ifgs_all, its model and residual are always None (as these would be the size of all the interferograms).  
+        """
+        import numpy as np
+        from scipy import linalg
+        
+        # 1: g.T @ d for each set of (mean centered) interferograms, and the sum of the squares of these 
+        gtds = []
+        means = []
+        sum_squares = []
+        for interferogram in interferograms:
+            ifgs_mean = np.mean(interferogram, dtype = np.float64) if not isinstance(interferogram, lazy_ifgs_all) else interferogram.mean()
+            gtd = np.asarray((interferogram @ self.sources.T).T, dtype = np.float64) - ifgs_mean * self.source_sums[:, np.newaxis]     # g.T @ d, for the mean centered d
+            if isinstance(interferogram, lazy_ifgs_all):                                                                          # the interferograms are never made, so the same is computed from products with them.  
+                ifgs_sum_squares = interferogram.sum_squares()
+            else:
+                ifgs_sum_squares = np.einsum('ij,ij->', interferogram, interferogram, dtype = np.float64)
+            gtds.append(gtd)
+            means.append(ifgs_mean)
+            sum_squares.append(ifgs_sum_squares - np.size(interferogram) * ifgs_mean**2)                                        # of the mean centered interferograms
+        
+        # 2: solve for all the interferograms at once
+        gtd_all = np.concatenate(gtds, axis = 1)
+        m_all = linalg.cho_solve(self.gtg_factor, gtd_all) if self.gtg_factor is not None else self.gtg_pinv @ gtd_all
+        ms = np.split(m_all, np.cumsum([gtd.shape[1] for gtd in gtds])[:-1], axis = 1)
+        
+        # 3: the misfit, and possibly the model and residual, for each set of interferograms
+        inversion_results = []
+        for interferogram, gtd, ifgs_mean, ifgs_sum_squares, m in zip(interferograms, gtds, means, sum_squares, ms):
+            n_pixels = np.size(interferogram)
+            d_resid_sum_squares = ifgs_sum_squares - 2 * np.sum(m * gtd) + np.sum(m * (self.gtg @ m))                          # |d - g@m|**2
+            mean_l2norm = np.sqrt(np.maximum(d_resid_sum_squares, 0))/n_pixels                                                 # misfit between ifg and ifg reconstructed from sources
+            m = m.astype(np.result_type(self.sources.dtype, interferogram.dtype), copy = False)                                 # in the precision of the data
+            d_hat = None
+            d_resid = None
+            if (return_model or return_residual) and not isinstance(interferogram, lazy_ifgs_all):
+                d_hat = self.sources.T @ m                                                                                      # pixels x n_ifgs
+                if return_residual:
+                    d_resid = (interferogram.T - ifgs_mean).astype(d_hat.dtype, copy = False)                                 # a new array, so the interferograms aren't changed
+                    d_resid -= d_hat
+                if not return_model:
+                    d_hat = None
+            inversion_results.append({'tcs'      : m,
+                                      'model'    : d_hat,
+                                      'residual' : d_resid,
+                                      'l2_norm'  : mean_l2norm})
+        return inversion_results
+
+#%%
+
+def bss_components_inversion(sources, interferograms, return_model = True, return_residual = True):
     """
     A function to fit an interferogram using components learned by BSS, and return how strongly
     each component is required to reconstruct that interferogramm, and the 
@@ -942,41 +1001,78 @@ def bss_components_inversion(sources, interferograms):
     Inputs:
         sources | n_sources x pixels | ie architecture I.  Mean centered
         interferogram | list of (n_ifgs x pixels) | Doesn't have to be mean centered, multiple interferograms to be fit can be fit by making the list as long as required.  
+        return_model | boolean | if False, the model isn't made (and is None).  
+        return_residual | boolean | if False, the residual isn't made (and is None).  
         
     Outputs:
         m | rank 1 array | the strengths with which to use each source to reconstruct the ifg.  
         mean_l2norm | float | the misfit between the ifg and the ifg reconstructed from sources
+        If an item of interferograms is a lazy_ifgs_all, its model and residual are None (as these would be the size of all the interferograms).  
+    History:
+        2026_10_18 | AG | Add support for a lazy_ifgs_all, using only products with it.  
+        2026_10_18 | AG | Compute g.T @ g and its inverse in float64, even if the sources are float32.  
+        2026_10_18 | AG | Use bss_inversion (so g.T @ g is factored once for all the interferograms), don't mean centre the interferograms in place, 
+                           and add return_model and return_residual.  
     """
-    import numpy as np
-    
-    inversion_results = []
-    for interferogram in interferograms:
-        interferogram -= np.mean(interferogram)                     # mean centre
-        n_pixels = np.size(interferogram)
+    return bss_inversion(sources).fit(interferograms, return_model, return_residual)
+
+
+#%%
     
+
+class mask_pixels():
+    """ The mapping between row vectors of the pixels that aren't masked (e.g. interferograms or sources as row vectors) and rank 2 images, 
+    computed once for a mask, so that whole rank 2 arrays of row vectors can be made into rank 3 arrays of images (scatter), or the reverse 
+    (gather), in one vectorised step (rather than making each image as a masked array).  
+    Inputs:
+        mask | rank 2 boolean | True for pixels that are masked.  
+    History:
+        2026_10_18 | AG | Written
+    """
+    def __init__(self, mask):
+        import numpy as np
+        self.mask = np.asarray(mask, dtype = bool)
+        self.shape = self.mask.shape
+        self.pixel_args = np.flatnonzero(~self.mask)                                   # the flat index of each pixel that isn't masked, in the order they are in the row vectors
+        self.n_pixels = self.pixel_args.shape[0]
     
-        d = interferogram.T                                        # now n_pixels x n_ifgs
-        g = sources.T                                              # a matrix of ICA sources and each is a column (n_pixels x n_sources)
-        
-        ### Begin different types of inversions.  
-        m = np.linalg.inv(g.T @ g) @ g.T @ d                       # m (n_sources x 1), least squares
-        #m = g.T @ np.linalg.inv(g @ g.T) @ d                      # m (n_sources x 1), least squares with minimum norm condition.     COULDN'T GET TO WORK.  
-        #m = np.linalg.pinv(g) @ d                                   # Moore-Penrose inverse of G for a simple inversion.  
-        # u = 1e0                                                                 # bigger value favours a smoother m, which in turn can lead to a worse fit of the data.  1e3 gives smooth but bad fit, 1e1 is a compromise, 1e0 is rough but good fit.  
-        # m = np.linalg.inv(g.T @ g + u*np.eye(g.shape[1])) @ g.T @ d;                # Tikhonov solution  
-        
-        
-        ### end different types of inversion
-        d_hat = g@m
-        d_resid = d - d_hat
-        mean_l2norm = np.sqrt(np.sum(d_resid**2))/n_pixels          # misfit between ifg and ifg reconstructed from sources
-        
-        inversion_results.append({'tcs'      : m,
-                                  'model'    : d_hat,
-                                  'residual' : d_resid,
-                                  'l2_norm'  : mean_l2norm})
+    def scatter(self, r2, out = None, fill_value = 0):
+        """ Make row vectors into images.  
+        Inputs:
+            r2 | rank 2 array | n x n_pixels (or rank 1 for one row vector, which is then made into a rank 2 image).  
+            out | rank 3 array or None | n x height x width.  If provided (e.g. a memmap), the images are written to this (and it must be C contiguous), 
+                                         and if not a new array is made (in the precision of r2, if it's floats).  
+            fill_value | float | the value of the masked pixels.  Not used if out is provided (so those pixels aren't changed).  
+        Returns:
+            r3 | rank 3 array | n x height x width (or rank 2 if r2 is rank 1).  
+        """
+        import numpy as np
+        r2 = np.asarray(r2)
+        if r2.shape[-1] != self.n_pixels:
+            raise Exception(f"There are {r2.shape[-1]} pixels in each row vector, but {self.n_pixels} pixels aren't masked.  ")
+        if out is None:
+            out = np.full(r2.shape[:-1] + self.shape, fill_value, dtype = np.result_type(r2.dtype, np.float32))
+        out.reshape(r2.shape[:-1] + (-1,))[..., self.pixel_args] = r2                  # reshape is a view, as out is C contiguous.  
+        return out
+    
+    def gather(self, r3):
+        """ Make images into row vectors.  
+        Inputs:
+            r3 | rank 3 array | n x height x width (or rank 2 for one image).  Can be a masked array.  
+        Returns:
+            r2 | rank 2 array | n x n_pixels (or rank 1 if r3 is rank 2)
+        """
+        import numpy as np
+        r3 = np.ma.getdata(r3)
+        return np.reshape(r3, r3.shape[:-2] + (self.mask.size,))[..., self.pixel_args]
     
-    return inversion_results
+    def scatter_ma(self, r2, out = None):
+        """ As scatter, but returns a masked array (with its own mask).  
+        """
+        import numpy as np
+        import numpy.ma as ma
+        r3 = self.scatter(r2, out)
+        return ma.array(r3, mask = np.broadcast_to(self.mask, r3.shape).copy(), copy = False)
 
 
 #%%
@@ -1002,29 +1098,164 @@ def col_to_ma(col, pixel_mask):
 
 #%% taken from insar_tools.py
 
-def r2_to_r3(ifgs_r2, mask):
+def r2_to_r3(ifgs_r2, mask, out = None):
     """ Given a rank2 of ifgs as row vectors, convert it to a rank3. 
     Inputs:
         ifgs_r2 | rank 2 array | ifgs as row vectors 
         mask | rank 2 array | to convert a row vector ifg into a rank 2 masked array        
+        out | rank 3 array or None | if provided (e.g. a memmap), the ifgs are written to this, rather than a new array.  See mask_pixels.  
     returns:
         phUnw | rank 3 array | n_ifgs x height x width
     History:
         2020/06/10 | MEG  | Written
+        2026_10_18 | AG | Replace the loop of col_to_ma calls with one scatter of all the rows (mask_pixels.scatter_ma), which keeps the precision of ifgs_r2.  Add out.  
     """
-    import numpy as np
-    import numpy.ma as ma
-    
-    n_ifgs = ifgs_r2.shape[0]
-    ny, nx = col_to_ma(ifgs_r2[0,], mask).shape                                   # determine the size of an ifg when it is converter from being a row vector
+    return mask_pixels(mask).scatter_ma(ifgs_r2, out)                                   # a masked array
+
+
+#%%
+
+class lazy_sources_r3():
+    """ A rank 3 (n_sources x height x width) view of sources that are stored as row vectors, in which a source is only made into 
+    a rank 2 masked array when it is indexed.  This can be used in place of a rank 3 array of all the sources (e.g. for the inset 
+    axes of plot_2d_interactive_fig) without ever making all of them, and works with sources that are memory mapped from disk.  
+    The sources can also be stored as the coefficients that make them from some mixtures (i.e. sources = coefficients @ mixtures).  
+    Inputs:
+        sources_r2 | rank 2 array | n_sources x n_pixels, or if mixtures is provided, n_sources x n_mixtures
+        mask | rank 2 boolean | to convert a row vector source into a rank 2 masked array
+        mixtures | rank 2 array or None | n_mixtures x n_pixels.  If provided, sources_r2 are coefficients of these.  
+    History:
+        2026_10_18 | AG | Written
+        2026_10_18 | AG | Use mask_pixels, so that several sources can be indexed at once (e.g. [args] or [start:stop]).  
+    """
+    def __init__(self, sources_r2, mask, mixtures = None):
+        self.sources_r2 = sources_r2
+        self.mask = mask
+        self.mixtures = mixtures
+        self.shape = (sources_r2.shape[0],) + mask.shape
+        self.pixels = mask_pixels(mask)                                                 # the mapping between row vectors and images, computed once
+        
+    def __len__(self):
+        return self.shape[0]
     
-    ifgs_r3 = np.zeros((n_ifgs, ny, nx))                                                # initate to store new ifgs
-    for ifg_n, ifg_row in enumerate(ifgs_r2):                                           # loop through all ifgs
-        ifgs_r3[ifg_n,] = col_to_ma(ifg_row, mask)                                  
+    def __getitem__(self, index):
+        if isinstance(index, tuple):                                                    # e.g. [n,] or [n, :, :]
+            index, index_image = index[0], index[1:]
+        else:
+            index_image = ()
+        source = self.sources_r2[index]                                                 # one source (rank 1) or several (rank 2)
+        if self.mixtures is not None:
+            source = source @ self.mixtures
+        source_r3 = self.pixels.scatter_ma(source)
+        return source_r3[(slice(None),) * (source_r3.ndim - 2) + index_image]
+
+
+#%%
+
+class lazy_ifgs_all():
+    """ A rank 2 (n_ifgs x n_pixels) view of interferograms that are each the difference between the deformation at two acquisitions
+    (e.g. all the possible interferograms that can be made from a time series), without ever making them.  The interferograms are
+    differences @ acq_def_r2, where differences is a sparse matrix with -1 (start acquisition) and 1 (end acquisition) in each row, so
+    only the deformation at each acquisition (the size of the cumulative interferograms) is stored.  Products with it (e.g. for PCA and
+    whitening, ICA, and inversions), its Gram matrix, and selections of its rows are computed via acq_def_r2.  
+    Inputs:
+        acq_def_r2 | rank 2 array | n_acquisitions x n_pixels, the deformation at each acquisition as row vectors.  
+        acq_pairs | rank 2 array | n_ifgs x 2, the (start, end) acquisition of each interferogram, as indexes of the rows of acq_def_r2.  
+    History:
+        2026_10_18 | AG | Written
+        2026_10_18 | AG | Add sum_squares.  
+    """
+    __array_ufunc__ = None                                                              # so that numpy arrays @ this use __rmatmul__ (rather than making the array)
+
+    def __init__(self, acq_def_r2, acq_pairs):
+        import numpy as np
+        from scipy import sparse
+        self.acq_def_r2 = acq_def_r2
+        self.acq_pairs = np.asarray(acq_pairs)
+        n_ifgs = self.acq_pairs.shape[0]
+        self.differences = sparse.csr_matrix((np.tile([-1., 1.], n_ifgs), (np.repeat(np.arange(n_ifgs), 2), np.ravel(self.acq_pairs))),
+                                             shape = (n_ifgs, acq_def_r2.shape[0]))
+        self.differences.sort_indices()
+        self.shape = (n_ifgs, acq_def_r2.shape[1])
+        self.ndim = 2
+        self.size = self.shape[0] * self.shape[1]
+        self.dtype = acq_def_r2.dtype
+        self.acq_gram = None                                                            # acq_def_r2 @ acq_def_r2.T, only computed if needed.  
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """ Make only the interferograms (rows) that are selected (e.g. [n], [n, :], or [args, :])
+        """
+        import numpy as np
+        if not isinstance(index, tuple):
+            index = (index,)
+        ifg_args = np.arange(self.shape[0])[index[0]]                                   # works for ints, slices, and arrays of indexes or booleans.  
+        ifgs = self.differences[np.atleast_1d(ifg_args)] @ self.acq_def_r2
+        if np.ndim(ifg_args) == 0:
+            ifgs = ifgs[0]
+        return ifgs[(slice(None),) * (ifgs.ndim - 1) + index[1:]]
+
+    def __matmul__(self, other):
+        return self.differences @ (self.acq_def_r2 @ other)
+
+    def __rmatmul__(self, other):
+        import numpy as np
+        coefficients = (self.differences.T @ np.asarray(other).T).T                     # other @ differences
+        return coefficients.astype(self.dtype, copy = False) @ self.acq_def_r2           # in the precision of the ifgs (e.g. float32)
+
+    def __array__(self, dtype = None, copy = None):
+        import numpy as np
+        return np.asarray(self.toarray(), dtype = dtype)
+
+    def toarray(self):
+        """ Make all the interferograms.  
+        """
+        return self.differences @ self.acq_def_r2
+
+    def gram(self):
+        """ The Gram matrix of the interferograms (ifgs @ ifgs.T, n_ifgs x n_ifgs), in float64.  
+        """
+        from icasar.blind_signal_separation import gram_matrix
+        if self.acq_gram is None:
+            self.acq_gram = gram_matrix(self.acq_def_r2)
+        return self.differences @ (self.differences @ self.acq_gram).T                  # acq_gram is symmetric
+
+    def sum_squares(self):
+        """ The sum of the squares of all the interferograms (i.e. the trace of the Gram matrix), in float64, without making the Gram matrix.  
+        """
+        import numpy as np
+        from icasar.blind_signal_separation import gram_matrix
+        if self.acq_gram is None:
+            self.acq_gram = gram_matrix(self.acq_def_r2)
+        starts, ends = self.acq_pairs[:, 0], self.acq_pairs[:, 1]
+        return np.sum(self.acq_gram[starts, starts] + self.acq_gram[ends, ends] - 2 * self.acq_gram[starts, ends])      # |end - start|**2 for each ifg
+
+    def mean(self, axis = None, dtype = None, out = None):
+        """ As np.mean (which calls this).  
+        """
+        import numpy as np
+        if axis == 1:
+            means = self.differences @ np.mean(self.acq_def_r2, axis = 1)
+        elif axis == 0:
+            means = (np.ravel(self.differences.sum(axis = 0)) @ self.acq_def_r2) / self.shape[0]
+        else:
+            means = np.mean(self.differences @ np.mean(self.acq_def_r2, axis = 1))
+        return np.asarray(means, dtype = dtype)
+
+    def mean_centred_in_space(self, overwrite = False):
+        """ The same interferograms, but each with its mean removed (as a lazy_ifgs_all, as this is the same as removing the mean from each acquisition).  
+        If overwrite, the mean is removed from acq_def_r2 in place, and this is returned.  
+        """
+        import numpy as np
+        if overwrite:
+            acq_def_r2 = self.acq_def_r2
+            acq_def_r2 -= np.mean(acq_def_r2, axis = 1)[:, np.newaxis]
+            self.acq_gram = None                                                            # no longer correct.  
+            return self
+        return lazy_ifgs_all(self.acq_def_r2 - np.mean(self.acq_def_r2, axis = 1)[:, np.newaxis], self.acq_pairs)
     
-    mask_r3 = np.repeat(mask[np.newaxis,], n_ifgs, axis = 0)                            # expand the mask from r2 to r3
-    ifgs_r3_ma = ma.array(ifgs_r3, mask = mask_r3)                                      # and make a masked array    
-    return ifgs_r3_ma
 
 
 #%% Copied from small_plot_functions.py
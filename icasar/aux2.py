@@ -211,13 +211,59 @@ def plot_2d_interactive_fig(xy, colours, spatial_data = None, temporal_data = No
 
 
 
-def update_mask_sources_ifgs(mask_sources, sources, mask_ifgs, ifgs):
+_mask_update_args_cache = {}                                                                    # the arguments made by mask_update_args, for each pair of masks that they have been made for
+_mask_update_args_cache_nbytes = 100e6                                                           # the most bytes of arguments that are kept
+
+
+def clear_mask_update_args_cache():
+    """ Remove all the arguments that mask_update_args has kept (e.g. to free the memory once a set of frames has been processed).  
+    History:
+        2026_10_18 | AG | Written
+    """
+    _mask_update_args_cache.clear()
+
+
+def mask_update_args(mask_old, mask_new):
+    """ Given the mask used to make some row vectors (e.g. sources or ifgs) and a new mask, find the columns of the row vectors that are of pixels 
+    that are in both.  Applying a new mask is then just row_vectors[:, args] (or np.take), and can be done to any number of rows.  
+    The arguments are kept for the most recently used pairs of masks (up to 100MB of them, see clear_mask_update_args_cache to remove them), 
+    so they are only found once when the same masks are used again (e.g. when each new LiCSBAS frame is compared to stored sources).  
+    Inputs:
+        mask_old | boolean rank 2 | the mask that was used to make the row vectors (True is masked).  
+        mask_new | boolean rank 2 | the new mask.  Pixels that are masked in either are removed.  
+    Returns:
+        args | rank 1 array of ints | the columns of the row vectors to keep, in order (i.e. the same order as a row vector made with the mask of both).  
+    History:
+        2026_10_18 | AG | Written
+        2026_10_18 | AG | Keep up to 100MB of arguments (rather than those of the last 32 pairs of masks), and remove the least recently used first.  
+    """
+    import numpy as np
+    
+    mask_old = np.asarray(mask_old, dtype = bool)
+    mask_new = np.asarray(mask_new, dtype = bool)
+    if mask_old.shape != mask_new.shape:
+        raise Exception(f"The two masks must be the same size, even if they mask different pixels.  Exiting.  ")
+    key = (mask_old.shape, np.packbits(mask_old).tobytes(), np.packbits(mask_new).tobytes())
+    if key in _mask_update_args_cache:
+        args = _mask_update_args_cache.pop(key)                                          # and put it back at the end, as it's now the most recently used
+    else:
+        args = np.flatnonzero(~mask_new[~mask_old])                                      # for each pixel in the row vectors, is it also in the new mask?  
+    if args.nbytes <= _mask_update_args_cache_nbytes:
+        while sum([cached.nbytes for cached in _mask_update_args_cache.values()]) + args.nbytes > _mask_update_args_cache_nbytes:
+            del _mask_update_args_cache[next(iter(_mask_update_args_cache))]            # remove the least recently used pair
+        _mask_update_args_cache[key] = args
+    return args
+
+
+
+def update_mask_sources_ifgs(mask_sources, sources, mask_ifgs, ifgs, verbose = True):
     """ Given two masks of pixels, create a mask of pixels that are valid for both.  Also return the two sets of data with the new masks applied.  
     Inputs:
         mask_sources | boolean rank 2| original mask
         sources  | r2 array | sources as row vectors
         mask_ifgs | boolean rank 2| new mask
         ifgs  | r2 array | ifgs as row vectors
+        verbose | boolean | if True, the number of pixels in each mask is printed.  
     Returns:
         ifgs_new_mask
         sources_new_mask
@@ -226,37 +272,10 @@ def update_mask_sources_ifgs(mask_sources, sources, mask_ifgs, ifgs):
         2020/02/19 | MEG |  Written      
         2020/06/26 | MEG | Major rewrite.  
         2021_04_20 | MEG | Add check that sources and ifgs are both rank 2 (use row vectors if only one source, but it must be rank2 and not rank 1)
+        2026_10_18 | AG | Select the columns of each set of row vectors in one step (see mask_update_args), rather than making each row a masked array.  
+                           This is now the only version (it was also in icasar_funcs).  Add verbose.  
     """
     import numpy as np
-    import numpy.ma as ma
-    from icasar.aux1 import col_to_ma
-
-        
-    
-    def apply_new_mask(ifgs, mask_old, mask_new):
-        """Apply a new mask to a collection of ifgs (or sources) that are stored as row vectors with an accompanying mask.  
-        Inputs:
-            ifgs | r2 array | ifgs as row vectors
-            mask_old | r2 array | mask to convert a row of ifg into a rank 2 masked array
-            mask_new | r2 array | the new mask to be applied.  Note that it must not unmask any pixels that are already masked.  
-        Returns:
-            ifgs_new_mask | r2 array | as per ifgs, but with a new mask.  
-        History:
-            2020/06/26 | MEG | Written
-            2022_03_30 | MEG |  fix a bug in the number of pixels for the output array (ie. number of columns of ifgs_new_mask)
-        """
-
-        
-        for ifg_n, ifg in enumerate(ifgs):                                            # Loop through each source
-            ifg_r2 = col_to_ma(ifg, mask_old)                                         # turn it from a row vector into a rank 2 masked array        
-            ifg_r2_new_mask = ma.array(ifg_r2, mask = mask_new)                       # apply the new mask   
-            ifg_r1_new_mask = ma.compressed(ifg_r2_new_mask)                          # convert to row vector 
-            if ifg_n == 0:                                                            # if it's the first ifg..  
-                n_pixs_new = ifg_r1_new_mask.shape[0]                                 # get the new number of pixels 
-                ifgs_new_mask = np.zeros((ifgs.shape[0], n_pixs_new))                 # initiate an array of the correct size
-            ifgs_new_mask[ifg_n, :] = ifg_r1_new_mask                                 # put the row vector into the array
-        return ifgs_new_mask
-    
     
     # check some inputs.  Not exhuastive!
     if (len(sources.shape) != 2) or (len(ifgs.shape) != 2):
@@ -265,15 +284,20 @@ def update_mask_sources_ifgs(mask_sources, sources, mask_ifgs, ifgs):
     if mask_sources.shape != mask_ifgs.shape:
         raise Exception(f"The two masks must be the same size, even if they mask different pixels.  Exiting.  ")
     
-    mask_both = ~np.logical_and(~mask_sources, ~mask_ifgs)                                       # make a new mask for pixels that are in the sources AND in the current time series
-    n_pixs_sources = len(np.argwhere(mask_sources == False))                                  # masked pixels are 1s, so invert with 1- bit so that non-masked are 1s, then sum to get number of pixels
-    n_pixs_new = len(np.argwhere(mask_ifgs == False))                                          # ditto for new mask
-    n_pixs_both = len(np.argwhere(mask_both == False))                                        # ditto for the mutual mask
-    print(f"Updating masks and ICA sources.  Of the {n_pixs_sources} in the 1st set of sources and {n_pixs_new} in the 2nd set of sources, "
-          f"{n_pixs_both} are in both and can be used in the following step.  ")
+    for name, r2_array, mask in zip(['sources', 'ifgs'], [sources, ifgs], [mask_sources, mask_ifgs]):
+        if r2_array.shape[1] != np.sum(~mask):
+            raise Exception(f"There are {r2_array.shape[1]} pixels in each row of '{name}', but {np.sum(~mask)} pixels aren't masked in its mask.  Exiting.  ")
+    
+    mask_both = np.logical_or(mask_sources, mask_ifgs)                                          # make a new mask for pixels that are in the sources AND in the current time series
+    if verbose:
+        n_pixs_sources = sources.shape[1]
+        n_pixs_new = ifgs.shape[1]
+        n_pixs_both = np.sum(~mask_both)
+        print(f"Updating masks and ICA sources.  Of the {n_pixs_sources} in the 1st set of sources and {n_pixs_new} in the 2nd set of sources, "
+              f"{n_pixs_both} are in both and can be used in the following step.  ")
     
-    ifgs_new_mask = apply_new_mask(ifgs, mask_ifgs, mask_both)                                  # apply the new mask to the old ifgs and return the non-masked elemts as row vectors.  
-    sources_new_mask = apply_new_mask(sources, mask_sources, mask_both)                         # ditto for the sources.  
+    ifgs_new_mask = np.take(ifgs, mask_update_args(mask_ifgs, mask_sources), axis = 1)          # apply the new mask to the old ifgs and return the non-masked elemts as row vectors.  
+    sources_new_mask = np.take(sources, mask_update_args(mask_sources, mask_ifgs), axis = 1)    # ditto for the sources.  
     
     return ifgs_new_mask, sources_new_mask, mask_both
     
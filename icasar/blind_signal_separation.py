@@ -12,7 +12,8 @@ Created on Wed Dec 18 11:59:13 2019
 
 def fastica_MEG(X, n_comp=None,
             algorithm="parallel", whiten=True, fun="logcosh", fun_prime='', 
-            fun_args={}, maxit=200, tol=1e-04, w_init=None, verbose = True):
+            fun_args={}, maxit=200, tol=1e-04, w_init=None, verbose = True, record_history = False, 
+            minibatch_param = None):
     """Perform Fast Independent Component Analysis.
     Parameters
     ----------
@@ -48,6 +49,20 @@ def fastica_MEG(X, n_comp=None,
     w_init : (n_comp,n_comp) array
              Initial un-mixing array of dimension (n.comp,n.comp).
              If None (default) then an array of normal r.v.'s is used
+    record_history : boolean
+             If True, the change in W and W itself are recorded at each iteration 
+             (parallel only).  If False, hist_lim and hist_W are None.  
+    minibatch_param : None or tuple
+             (n_samples_batch, batch_growth) or (n_samples_batch, batch_growth, maxit_batch).  
+             If a tuple (and parallel), FastICA is first run on a random selection of 
+             n_samples_batch samples, then on a selection batch_growth times bigger, and so 
+             on (each starting from the previous W), and only then on all the samples.  If 
+             batch_growth is 1 (or less), only one selection is used.  Each selection is only 
+             iterated maxit_batch times at most (default 10), and to a looser tolerance, as 
+             the sampling noise of a selection stops W settling to tol (see minibatch_phases).  
+             As the iterations with all the samples start close to the solution, few are 
+             needed.  Convergence (and the converged flag and history) is still for the 
+             iterations with all the samples.  
  
     Results
     -------
@@ -76,6 +91,9 @@ def fastica_MEG(X, n_comp=None,
       2017/07/19 | Merged into one function by MEG and included a PCA function for whitening
       2017/07/20 | fixed bug when giving the function whitened data
       2018/02/22 | Return a boolean flag describing if algorithm converged or not (only works with symetric estimation)
+      2026_10_18 | AG | Parallel iterations reuse buffers (see fastica_nonlinearity), and the history is only recorded if record_history.  
+      2026_10_18 | AG | Add minibatch_param to first iterate with random selections of the samples.  
+      2026_10_18 | AG | Give each phase of minibatch_param its own (looser) tolerance and a small iteration cap (see minibatch_phases).  
       
     """
     
@@ -105,7 +123,7 @@ def fastica_MEG(X, n_comp=None,
             # we set lim to tol+1 to be sure to enter at least once in next while
             lim = tol + 1 
             while ((lim > tol) & (n_iterations < (maxit-1))):
-                wtx = np.dot(w.T, X)
+                wtx = np.dot(w.T.astype(X.dtype, copy = False), X)                  # in the precision of X, so that this isn't float64 for float32 X
                 gwtx = g(wtx, fun_args)
                 g_wtx = gprime(wtx, fun_args)
                 w1 = (X * gwtx).mean(axis=1) - g_wtx.mean() * w
@@ -118,9 +136,10 @@ def fastica_MEG(X, n_comp=None,
         return W                    # XXXX for deflation, a converged term isn't returned
 
     
-    def _ica_par(X, tol, g, gprime, fun_args, maxit, w_init):
+    def _ica_par(X, tol, g, gprime, fun_args, maxit, w_init, report = True):
         """Parallel FastICA.
-        Used internally by FastICA.
+        Used internally by FastICA.  wtx and g(wtx) are written to the same two buffers each iteration (and for the standard 
+        functions, g and the mean of gprime are computed in one pass, see fastica_nonlinearity), so no arrays the size of X are made.  
         2017/05/10 | edit to? 
         """
         def _sym_decorrelation(W):
@@ -129,36 +148,46 @@ def fastica_MEG(X, n_comp=None,
             s, u = linalg.eigh(K) 
             # u (resp. s) contains the eigenvectors (resp. square roots of 
             # the eigenvalues) of W * W.T 
-            u, W = [np.asmatrix(e) for e in (u, W)]
-            W = (u * np.diag(1.0/np.sqrt(s)) * u.T) * W  # W = (W * W.T) ^{-1/2} * W
-            return np.asarray(W)
+            W = ((u * (1.0/np.sqrt(s))) @ u.T) @ W  # W = (W * W.T) ^{-1/2} * W
+            return W
     
         n, p = X.shape
         W = _sym_decorrelation(w_init)
         # we set lim to tol+1 to be sure to enter at least once in next while
         lim = tol + 1 
         it = 0
-        hist_lim = np.zeros((1, maxit))                                   #initiate array for history of change of W
-        hist_W = np.zeros((w_init.size, maxit))                           # and for what W actually is
+        if record_history:
+            hist_lim = np.zeros((1, maxit))                               #initiate array for history of change of W
+            hist_W = np.zeros((w_init.size, maxit))                       # and for what W actually is
+        wtx = np.empty((n, p), dtype = X.dtype)                           # buffers for W @ X and g(W @ X), reused each iteration
+        gwtx = np.empty((n, p), dtype = X.dtype)
         while ((lim > tol) and (it < (maxit-1))):                           # and done less than the maximum iterations
-            wtx = W @ X
-            gwtx = g(wtx, fun_args)
-            g_wtx = gprime(wtx, fun_args)
-            W1 = (gwtx @ X.T)/float(p) - ((np.diag(g_wtx.mean(axis=1))) @ W)
+            np.matmul(W.astype(X.dtype, copy = False), X, out = wtx)        # W is kept in float64, but the products with X are in its precision
+            if type(fun) is str:
+                g_wtx_mean = fastica_nonlinearity(wtx, gwtx, fun, fun_args)       # note that this overwrites wtx
+            else:
+                g_wtx_mean = gprime(wtx, fun_args).mean(axis=1)
+                gwtx[:] = g(wtx, fun_args)
+            W1 = (gwtx @ X.T)/float(p) - (g_wtx_mean[:, np.newaxis] * W)    # scaling the rows of W is np.diag(g_wtx_mean) @ W
             W1 = _sym_decorrelation(W1)
             lim = max(abs(abs(np.diag(W1 @ W.T)) - 1))
             W = W1
             it += 1
-            hist_lim[0,it] = lim                                        # recond the measure of how much W changes
-            hist_W[:,it] = np.ravel(W)                                  # and what W is
-        hist_lim = hist_lim[:, 0:it]                                    # crop the 0 if we finish before the max number of iterations
-        hist_W = hist_W[:, 0:it]                                        # ditto
+            if record_history:
+                hist_lim[0,it] = lim                                    # recond the measure of how much W changes
+                hist_W[:,it] = np.ravel(W)                              # and what W is
+        if record_history:
+            hist_lim = hist_lim[:, 0:it]                                # crop the 0 if we finish before the max number of iterations
+            hist_W = hist_W[:, 0:it]                                    # ditto
+        else:
+            hist_lim = None
+            hist_W = None
         if it < maxit-1:
-            if verbose:
+            if verbose and report:
                 print('FastICA algorithm converged in ' + str(it) + ' iterations.  ')
             converged = True
         else:
-            if verbose:
+            if verbose and report:
                 print("FastICA algorithm didn't converge in " + str(it) + " iterations.  ")
             converged = False
         return W, hist_lim, hist_W, converged
@@ -219,7 +248,7 @@ def fastica_MEG(X, n_comp=None,
         vecs, vals, whiten_mat, dewhiten_mat, x_mc, x_decorrelate, x_white  = PCA_meg2(X)           # function determines whether to use compact trick or not
         X1 = x_white[0:n_comp, :]                                                                    # if more mixtures than components to recover, use only first few dimensions
     else:
-        X1 = np.copy(X[0:n_comp, :])
+        X1 = X[0:n_comp, :]                                                                          # only read, so doesn't need to be copied
         
 
     if w_init is None:
@@ -238,30 +267,208 @@ def fastica_MEG(X, n_comp=None,
               'w_init': w_init}
 
     func = algorithm_funcs.get(algorithm, 'parallel')
+    
+    if (minibatch_param is not None) and (algorithm == 'parallel'):                        # iterate with random selections of the samples to get close to the solution
+        for n_samples_batch, tol_batch, maxit_batch in minibatch_phases(X1.shape[1], minibatch_param, tol):
+            batch_args = np.sort(np.random.randint(0, X1.shape[1], n_samples_batch))       # with replacement, as much quicker than without when there are many samples
+            kwargs_batch = dict(kwargs, tol = tol_batch, maxit = maxit_batch)
+            kwargs['w_init'], _, _, _ = _ica_par(X1[:, batch_args], report = False, **kwargs_batch)
 
     W, hist_lim, hist_W, converged = func(X1, **kwargs)                                    #  W unmixes the whitened data
     #del X1
 
     if whiten:
-        S = W @ whiten_mat[0:n_comp,:] @ x_mc
+        S = (W @ whiten_mat[0:n_comp,:]).astype(x_mc.dtype, copy = False) @ x_mc
         A = np.linalg.inv(W)
         A_dewhite = dewhiten_mat[:,0:n_comp] @ A    
         #S = np.dot(np.dot(W, K), X)
         return W, S, A, A_dewhite, hist_lim, hist_W, vecs, vals, x_mc, x_decorrelate, x_white, converged
     else:
-        S = W @ X1
+        S = W.astype(X1.dtype, copy = False) @ X1
         A = np.linalg.inv(W)
         return W, S, A, hist_lim, hist_W, converged
 
 #%%
 
-def PCA_meg2(X, verbose = False, return_dewhiten = True):
+def minibatch_phases(n_samples, minibatch_param, tol):
+    """ The phases of mini-batch FastICA (see fastica_MEG), which each iterate with a random selection of the samples.  
+    The change in W between iterations can't fall below the sampling noise of a selection (which scales with 1 / sqrt of its 
+    number of samples), so the tolerance of each phase is tol scaled up by sqrt(n_samples / n_samples_batch), and each 
+    phase is only iterated a few times, as it only needs to get W close to the solution for the next phase.  
+    Inputs:
+        n_samples | int | number of samples in the data.  
+        minibatch_param | tuple | (n_samples_batch, batch_growth) or (n_samples_batch, batch_growth, maxit_batch).  See fastica_MEG.  
+        tol | float | the tolerance used with all the samples.  
+    Returns:
+        phases | list of tuples | (n_samples_batch, tol_batch, maxit_batch) for each phase.  Empty if the first selection isn't smaller than the data.  
+    History:
+        2026_10_18 | AG | Written, to stop each phase iterating to maxit.  
+    """
+    import numpy as np
+    
+    n_samples_batch, batch_growth = minibatch_param[:2]
+    if len(minibatch_param) > 2:
+        maxit_batch = minibatch_param[2]
+    else:
+        maxit_batch = 10
+    phases = []
+    while n_samples_batch < n_samples:
+        phases.append((n_samples_batch, tol * np.sqrt(n_samples / n_samples_batch), maxit_batch))
+        if batch_growth <= 1:
+            break
+        n_samples_batch = int(np.ceil(n_samples_batch * batch_growth))
+    return phases
+
+#%%
+
+def fastica_MEG_batch(X, w_inits, fun = 'logcosh', fun_args = {}, maxit = 200, tol = 1e-04, verbose = True, batch_bytes = 1e9, 
+                      minibatch_param = None):
+    """ Perform many runs of parallel FastICA on the same (whitened) data, with each run starting from a different initial unmixing matrix.  
+    The unmixing matrices are stacked along a first axis and iterated together (so each iteration is a few large matrix multiplications, 
+    rather than a few small ones for each run), and each run stops being updated once it has converged.  The convergence criterion is the same 
+    as in fastica_MEG, so the results are those of calling fastica_MEG (with whiten = False) with each of the initial unmixing matrices in turn.  
+    
+    Inputs:
+        X | rank 2 array | whitened data as row vectors (ie n_comp x n_samples).  If float32, the products with it are in float32 (but W is float64).  
+        w_inits | rank 3 array | initial unmixing matrices, n_runs x n_comp x n_comp
+        fun | string | 'logcosh', 'exp' or 'cube'.  See fastica_MEG
+        fun_args | dict | See fastica_MEG
+        maxit | int | Maximum number of iterations to perform
+        tol | float | tolerance at which the un-mixing matrix is considered to have converged
+        verbose | boolean | if True, the number of iterations each run took to converge (or if it didn't converge) is printed.  
+        batch_bytes | float | approximate memory limit for the (n_runs x n_comp x n_samples) arrays used in each iteration.  If more would be needed, 
+                              the runs are performed in several batches.  
+        minibatch_param | None or tuple | See fastica_MEG.  All the runs are first iterated together with the same random selections of the samples 
+                                          (so they stay batched), and the results are then no longer the same as calling fastica_MEG for each run.  
+    Returns:
+        W | rank 3 array | estimated un-mixing matrix for each run, n_runs x n_comp x n_comp
+        converged | rank 1 boolean array | True for runs that converged.  
+    History:
+        2026_10_18 | AG | Written
+        2026_10_18 | AG | W @ X and g(W @ X) for all the runs are written to two buffers that are made once for each batch of runs.  
+        2026_10_18 | AG | Add minibatch_param, with one selection of the samples for each phase that all the runs share.  
+    """
+    import numpy as np
+    
+    def sym_decorrelation_batch(W):
+        """ Symmetric decorrelation of a stack of unmixing matrices, i.e. W = (W * W.T) ^{-1/2} * W  for each one.  """
+        s, u = np.linalg.eigh(W @ np.swapaxes(W, 1, 2))
+        return ((u * (1.0 / np.sqrt(s))[:, np.newaxis, :]) @ np.swapaxes(u, 1, 2)) @ W
+    
+    def ica_par_batch(X, W, tol, maxit):
+        """ Iterate a stack of unmixing matrices (n_runs_batch x n_comp x n_comp) with the samples X until each has converged (or the 
+        maximum iterations are reached).  Returns W, which runs converged, and the number of iterations of each.  
+        """
+        n_samples = X.shape[1]
+        wtx_batch = np.empty((W.shape[0], n_comp, n_samples), dtype = X.dtype)                        # buffers for W @ X and g(W @ X), reused each iteration
+        gwtx_batch = np.empty((W.shape[0], n_comp, n_samples), dtype = X.dtype)
+        converged = np.zeros(W.shape[0], dtype = bool)
+        n_its = np.zeros(W.shape[0], dtype = int)
+        active = np.all(np.isfinite(W), axis = (1,2))                                                  # runs that are still being iterated.  
+        it = 0
+        while np.any(active) and (it < (maxit-1)):                                                     # stop when all have converged, or the maximum iterations reached.  
+            active_args = np.ravel(np.argwhere(active))
+            W_active = W[active_args]
+            wtx = wtx_batch[:active_args.shape[0]]                                                    # the first part of the buffers, for the runs that are still active
+            gwtx = gwtx_batch[:active_args.shape[0]]
+            np.matmul(W_active.astype(X.dtype, copy = False), X, out = wtx)
+            g_wtx_mean = fastica_nonlinearity(wtx, gwtx, fun, fun_args)                               # note that this overwrites wtx
+            W1 = (gwtx @ X.T)/float(n_samples) - (g_wtx_mean[:, :, np.newaxis] * W_active)
+            finite = np.all(np.isfinite(W1), axis = (1,2))                                             # runs can fail (e.g. nans), and these stop being iterated.  
+            W1[finite] = sym_decorrelation_batch(W1[finite])
+            finite &= np.all(np.isfinite(W1), axis = (1,2))
+            lim = np.max(np.abs(np.abs(np.einsum('rij,rij->ri', W1, W_active)) - 1), axis = 1)        # as per fastica_MEG, but for each run
+            W[active_args] = W1
+            it += 1
+            n_its[active_args] = it
+            finished = finite & (lim <= tol)                                                           # converged on this iteration
+            converged[active_args[finished]] = (it < (maxit-1))
+            active[active_args[finished | ~finite]] = False
+        return W, converged, n_its
+    
+    n_runs, n_comp, _ = w_inits.shape
+    n_samples = X.shape[1]
+    runs_per_batch = max(1, int(batch_bytes // (2 * n_comp * n_samples * X.itemsize)))                 # two arrays of size n_runs x n_comp x n_samples are needed each iteration.  
+    if minibatch_param is not None:
+        phases = [(np.sort(np.random.randint(0, n_samples, n_samples_batch)), tol_batch, maxit_batch)                              # the samples used by each phase, shared by all the runs
+                  for n_samples_batch, tol_batch, maxit_batch in minibatch_phases(n_samples, minibatch_param, tol)]
+    else:
+        phases = []
+    
+    W_all = np.zeros(w_inits.shape)
+    converged = np.zeros(n_runs, dtype = bool)
+    n_its = np.zeros(n_runs, dtype = int)
+    for batch_start in range(0, n_runs, runs_per_batch):
+        batch = np.arange(batch_start, min(batch_start + runs_per_batch, n_runs))
+        W = sym_decorrelation_batch(np.asarray(w_inits[batch], dtype = float))
+        for batch_args, tol_batch, maxit_batch in phases:                                              # iterate with the selections of the samples to get close to the solution
+            W, _, _ = ica_par_batch(X[:, batch_args], W, tol_batch, maxit_batch)
+        W_all[batch], converged[batch], n_its[batch] = ica_par_batch(X, W, tol, maxit)
+    
+    if verbose:
+        for n_it, run_converged in zip(n_its, converged):
+            if run_converged:
+                print('FastICA algorithm converged in ' + str(n_it) + ' iterations.  ')
+            else:
+                print("FastICA algorithm didn't converge in " + str(n_it) + " iterations.  ")
+    return W_all, converged
+
+#%%
+
+def fastica_nonlinearity(wtx, gwtx, fun = 'logcosh', fun_args = {}):
+    """ Compute the nonlinearity used by FastICA (g) and the mean of its derivative (gprime) in one pass, without making any new arrays 
+    the size of wtx.  The results are the same as g and gprime in fastica_MEG.  
+    
+    Inputs:
+        wtx | array | W @ X, with the samples along the last axis (e.g. n_comp x n_samples, or n_runs x n_comp x n_samples).  
+                      This is used as a buffer, so is overwritten.  
+        gwtx | array | the same shape and dtype as wtx.  g(wtx) is written to this.  
+        fun | string | 'logcosh', 'exp' or 'cube'.  See fastica_MEG
+        fun_args | dict | See fastica_MEG
+    Returns:
+        g_wtx_mean | array | mean of gprime(wtx) along the samples (last) axis.  
+    History:
+        2026_10_18 | AG | Written.  Computes g in place and the mean of gprime in the same pass, so no temporary arrays the size of W @ X are made.  
+    """
+    import numpy as np
+    
+    if fun == 'logcosh':
+        alpha = fun_args.get('alpha', 1.0)
+        np.multiply(wtx, alpha, out = gwtx)
+        np.tanh(gwtx, out = gwtx)                                                   # g
+        np.square(gwtx, out = wtx)
+        g_wtx_mean = alpha * (1 - np.mean(wtx, axis = -1))                          # as gprime is alpha * (1 - g**2)
+    elif fun == 'exp':
+        np.square(wtx, out = gwtx)
+        gwtx *= -0.5
+        np.exp(gwtx, out = gwtx)                                                    # exp(-(x**2)/2)
+        exp_mean = np.mean(gwtx, axis = -1)
+        gwtx *= wtx                                                                 # g
+        wtx *= gwtx                                                                 # x**2 * exp(-(x**2)/2)
+        g_wtx_mean = exp_mean - np.mean(wtx, axis = -1)                             # as gprime is (1 - x**2) * exp(-(x**2)/2)
+    elif fun == 'cube':
+        np.square(wtx, out = gwtx)
+        g_wtx_mean = 3 * np.mean(gwtx, axis = -1)                                   # gprime
+        gwtx *= wtx                                                                 # g
+    else:
+        raise ValueError('fun argument should be one of logcosh, exp or cube')
+    return g_wtx_mean
+
+#%%
+
+def PCA_meg2(X, verbose = False, return_dewhiten = True, n_comp = None, all_vals = False):
     """
     Input:
         X | array | rows are dimensions (e.g. 2 x 1000 normally for 2 sound recordings, or eg 12x225 for 12 15x15 pixel images)
                     Doesn't have to be mean centered
         verbose | boolean | if true, prints some info to the screen.  
-        return_dewhiten | boolean | if False, doesn't return the dewhitening matrix as the pseudo inverse needed to calculate this can fail with very large matrices (e.g. 1e6)
+        return_dewhiten | boolean | if False, doesn't return the dewhitening matrix.  (This used to need a pseudo inverse that could fail with very large matrices (e.g. 1e6), 
+                                    but is now computed from the eigenvalues, so this is rarely needed).  
+        n_comp | int or None | if an int, only this many of the most important components are computed (using scipy's eigh with subset_by_index, 
+                               so the other eigenvectors are never found), and the vectors, whitening and dewhitening matrices, and the 
+                               decorrelated and whitened data only have this many components (i.e. rows of x_white).  
+        all_vals | boolean | if True (and n_comp is an int), all the eigenvalues are still returned (e.g. for a plot of the variance of each component).  
+                             These are computed without the eigenvectors, so are cheaper.  
         
     Output:
         vecs | array | eigenvectors as columns, most important first
@@ -285,9 +492,14 @@ def PCA_meg2(X, verbose = False, return_dewhiten = True):
                        very large matrices.  
     2020/06/09 | MEG | Add a raise Exception so that data cannot have nans in it.  
     2021_10_07 | MEG | Add raise Exception for the case that negative eignevalues are returned.  
+    2026_10_18 | AG | The outputs that are the size of the data are in the precision of X (e.g. float32), but covariance matrices are float64.  
+    2026_10_18 | AG | Add n_comp, so that eigh only finds the eigenvectors that are used, and all_vals (which then uses eigvalsh).  
+    2026_10_18 | AG | x_mc is no longer a second copy of the mean centered data.  
+    2026_10_18 | AG | The compact trick whitens and dewhitens using the singular values of X (from the eigenvalues), so no loop over the rows or pinv.  
     """
     
     import numpy as np
+    from scipy import linalg
 
     # Check if the data are suitable
     if np.max(np.isnan(X)):
@@ -301,46 +513,281 @@ def PCA_meg2(X, verbose = False, return_dewhiten = True):
     if samples < dims and dims > 100:                   # do PCA using the compact trick (i.e. if there are more dimensions than samples, there will only ever be sample -1 PC [imagine a 3D space with 2 points.  There is a vector joining the points, one orthogonal to that, but then there isn't a third one])
         if verbose:
             print('There are more samples than dimensions and more than 100 dimension so using the compact trick.')
-        M = (1/samples) * X.T @ X                                        # maximum liklehood covariance matrix.  See blog post for details on (samples) or (samples -1): https://lazyprogrammer.me/covariance-matrix-divide-by-n-or-n-1/
-        e, EV = np.linalg.eigh(M)                                         # eigenvalues and eigenvectors.  Note that in some cases this function can return negative eigenvalues (e)    
+        if X.dtype == np.float64:
+            M = (1/samples) * X.T @ X                                    # maximum liklehood covariance matrix.  See blog post for details on (samples) or (samples -1): https://lazyprogrammer.me/covariance-matrix-divide-by-n-or-n-1/
+        else:
+            M = gram_matrix(X.T) / samples                               # as above, but summed in float64.  
+        truncate = (n_comp is not None) and (n_comp < samples - 1)      # the last eigenvector is always dropped, so truncating only helps if fewer are wanted
+        if truncate:
+            e, EV = linalg.eigh(M, subset_by_index = [samples - n_comp, samples - 1])      # only the n_comp biggest eigenvalues and their vectors
+        else:
+            e, EV = np.linalg.eigh(M)                                     # eigenvalues and eigenvectors.  Note that in some cases this function can return negative eigenvalues (e)    
+            e, EV = e[1:], EV[:, 1:]                                      # drop the smallest eigenvector and value as it's not defined (X is mean centered, so there are only samples - 1 components)
         if np.min(e) < 0:
             print(f"There are negative values in the eigenvalues.  This is a tricky problem, but is usually only caused by poor approximations to zero by floating point arithmetic.  "
                   f"Trying to set these to a better approxiation of zero to contiue.  ")
             e = np.where(e < 0, np.abs(e), e)
-        tmp = (X @ EV)                                                   # this is the compact trick
-        vecs = tmp[:,::-1]                                               # vectors are columns, make first (left hand ones) the important onces
-        vals = np.sqrt(e)[::-1]                                          # also reverse the eigenvectors.  Note that with the negative eigen values that can be encoutered here, this produces nans.  
-        vals = np.nan_to_num(vals, nan = 0.0)               
-        for i in range(vecs.shape[0]):        # normalise each eigenvector (ie change length to 1)
-            vecs[i,:] /= vals
-        vecs = vecs[:, 0:-1]                       # drop the last eigenvecto and value as it's not defined.            
-        vecs = np.divide(vecs, np.linalg.norm(vecs, axis = 0)[np.newaxis, :])       # make unit length (columns)
-        vals = vals[0:-1]                          # also drop the last eigenvealue
-        X_pca_basis = vecs.T @ X                     # whitening using the compact trick is a bit of a fudge
-        covs = np.diag(np.cov(X_pca_basis))
-        covs_recip = np.reciprocal(np.sqrt(covs))
-        covs_recip_mat = np.diag(covs_recip)
-        whiten_mat = (covs_recip_mat @ vecs.T)
+        e, EV = e[::-1], EV[:, ::-1]                                     # vectors are columns, make first (left hand ones) the important onces
+        singular_vals = np.sqrt(e * samples)                             # X = vecs @ diag(singular_vals) @ EV.T (the thin SVD of X)
+        vecs = X @ (EV / singular_vals[np.newaxis, :]).astype(X.dtype, copy = False)          # this is the compact trick, the left singular vectors are X @ EV scaled by 1 / singular_vals
+        vecs /= np.linalg.norm(vecs, axis = 0)[np.newaxis, :]            # and are unit length, but make sure of this (as floating point)
+        vals = np.sqrt(e)                                                # the square roots of the eigenvalues
+        if truncate and all_vals:
+            vals = np.sqrt(np.abs(linalg.eigvalsh(M)))[::-1][0:-1]       # as above, but for all of them
+        whiten_scales = np.sqrt(samples - 1) / singular_vals             # the rows of vecs.T @ X have variance singular_vals**2 / (samples - 1), so whitening just scales these
+        whiten_mat = whiten_scales.astype(X.dtype)[:, np.newaxis] * vecs.T
         if return_dewhiten:
-            dewhiten_mat = np.linalg.pinv(whiten_mat)                           # as always loose a dimension with compact trick, have to use pseudoinverse
+            dewhiten_mat = vecs * (1 / whiten_scales).astype(X.dtype)[np.newaxis, :]      # as vecs are orthonormal, this is the pseudoinverse of whiten_mat (so doesn't need np.linalg.pinv)
 
     else:                                                                       # or do PCA normally
-        cov_mat = np.cov(X)                                                     # dims by dims covariance matrix
-        vals_noOrder, vecs_noOrder = np.linalg.eigh(cov_mat)                    # vectors (vecs) are columns, not not ordered
-        order = np.argsort(vals_noOrder)[::-1]                                  # get order of eigenvalues descending
-        vals = vals_noOrder[order]                                              # reorder eigenvalues
-        vals = np.abs(vals)                                                        # do to floatint point arithmetic some tiny ones can be nagative which is problematic with the later square rooting
-        vecs = vecs_noOrder[:,order]                                            # reorder eigenvectors
-        vals_sqrt_mat = np.diag(np.reciprocal(np.sqrt(vals)))          # square roots of eigenvalues on diagonal of square matrix
-        whiten_mat = vals_sqrt_mat @ vecs.T                            # eigenvectors scaled by 1/values to make variance same in all directions
-        if return_dewhiten:
-            dewhiten_mat = np.linalg.inv(whiten_mat)
+        if X.dtype == np.float64:
+            cov_mat = np.cov(X)                                                 # dims by dims covariance matrix
+        else:
+            cov_mat = gram_matrix(X) / (samples - 1)                            # as per np.cov (X is mean centered), but without copying X to float64.  
+        truncate = (n_comp is not None) and (n_comp < dims)
+        if truncate:
+            vals, vecs = linalg.eigh(cov_mat, subset_by_index = [dims - n_comp, dims - 1])     # only the n_comp biggest eigenvalues and their vectors
+            vals = np.abs(vals[::-1])                                           # descending, and positive as below
+            vecs = vecs[:, ::-1]
+            whiten_mat = np.reciprocal(np.sqrt(vals))[:, np.newaxis] * vecs.T  # as below
+            if return_dewhiten:
+                dewhiten_mat = vecs * np.sqrt(vals)[np.newaxis, :]              # the inverse of the full whitening matrix, truncated to n_comp columns
+            if all_vals:
+                vals = np.abs(np.sort(linalg.eigvalsh(cov_mat))[::-1])          # but return all the eigenvalues
+        else:
+            vals_noOrder, vecs_noOrder = np.linalg.eigh(cov_mat)                    # vectors (vecs) are columns, not not ordered
+            order = np.argsort(vals_noOrder)[::-1]                                  # get order of eigenvalues descending
+            vals = vals_noOrder[order]                                              # reorder eigenvalues
+            vals = np.abs(vals)                                                        # do to floatint point arithmetic some tiny ones can be nagative which is problematic with the later square rooting
+            vecs = vecs_noOrder[:,order]                                            # reorder eigenvectors
+            vals_sqrt_mat = np.diag(np.reciprocal(np.sqrt(vals)))          # square roots of eigenvalues on diagonal of square matrix
+            whiten_mat = vals_sqrt_mat @ vecs.T                            # eigenvectors scaled by 1/values to make variance same in all directions
+            if return_dewhiten:
+                dewhiten_mat = np.linalg.inv(whiten_mat)
     # use the vectors and values to decorrelate and whiten
-    x_mc = np.copy(X)                       # data mean centered
-    x_decorrelate =  vecs.T @ X             # data decorrelated
-    x_white = whiten_mat @ X                # data whitened
+    x_mc = X                                # data mean centered (X is already a new array, so doesn't need copying)
+    x_decorrelate =  vecs.T.astype(X.dtype, copy = False) @ X             # data decorrelated
+    x_white = whiten_mat.astype(X.dtype, copy = False) @ X                # data whitened
   
     if return_dewhiten:
         return vecs, vals, whiten_mat, dewhiten_mat, x_mc, x_decorrelate, x_white
     else:
         return vecs, vals, whiten_mat, x_mc, x_decorrelate, x_white
+
+#%%
+
+def PCA_meg2_gram(gram, n_samples, n_comp = None, all_vals = False):
+    """ PCA (and whitening) from the Gram matrix of some mean centered data (X @ X.T), rather than the data itself.  
+    Gives the same results as the normal (i.e. not compact trick) case of PCA_meg2, but as the Gram matrix is only 
+    n_dims x n_dims, doesn't need any arrays that are the size of the data.  
+    
+    Inputs:
+        gram | rank 2 array | X @ X.T for mean centered data X (rows are dimensions).  e.g. 20 x 20 for 20 interferograms.  Used in float64.  
+        n_samples | int | number of samples in X (e.g. the number of pixels in each interferogram).  
+        n_comp | int or None | if an int, only this many of the most important components are computed and returned.  
+        all_vals | boolean | if True (and n_comp is an int), all the eigenvalues are still returned.  See PCA_meg2.  
+    Returns:
+        vecs | array | eigenvectors as columns, most important first
+        vals | 1d array | eigenvalues, most important first
+        whiten_mat | 2d array | whitens the mean centered data (n_comp x n_dims)
+        dewhiten_mat | 2d array | dewhitens the whitened data (n_dims x n_comp)
+    History:
+        2026_10_18 | AG | Written
+        2026_10_18 | AG | Use eigh with subset_by_index when n_comp is given, so the unused eigenvectors aren't found.  Add all_vals.  
+    """
+    import numpy as np
+    from scipy import linalg
+    
+    cov_mat = np.asarray(gram, dtype = np.float64) / (n_samples - 1)                # as per np.cov
+    n_dims = cov_mat.shape[0]
+    if (n_comp is not None) and (n_comp < n_dims):
+        vals, vecs = linalg.eigh(cov_mat, subset_by_index = [n_dims - n_comp, n_dims - 1])     # only the n_comp biggest eigenvalues and their vectors
+        vals = np.abs(vals[::-1])                                                   # descending, and positive as below
+        vecs = vecs[:, ::-1]
+    else:
+        vals_noOrder, vecs_noOrder = np.linalg.eigh(cov_mat)                        # vectors (vecs) are columns, not not ordered
+        order = np.argsort(vals_noOrder)[::-1]                                      # get order of eigenvalues descending
+        vals = np.abs(vals_noOrder[order])                                          # do to floatint point arithmetic some tiny ones can be nagative which is problematic with the later square rooting
+        vecs = vecs_noOrder[:,order]                                                # reorder eigenvectors
+    whiten_mat = np.reciprocal(np.sqrt(vals))[:, np.newaxis] * vecs.T               # eigenvectors scaled by 1/values to make variance same in all directions
+    dewhiten_mat = vecs * np.sqrt(vals)[np.newaxis, :]                              # the inverse of this (or the first n_comp columns of it)
+    if all_vals and (vals.shape[0] < n_dims):
+        vals = np.abs(np.sort(linalg.eigvalsh(cov_mat))[::-1])                      # all of them, e.g. for a plot of the variance of each component
+    return vecs, vals, whiten_mat, dewhiten_mat
+
+#%%
+
+def gram_matrix(X, n_samples_block = 2**16):
+    """ X @ X.T (e.g. for PCA), in float64.  If X isn't float64 (e.g. float32), the product for each block of samples (columns) is 
+    computed in the precision of X and these are summed in float64, so X is never copied to float64.  
+    
+    Inputs:
+        X | rank 2 array | data as row vectors (ie n_dims x n_samples)
+        n_samples_block | int | number of samples in each block.  
+    Returns:
+        gram | rank 2 array | n_dims x n_dims
+    History:
+        2026_10_18 | AG | Written
+    """
+    import numpy as np
+    
+    if X.dtype == np.float64:
+        return X @ X.T
+    gram = np.zeros((X.shape[0], X.shape[0]))
+    for sample_start in range(0, X.shape[1], n_samples_block):
+        X_block = X[:, sample_start : sample_start + n_samples_block]
+        gram += X_block @ X_block.T
+    return gram
+
+#%%
+
+class pca_streaming():
+    """ PCA (and whitening) of data that are read in blocks of samples (columns), so that the data are never all in memory and 
+    no copies of them (e.g. mean centered) are made.  The mean of each row and the Gram matrix of the mean centered data are 
+    accumulated in one pass over the blocks (each block's are combined with those of the previous blocks, as per Chan et al. 1979),
+    PCA is then done from the Gram matrix (see PCA_meg2_gram), and projections of the data (e.g. the whitened data) are made 
+    block by block when they're asked for (see project).  Gives the same results as the normal (i.e. not compact trick) case of PCA_meg2.  
+    New rows (e.g. the interferograms of a new acquisition) can be added without recomputing the Gram matrix of the previous rows 
+    (see append_rows), and as the data aren't pickled, the state can be saved (e.g. with pickle) and updated when there are new data.  
+    Inputs:
+        X | rank 2 array-like or function | n_dims x n_samples.  Either anything with a shape that can be sliced as X[:, start:stop] (e.g. a numpy array 
+                                            or memmap, or an h5py dataset), or a function that returns an iterator over the blocks of samples 
+                                            (each n_dims x n_samples_block, in order).  Note that a generator itself can't be used, as the data are read 
+                                            once to do the PCA, and again for each projection.  
+        n_comp | int or None | if an int, only this many of the most important components are computed.  See PCA_meg2.  
+        all_vals | boolean | if True (and n_comp is an int), all the eigenvalues are still computed.  See PCA_meg2.  
+        n_samples_block | int | number of samples in each block that is read (if X is array-like).  
+    Attributes:
+        means | rank 1 array | the mean of each row (dimension) of X, float64.  
+        gram | rank 2 array | the Gram matrix of the mean centered X (n_dims x n_dims), float64.  
+        n_samples | int | number of samples (columns) in X.  
+        vecs, vals, whiten_mat, dewhiten_mat | as per PCA_meg2_gram.  
+        dtype | numpy dtype | the precision of X (or float32 if X is integers), which is also that of the projections.  
+        check_args, check_values | rank 1 and rank 2 arrays | the first sample of each block, and the values of X there (n_dims x n_blocks).  
+                                                              Used by append_rows to check that the previous rows haven't changed.  
+    History:
+        2026_10_18 | AG | Written
+        2026_10_18 | AG | Add append_rows, and don't pickle X.  
+        2026_10_18 | AG | append_rows only sums the new rows, makes the products in one pass, and checks the previous rows using check_values.  
+    """
+    def __init__(self, X, n_comp = None, all_vals = False, n_samples_block = 2**16):
+        import numpy as np
+        self.X = X
+        self.n_samples_block = n_samples_block
+        self.n_samples = 0
+        self.means = None
+        check_args, check_values = [], []                                                                       # the first sample of each block, kept to check the data in append_rows
+        for X_block in self.blocks():
+            n_block = X_block.shape[1]
+            if n_block == 0:
+                continue
+            check_args.append(self.n_samples)
+            check_values.append(X_block[:, 0])
+            means_block = np.mean(X_block, axis = 1, dtype = np.float64)
+            gram_block = gram_matrix(X_block - means_block.astype(X_block.dtype)[:, np.newaxis])             # only this block is mean centered
+            if self.means is None:                                                                              # first block
+                self.means, self.gram, self.dtype = means_block, gram_block, np.result_type(X_block.dtype, np.float32)
+            else:
+                delta = means_block - self.means
+                n_total = self.n_samples + n_block
+                self.gram += gram_block + np.outer(delta, delta) * (self.n_samples * n_block / n_total)         # combine the Gram matrices of the mean centered blocks
+                self.means += delta * (n_block / n_total)
+            self.n_samples += n_block
+        if self.means is None:
+            raise Exception(f"There are no samples in the data, so PCA can't be performed.  ")
+        self.check_args = np.array(check_args)
+        self.check_values = np.stack(check_values, axis = 1)
+        if np.max(np.isnan(self.gram)):
+            raise Exception("Unable to proceed as the data ('X') contains Nans.  ")
+        self.vecs, self.vals, self.whiten_mat, self.dewhiten_mat = PCA_meg2_gram(self.gram, self.n_samples, n_comp, all_vals)
+
+    def blocks(self):
+        """ An iterator over the blocks of samples of X, as numpy arrays.  
+        """
+        import numpy as np
+        if callable(self.X):
+            return (np.asarray(X_block) for X_block in self.X())
+        return (np.asarray(self.X[:, sample_start : sample_start + self.n_samples_block]) for sample_start in range(0, self.X.shape[1], self.n_samples_block))
+
+    def project(self, matrix, out = None):
+        """ matrix @ (X - means), made one block of samples at a time.  e.g. the whitened data are self.project(self.whiten_mat), 
+        and the decorrelated data are self.project(self.vecs.T).  
+        Inputs:
+            matrix | rank 2 array | n_rows x n_dims
+            out | rank 2 array-like or None | n_rows x n_samples.  If provided (e.g. a memmap), the projection is written to this, and if not a new array is made.  
+        Returns:
+            out | rank 2 array | in the precision of X.  
+        """
+        import numpy as np
+        matrix = np.asarray(matrix).astype(self.dtype, copy = False)
+        means = self.means.astype(self.dtype)[:, np.newaxis]
+        if out is None:
+            out = np.empty((matrix.shape[0], self.n_samples), dtype = self.dtype)
+        sample_start = 0
+        for X_block in self.blocks():
+            sample_stop = sample_start + X_block.shape[1]
+            out[:, sample_start : sample_stop] = matrix @ (X_block - means)
+            sample_start = sample_stop
+        return out
+
+    def append_rows(self, X, n_comp = None, all_vals = False):
+        """ Update the PCA for new rows (dimensions, e.g. the interferograms of a new acquisition) that have been added to the end of the data.  
+        The means and Gram matrix of the previous rows are kept, and only the products of the new rows with all the rows are computed (in one 
+        pass over the data), so the arithmetic is proportional to the number of new rows (though all the rows are still read).  
+        Inputs:
+            X | rank 2 array-like or function | as per __init__, but n_dims_new x n_samples.  The first n_dims rows must be the data used before 
+                                                (which is checked using the values of a few samples that were kept), and the same samples (e.g. pixels).  
+            n_comp | int or None | as per __init__.  
+            all_vals | boolean | as per __init__.  
+        Returns:
+            Updates means, gram, vecs, vals, whiten_mat, and dewhiten_mat (and X, which is then used by project).  
+        """
+        import numpy as np
+        n_dims = self.gram.shape[0]
+        self.X = X
+        
+        # 1: products of each row with the new rows, and the sums of the new rows.  The new rows are shifted by their values in the first sample 
+        #    (close to their means) so that there's little cancellation when they're mean centered below.  
+        cross = None
+        n_samples = 0
+        for X_block in self.blocks():
+            if X_block.shape[1] == 0:
+                continue
+            if cross is None:
+                n_dims_new = X_block.shape[0]
+                shift = X_block[n_dims:, :1].astype(np.float64)
+                cross = np.zeros((n_dims_new, n_dims_new - n_dims))
+                sums_new = np.zeros(n_dims_new - n_dims)
+                check_values = np.zeros((n_dims_new, self.check_args.shape[0]), dtype = self.check_values.dtype)
+            X_new_shifted = X_block[n_dims:] - shift.astype(X_block.dtype)
+            cross += X_block @ X_new_shifted.T
+            sums_new += np.sum(X_new_shifted, axis = 1, dtype = np.float64)
+            check_in_block = (self.check_args >= n_samples) & (self.check_args < n_samples + X_block.shape[1])
+            check_values[:, check_in_block] = X_block[:, self.check_args[check_in_block] - n_samples]
+            n_samples += X_block.shape[1]
+        if n_samples != self.n_samples:
+            raise Exception(f"There are {n_samples} samples in X, but the PCA was for {self.n_samples}.  They must be the same samples (e.g. pixels).  ")
+        if not np.allclose(check_values[:n_dims], self.check_values, equal_nan = True):
+            raise Exception(f"The first {n_dims} rows of X aren't the data that were used before, so the PCA can't be updated.  ")
+        
+        # 2: mean center the products.  For row i and new row j, sum(x_i * (y_j - m_j)) = sum(x_i * (y_j - c_j)) - (m_j - c_j) * sum(x_i)
+        means_new = shift[:, 0] + sums_new / n_samples
+        means = np.concatenate((self.means, means_new))
+        cross -= np.outer(n_samples * means, means_new - shift[:, 0])
+        
+        # 3: the new Gram matrix, and PCA
+        gram = np.zeros((n_dims_new, n_dims_new))
+        gram[:n_dims, :n_dims] = self.gram
+        gram[:, n_dims:] = cross
+        gram[n_dims:, :n_dims] = cross[:n_dims].T
+        self.gram = gram
+        self.means = means
+        self.check_values = check_values
+        self.vecs, self.vals, self.whiten_mat, self.dewhiten_mat = PCA_meg2_gram(self.gram, self.n_samples, n_comp, all_vals)
+
+    def __getstate__(self):
+        """ The data (X) aren't pickled, only what's needed to update the PCA (see append_rows).  
+        """
+        state = dict(self.__dict__)
+        state['X'] = None
+        return state
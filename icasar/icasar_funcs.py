@@ -7,13 +7,18 @@ Created on Tue May 29 11:23:10 2018
 
 import pdb
 
+from icasar.aux2 import update_mask_sources_ifgs  # noqa: F401                      # this used to also be defined here, so can still be imported from here.  
+
 #%%
 
 def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window", 
            sica_tica = 'sica', ifgs_format = 'all', max_n_all_ifgs = 1000,                                                     # this row of arguments are only needed with spatial data.  
            bootstrapping_param = (200,0), ica_param = (1e-4, 150), tsne_param = (30,12), hdbscan_param = (35,10),
            out_folder = './ICASAR_results/', ica_verbose = 'long', inset_axes_side = {'x':0.1, 'y':0.1}, 
-           load_fastICA_results = False, label_sources = False):
+           load_fastICA_results = False, label_sources = False, n_jobs = 1, sources_as_coefficients = False,
+           sources_on_disk = False, sources_dtype = None, memory_budget = 1e9, knn_param = None,
+           tsne_mode = 'auto', tsne_method = 'barnes_hut', overwrite_input = False, dtype = 'float64', minibatch_param = None, 
+           incremental_pca = False):
     """
     Perform ICASAR, which is a robust way of applying sICA to data.  As PCA is also performed as part of this,
     the sources and time courses found by PCA are also returned.  Note that this can be run with eitehr 1d data (e.g. time series for a GPS station),
@@ -62,6 +67,38 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
         
 
         load_fastICA_results | boolean | The multiple runs of FastICA are slow, so if now paramters are being changed here, previous runs can be reloaded.  
+        n_jobs | int | number of processes used to perform the multiple runs of FastICA.  The results don't depend on this.  If more than 1, on platforms 
+                       that start new processes by spawning them (e.g. Windows and macOS), the script that calls ICASAR must do so inside an 
+                       if __name__ == '__main__': block (as the processes import the script).  
+        sources_as_coefficients | boolean | sICA only.  If True, the sources from each run of FastICA are stored as the coefficients that make them from the 
+                                            mean centered mixtures (n_ifgs long, rather than n_pixels), and the similarities between them are computed from these.  
+                                            Only the centrotypes are made at full resolution.  
+        sources_on_disk | boolean | sICA only.  If True, the sources from each run of FastICA are written to FastICA_sources.npy in out_folder as each run 
+                                    converges, and are then only read from there when needed (as a numpy memmap), rather than all being kept in RAM.  
+        sources_dtype | string or None | 'float64' or 'float32'.  The precision the sources from each run of FastICA are stored in (sICA only), and that the 
+                                         similarities between them are computed in.  If None, dtype.  
+        memory_budget | float | approximate number of bytes of the sources from all the runs of FastICA that are read at once when comparing them.  
+        knn_param | tuple or None | If None, the similarities between all the sources from all the runs of FastICA are used to cluster them.  If a tuple, 
+                                    (n_neighbours, 'exact' or 'approximate'), and only each source's n_neighbours most similar sources are used (as a sparse 
+                                    graph), which scales to many more sources.  See bootstrapped_sources_to_centrotypes.  
+        tsne_mode | string | 'auto', 'now', 'lazy' or 'background'.  When the 2d manifold representation of the sources (which is only used in figures) is computed.  
+                             If 'lazy', S_all_info['xy'] is a lazy_tsne which only computes it when needed (i.e. when its embedding method is called), 
+                             and if 'background' it is computed in a background thread.  In both cases, it's also saved to TSNE_xy_<n_sources>_<random_state>.npy 
+                             in out_folder once computed (see lazy_tsne).  
+                             'auto' is 'lazy' if figures is 'none', else 'now'.  
+        tsne_method | string | 'barnes_hut', 'barnes_hut_knn', 'fft' (requires openTSNE), or 'umap' (requires umap-learn).  How the 2d manifold is computed.  The 
+                               methods other than 'barnes_hut' only use each source's nearest neighbours, so are much faster with many sources.  See tsne_embedding.  
+        overwrite_input | boolean | If True, the mixtures (spatial_data['ifgs_dc'] or temporal_data['mixtures_r2']) are mean centered in place, rather than copied.  
+                                    This saves memory, but they are changed.  (If they aren't already dtype, it's a copy of them in dtype that is changed).  
+        dtype | string | 'float64' or 'float32'.  The precision of the mixtures, and so of everything that is the size of them (e.g. the whitened mixtures 
+                         and the products with them during FastICA, the sources, and the inversions).  The covariance and Gram matrices (which are small, 
+                         but sum over all the pixels) and their eigendecompositions and inverses are always computed in float64.  
+        minibatch_param | tuple or None | If a tuple, (n_pixels_batch, batch_growth), and each run of FastICA first iterates using random selections of 
+                                          n_pixels_batch pixels (then batch_growth times more, and so on), before a few iterations with all the pixels.  
+                                          This helps most when the runs need many iterations, see fastica_MEG and scripts/benchmark_minibatch_ica.py.  
+        incremental_pca | boolean | sICA with ifgs_format 'inc' or 'cum' only.  If True, the state of the PCA (see pca_streaming) is saved to PCA_state.pkl in 
+                                    out_folder (which isn't deleted), and if ICASAR is run again with the same interferograms plus some new ones 
+                                    at the end (e.g. when a new acquisition arrives), the PCA is updated with just the new interferograms, rather than recomputed.  
 
     Outputs:
         S_best | rank 2 array | the recovered sources as row vectors (e.g. 5 x 1230)
@@ -73,6 +110,7 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
         S_all_info | dictionary| useful for custom plotting. Sources: all the sources in a rank 3 array (e.g. 500x500 x1200 for 6 sources recovered 200 times)
                                                             labels: label for each soure
                                                             xy: x and y coordinats for 2d representaion of all sources
+                                                            If sources_as_coefficients, sources are the coefficients and mixtures_mc is also included (sources @ mixtures_mc are the sources).  
         phUnw_mean | r2 array | the mean for each interfeorram.  subtract from (tcs * sources) to get back original ifgs.  
         
     History:
@@ -90,6 +128,21 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
         2021_10_07 | MEG | Add option to limit the number of ifgs created from incremental. (e.g. if 5000 are generated but default value of 1000 is used, 1000 will be randomly chosen from the 5000)
         2021_10_20 | MEG | Also save the 2d position of each source, and its HDBSSCAN label in the .pickle file.  
         2022_01_18 | MEG | Add option to use cumulative (i.e. single master) interferograms.  
+        2026_10_18 | AG | Add n_jobs, to spread the FastICA runs over a pool of processes.  
+        2026_10_18 | AG | Add sources_as_coefficients, so the sources of each FastICA run are kept as n_ifgs coefficients of the mixtures, rather than n_pixels values.  
+        2026_10_18 | AG | Add sources_on_disk and sources_dtype (e.g. a float32 memmap of the sources of all the runs), and memory_budget to read them in blocks.  
+        2026_10_18 | AG | Add knn_param, to cluster using a sparse k nearest neighbour graph of the similarities.  
+        2026_10_18 | AG | Add tsne_mode ('auto' doesn't compute the 2d manifold if no figures are made, see lazy_tsne).  
+        2026_10_18 | AG | Add tsne_method (e.g. 'barnes_hut_knn' or 'fft'), see tsne_embedding.  
+        2026_10_18 | AG | All ifgs are never made (see lazy_ifgs_all), so PCA, ICA, and the inversions with them use only products with the cumulative ifgs.  
+        2026_10_18 | AG | Only make the time series that are used, and only mean centre them when needed.  Add overwrite_input.  
+        2026_10_18 | AG | Add dtype, so that the mixtures, PCA and FastICA can be float32.  
+        2026_10_18 | AG | Add minibatch_param, which is passed to each FastICA run (see fastica_MEG).  
+        2026_10_18 | AG | PCA only computes the first n_comp components (and all the eigenvalues only if there are figures).  
+        2026_10_18 | AG | PCA (if not the compact trick) is done with pca_streaming, so no copies of the mixtures are made.  
+        2026_10_18 | AG | PCA is only tried once (the compact trick no longer uses a pseudo inverse that could fail).  
+        2026_10_18 | AG | Add incremental_pca, which saves PCA_state.pkl and updates it (pca_streaming.append_rows) when ifgs have been added.  
+        2026_10_18 | AG | The inversions for the time courses don't make the models, or the residuals unless they're returned.  
     
     Stack overview:
         PCA_meg2                                        # do PCA
@@ -124,34 +177,90 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
     from pathlib import Path
     import pdb
     # internal functions
-    from icasar.blind_signal_separation import PCA_meg2
-    from icasar.aux1 import  bss_components_inversion, maps_tcs_rescale, r2_to_r3, r2_arrays_to_googleEarth
+    from icasar.blind_signal_separation import PCA_meg2, PCA_meg2_gram, pca_streaming
+    from icasar.aux1 import  bss_components_inversion, maps_tcs_rescale, r2_to_r3, r2_arrays_to_googleEarth, lazy_sources_r3, lazy_ifgs_all
     from icasar.aux1 import plot_pca_variance_line, plot_temporal_signals, two_spatial_signals_plot
     from icasar.aux1 import prepare_point_colours_for_2d, prepare_legends_for_2d, create_all_ifgs, create_cumulative_ifgs, signals_to_master_signal_comparison, plot_source_tc_correlations
-    from icasar.aux2 import plot_2d_interactive_fig, baseline_from_names, update_mask_sources_ifgs
+    from icasar.aux2 import plot_2d_interactive_fig, baseline_from_names
     
     
     class ifg_timeseries():
-        def __init__(self, mixtures, ifg_dates):
+        """ A time series of ifgs.  The mean centred mixtures (in space or in time) and the means are only computed when they are first used, 
+        and then kept.  If overwrite_mixtures, the first mean centering is done in place (so the mixtures are not copied, but can't be used again).  
+        """
+        def __init__(self, mixtures, ifg_dates, overwrite_mixtures = False):
             self.mixtures = mixtures
             self.ifg_dates = ifg_dates
+            self.overwrite_mixtures = overwrite_mixtures
+            self._means_space = None                                                                    # these are only computed when they are first used.  
+            self._mixtures_mc_space = None
+            self._means_time = None
+            self._mixtures_mc_time = None
             self.print_timeseries_info()
-            self.mean_centre_in_space()
-            self.mean_centre_in_time()
             self.baselines_from_names()
                         
         def print_timeseries_info(self):
             print(f"This interferogram timeseries has {self.mixtures.shape[0]} times and {self.mixtures.shape[1]} pixels.  ")
             
+        def get_mixtures(self):
+            if self.mixtures is None:
+                raise Exception("The mixtures have already been mean centered in place (overwrite_mixtures), so can't be used again.  ")
+            return self.mixtures
+        
+        @property
+        def means_space(self):
+            import numpy as np
+            if self._means_space is None:
+                self._means_space = np.mean(self.get_mixtures(), axis = 1)
+            return self._means_space
+        
+        @property
+        def mixtures_mc_space(self):
+            if self._mixtures_mc_space is None:
+                self.mean_centre_in_space()
+            return self._mixtures_mc_space
+        
+        @property
+        def means_time(self):
+            import numpy as np
+            if self._means_time is None:
+                self._means_time = np.mean(self.get_mixtures(), axis = 0)
+            return self._means_time
+        
+        @property
+        def mixtures_mc_time(self):
+            if (self._mixtures_mc_time is None) and isinstance(self.mixtures, lazy_ifgs_all):          # these would have to be made for all ifgs, and are only used for the cumulative ifgs (with tICA).  
+                raise Exception("The interferograms can't be mean centered in time when they are all the interferograms that are made lazily (a lazy_ifgs_all), "
+                                "as all of them would have to be made.  Only the cumulative interferograms (e.g. for tICA) can be mean centered in time.  Exiting.  ")
+            if self._mixtures_mc_time is None:
+                self.mean_centre_in_time()
+            return self._mixtures_mc_time
+            
         def mean_centre_in_space(self):
             import numpy as np
-            self.means_space = np.mean(self.mixtures, axis = 1)
-            self.mixtures_mc_space = self.mixtures - self.means_space[:, np.newaxis]
+            means_space = self.means_space
+            mixtures = self.get_mixtures()
+            if isinstance(mixtures, lazy_ifgs_all):
+                self._mixtures_mc_space = mixtures.mean_centred_in_space(overwrite = self.overwrite_mixtures)     # still never made
+            elif self.overwrite_mixtures and np.issubdtype(mixtures.dtype, np.floating):
+                mixtures -= means_space[:, np.newaxis]
+                self._mixtures_mc_space = mixtures
+            else:
+                self._mixtures_mc_space = mixtures - means_space[:, np.newaxis]
+            if self.overwrite_mixtures:
+                self.mixtures = None
             
         def mean_centre_in_time(self):
             import numpy as np
-            self.means_time = np.mean(self.mixtures, axis = 0)
-            self.mixtures_mc_time = self.mixtures - self.means_time[np.newaxis, :]
+            means_time = self.means_time
+            mixtures = self.get_mixtures()
+            if self.overwrite_mixtures and np.issubdtype(mixtures.dtype, np.floating):
+                mixtures -= means_time[np.newaxis, :]
+                self._mixtures_mc_time = mixtures
+            else:
+                self._mixtures_mc_time = mixtures - means_time[np.newaxis, :]
+            if self.overwrite_mixtures:
+                self.mixtures = None
             
             
         def baselines_from_names(self):
@@ -225,6 +334,15 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
                 print(f"With tica (tICA),  only the cumulative ifgs can be used.  Updating the ifgs_format setting to reflect this.  ")
                 ifgs_format = 'cum'
             print(f"For tICA, the cumulative interferograms are required.  These will be calculated from the incremental (daisy chain) interferograms.  ")
+            if sources_as_coefficients:
+                print(f"'sources_as_coefficients' is only supported with sICA.  Setting this to False and trying to continue.  ")
+                sources_as_coefficients = False
+            if sources_on_disk:
+                print(f"'sources_on_disk' is only supported with sICA.  Setting this to False and trying to continue.  ")
+                sources_on_disk = False
+        if sources_as_coefficients and sources_on_disk:
+            print(f"As 'sources_as_coefficients' is True, the sources are already small so 'sources_on_disk' is being set to False.  ")
+            sources_on_disk = False
                 
     else:                                                                                                                           # or we could do temporal data.  
         xvals = temporal_data['xvals']
@@ -232,6 +350,12 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
         del sica_tica, ifgs_format, max_n_all_ifgs
         if np.max(np.isnan(temporal_data['mixtures_r2'])):
             raise Exception("Unable to proceed as the data ('spatial_data['mixtures_r2']') contains Nans.  ")
+        if sources_as_coefficients:
+            print(f"'sources_as_coefficients' is only supported with spatial data.  Setting this to False and trying to continue.  ")
+            sources_as_coefficients = False
+        if sources_on_disk:
+            print(f"'sources_on_disk' is only supported with spatial data.  Setting this to False and trying to continue.  ")
+            sources_on_disk = False
    
                        
     #-3:  sort out various things for figures, and check input is of the correct form
@@ -257,15 +381,26 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
         print(f"'ica_verbose should be either 'long' or 'short'.  Setting to 'short' and continuing.  ")
         ica_verbose = 'short'
         fastica_verbose = False
+    if tsne_mode == 'auto':
+        if figures == 'none':
+            tsne_mode = 'lazy'                                                                          # the 2d manifold is only used in figures, so only compute it if it's needed later.  
+        else:
+            tsne_mode = 'now'
 
 
     # -1: create a folder that will be used for outputs
     if os.path.exists(out_folder):                                                                      # see if the folder we'll write to exists.  
+        files_to_keep = []
         if load_fastICA_results:                                                                        # we will need the .pkl of results from a previous run, so can't just delete the folder.  
+            print(f"As 'load_fastICA' is set to True, all but the FastICA_results.pkl (and FastICA_sources.npy) files will be deleted.   ")
+            files_to_keep.extend(['FastICA_results.pkl', 'FastICA_sources.npy'])
+        if incremental_pca:                                                                             # the PCA from a previous run may be updated
+            print(f"As 'incremental_pca' is set to True, PCA_state.pkl won't be deleted.  ")
+            files_to_keep.append('PCA_state.pkl')
+        if len(files_to_keep) > 0:
             existing_files = os.listdir(out_folder)                                                     # get all the ICASAR outputs.  
-            print(f"As 'load_fastICA' is set to True, all but the FastICA_results.pkl file will be deleted.   ")
             for existing_file in existing_files:
-                if existing_file == 'FastICA_results.pkl':                                              # if it's the results from the time consuming FastICA runs...
+                if existing_file in files_to_keep:                                                      # if it's the results from the time consuming FastICA runs (or PCA)...
                     pass                                                                                # ignore it    
                 else:
                     os.remove(out_folder / existing_file)                                               # but if not, delete it.  
@@ -283,14 +418,25 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
     
 
     # -0:  Create all interferograms, create the arary of mixtures (X), and mean centre
+    X_names = None                                                                                                                      # the name of each mixture, if they're interferograms that can be updated (see incremental_pca)
+    if sources_dtype is None:
+        sources_dtype = dtype
     if spatial:
-        print(f"Creating all possible variations of the time series (incremental/daisy chain, cumulative, and all possible).  ")        # we allrady have the daisy chain ifgs.  
-        ifgs_all_r2, ifg_dates_all = create_all_ifgs(spatial_data['ifgs_dc'], spatial_data['ifg_dates_dc'], max_n_all_ifgs)             # create all ifgs, even if we don't use them.  
-        ifgs_cum_r2, ifg_dates_cum = create_cumulative_ifgs(spatial_data['ifgs_dc'], spatial_data['ifg_dates_dc'])                      # create the cumulative ifgs, even if we don't use them
-        ifgs_dc = ifg_timeseries(spatial_data['ifgs_dc'], spatial_data['ifg_dates_dc'])                                                 # create a class (an ifg_timeseries) using the daisy chain ifgs
-        ifgs_all = ifg_timeseries(ifgs_all_r2, ifg_dates_all)                                                                           # create a class (an ifg_timeseries) using all possible ifgs
-        ifgs_cum = ifg_timeseries(ifgs_cum_r2, ifg_dates_cum)                                                                           # create a class (an ifg_timeseries) using the cumualtive ifgs.  
-        del ifgs_all_r2, ifg_dates_all, ifgs_cum_r2, ifg_dates_cum
+        ifgs_dc_r2 = np.asarray(spatial_data['ifgs_dc'], dtype = dtype)                                                                # only a copy if they aren't already dtype
+        print(f"Creating the variations of the time series (incremental/daisy chain, cumulative, or all possible) that are needed.  ")    # we allrady have the daisy chain ifgs.  
+        ifgs_all = None                                                                                                                 # all ifgs are used as the mixtures, or to make figures of the sICA time courses
+        if (sica_tica == 'sica') and ((ifgs_format == 'all') or (fig_kwargs['figures'] != "none")):
+            ifgs_all_r2, ifg_dates_all = create_all_ifgs(ifgs_dc_r2, spatial_data['ifg_dates_dc'], max_n_all_ifgs,                      # create all ifgs
+                                                         return_lazy = True)                                                            # they're never made, only the cumulative ifgs are stored.  
+            ifgs_all = ifg_timeseries(ifgs_all_r2, ifg_dates_all, overwrite_mixtures = True)                                            # create a class (an ifg_timeseries) using all possible ifgs
+            del ifgs_all_r2, ifg_dates_all
+        ifgs_cum = None                                                                                                                 # cumulative ifgs are used as the mixtures, or with tICA
+        if (sica_tica == 'tica') or (ifgs_format == 'cum'):
+            ifgs_cum_r2, ifg_dates_cum = create_cumulative_ifgs(ifgs_dc_r2, spatial_data['ifg_dates_dc'])                               # create the cumulative ifgs
+            ifgs_cum = ifg_timeseries(ifgs_cum_r2, ifg_dates_cum, overwrite_mixtures = True)                                            # create a class (an ifg_timeseries) using the cumualtive ifgs.  
+            del ifgs_cum_r2, ifg_dates_cum
+        ifgs_dc = ifg_timeseries(ifgs_dc_r2, spatial_data['ifg_dates_dc'], overwrite_mixtures = overwrite_input)                        # create a class (an ifg_timeseries) using the daisy chain ifgs.  Made last as it may be mean centered in place.  
+        del ifgs_dc_r2
         
         if sica_tica == 'sica':
             X_mean = ifgs_dc.means_space                                                                                                # daisy chain ifgs are supplied, so only interested in returning daisy chain means.  
@@ -298,31 +444,56 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
                 X_mc = ifgs_all.mixtures_mc_space                                                                                       # the mixtures (used by PCA and ICA) can be all possible ifgs...
             elif ifgs_format == 'inc':
                 X_mc = ifgs_dc.mixtures_mc_space                                                                                        # or just the incremental (daisy chain) ifgs.....
+                X_names = ifgs_dc.ifg_dates                                                                                             # used to check which mixtures the PCA state is for (see incremental_pca)
             elif ifgs_format == 'cum':
                 X_mc = ifgs_cum.mixtures_mc_space                                                                                       # or the cumulative (single master) ifgs.  
+                X_names = ifgs_cum.ifg_dates
         elif sica_tica == 'tica':                                                                                                       # if we're doing temporal ica with spatial data, the mixtures need to be the transpose
             X_mc = ifgs_cum.mixtures_mc_time.T                                                                                          # as cumulative and transpose, effectively the time series for each point.  
             X_mean = ifgs_cum.means_time
     else:
-        X = temporal_data['mixtures_r2']
+        X = np.asarray(temporal_data['mixtures_r2'], dtype = dtype)
         X_mean = np.mean(X, axis = 1)[:,np.newaxis]                                                                                     # get the mean for each ifg (ie along rows.  )
-        X_mc = X - X_mean                                                                                                               # mean centre the data (along rows)
+        if overwrite_input and np.issubdtype(X.dtype, np.floating):
+            X -= X_mean
+            X_mc = X                                                                                                                    # mean centred in place
+        else:
+            X_mc = X - X_mean                                                                                                           # mean centre the data (along rows)
         
         
     # 1: do sPCA once (and possibly create a figure of the PCA sources)
     print('Performing PCA to whiten the data....', end = "")
-    success = False
-    count = 0
-    while (success == False) and (count < 10):
-        try:
-            PC_vecs, PC_vals, PC_whiten_mat, PC_dewhiten_mat, x_mc, x_decorrelate, x_white = PCA_meg2(X_mc, verbose = False)                    # do PCA on the mean centered mixtures
-            success = True
-        except:
-            success = False
-            count += 1 
-    if not success:
-        raise Exception(f"PCA failed after {count} attempts.  This is most common with tICA when the number of observations are lower than the "
-                        f"number of variables and the compact trick is being used.  ")
+    if isinstance(X_mc, lazy_ifgs_all):                                                                                         # all ifgs, which are never made, so PCA is done from their Gram matrix
+        PC_vecs, PC_vals, PC_whiten_mat, PC_dewhiten_mat = PCA_meg2_gram(X_mc.gram(), X_mc.shape[1], n_comp, 
+                                                                         all_vals = (fig_kwargs['figures'] != "none"))
+        x_decorrelate = PC_vecs.T @ X_mc                                                                                        # only the first n_comp are used
+        x_white = PC_whiten_mat @ X_mc
+    elif not ((X_mc.shape[1] < X_mc.shape[0]) and (X_mc.shape[0] > 100)):                                                      # PCA_meg2 wouldn't use the compact trick, so PCA can be done from the Gram matrix, without copies of the mixtures
+        pca = None
+        if incremental_pca and (X_names is not None) and (out_folder / 'PCA_state.pkl').exists():                                    # try to update the PCA from a previous run
+            with open(out_folder / 'PCA_state.pkl', 'rb') as f:
+                pca = pickle.load(f)
+                pca_names = pickle.load(f)
+            try:
+                if list(X_names[:len(pca_names)]) != list(pca_names):
+                    raise Exception(f"The interferograms in PCA_state.pkl aren't the first of the current ones.  ")
+                pca.append_rows(X_mc, n_comp, all_vals = (fig_kwargs['figures'] != "none"))
+                print(f"Updated the PCA from PCA_state.pkl with {len(X_names) - len(pca_names)} new interferograms.... ", end = '')
+            except Exception as e:
+                print(f"Unable to update the PCA from PCA_state.pkl ({e}), so it will be recomputed.  ")
+                pca = None
+        if pca is None:
+            pca = pca_streaming(X_mc, n_comp, all_vals = (fig_kwargs['figures'] != "none"))
+        if incremental_pca and (X_names is not None):
+            with open(out_folder / 'PCA_state.pkl', 'wb') as f:
+                pickle.dump(pca, f)                                                                                                 # without the mixtures, see pca_streaming
+                pickle.dump(list(X_names), f)
+        PC_vecs, PC_vals, PC_whiten_mat, PC_dewhiten_mat = pca.vecs, pca.vals, pca.whiten_mat, pca.dewhiten_mat
+        x_projected = pca.project(np.vstack((PC_vecs.T, PC_whiten_mat)))                                                               # both in one pass over the mixtures
+        x_decorrelate, x_white = x_projected[:PC_vecs.shape[1]], x_projected[PC_vecs.shape[1]:]
+    else:
+        PC_vecs, PC_vals, PC_whiten_mat, PC_dewhiten_mat, _, x_decorrelate, x_white = PCA_meg2(X_mc, verbose = False, n_comp = n_comp,      # do PCA on the mean centered mixtures, but only find the first n_comp components
+                                                                                                all_vals = (fig_kwargs['figures'] != "none"))  # all the eigenvalues are only needed for the figure
     A_pca = PC_vecs                                                                                                                     # time courses 
     S_pca = x_decorrelate                                                                                                               # sources
     if spatial:
@@ -341,8 +512,7 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
         plot_pca_variance_line(PC_vals, title = '01_PCA_variance_line', **fig_kwargs)
         if spatial:
             if sica_tica == 'sica':
-                inversion_results = bss_components_inversion(S_pca, [ifgs_dc.mixtures_mc_space, ifgs_all.mixtures_mc_space])            # invert to fit the incremetal ifgs and all ifgs
-                source_residuals = inversion_results[0]['residual']                                                                     # residual for just the daisy chain ifgs.         
+                inversion_results = bss_components_inversion(S_pca, [ifgs_dc.mixtures_mc_space, ifgs_all.mixtures_mc_space], return_model = False, return_residual = False) # invert to fit the incremetal ifgs and all ifgs
                 A_pca_dc = inversion_results[0]['tcs'].T                                                                                # in sICA, time courses are in A
                 A_pca_all = inversion_results[1]['tcs'].T                                                                               # and time courses for all possible ifgs.             
                 two_spatial_signals_plot(S_pca, spatial_data['mask'], spatial_data['dem'], 
@@ -358,21 +528,40 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
     
 
     # 2: Make or load the results of the multiple ICA runs.  
+    sources_all_r2 = None                                                                                # will be set if the sources from all the runs are already in one array (sICA only)
     if load_fastICA_results:
         print(f"Loading the results of multiple FastICA runs.  ")
         try:
             with open(out_folder / 'FastICA_results.pkl', 'rb') as f:
                 S_hist = pickle.load(f)   
                 A_hist = pickle.load(f)
+            if S_hist is None:                                                                           # if the sources were stored on disk (see sources_on_disk)
+                sources_all_r2 = np.load(out_folder / 'FastICA_sources.npy', mmap_mode = 'r')            # open them as a memmap
+                S_hist = np.split(sources_all_r2, np.cumsum([A.shape[1] for A in A_hist])[:-1])          # and get a view of the sources from each run.  
         except:
             print(f"Failed to open the results from the previous runs of FastICA.  Switching 'load_fastICA_results' to False and trying to continue anyway.  ")
             load_fastICA_results = False
     if not load_fastICA_results:
        print(f"No results were found for the multiple ICA runs, so these will now be performed.  ")
+       if spatial and sica_tica == 'sica' and not sources_as_coefficients:                                   # sources are images, so are written to a single array as each run converges
+           if sources_on_disk:
+               sources_path = out_folder / 'FastICA_sources.npy'
+           else:
+               sources_path = None
+           sources_all = sources_store(n_comp * (n_converge_bootstrapping + n_converge_no_bootstrapping), X_mc.shape[1], sources_path, sources_dtype)
+       else:
+           sources_all = None
        S_hist, A_hist = perform_multiple_ICA_runs(n_comp, X_mc, bootstrapping_param, ica_param,
-                                                  x_white, PC_dewhiten_mat, ica_verbose) 
+                                                  x_white, PC_dewhiten_mat, ica_verbose, n_jobs, 
+                                                  sources_as_coefficients = sources_as_coefficients, whiten_matrix = PC_whiten_mat,
+                                                  sources_store = sources_all, minibatch_param = minibatch_param) 
+       if sources_all is not None:
+           sources_all_r2 = sources_all.sources_r2
        with open(out_folder / 'FastICA_results.pkl', 'wb') as f:
-            pickle.dump(S_hist, f)
+            if sources_on_disk:
+                pickle.dump(None, f)                                                                     # the sources are already in FastICA_sources.npy
+            else:
+                pickle.dump(S_hist, f)
             pickle.dump(A_hist, f)
          
     if spatial:                                                                                                                        # if we have spatial data, it's worth checking that at this point (after we may have loaded sources) they are still the correct size.  
@@ -381,7 +570,12 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
         elif sica_tica == 'tica':
             n_pixels_loaded = A_hist[0].shape[0]                                                                # but if it's temporal, the ifgs are column vectors in A (ie. what would be hte time courses for sica)
         
-        if n_pixels_loaded != np.sum(1-spatial_data['mask']):
+        if sources_as_coefficients:                                                                             # but if the sources are coefficients, they should be the same length as the number of mixtures
+            if n_pixels_loaded != X_mc.shape[0]:
+                raise Exception(f"The ICASAR sources that have been loaded are made from {n_pixels_loaded} mixtures, but there are {X_mc.shape[0]} "
+                                f"mixtures in the current data.  This normally happens when the FastICA results that are being loaded are from a "
+                                f"different set of data, or weren't stored as coefficients (see 'sources_as_coefficients').  Exiting.  ")
+        elif n_pixels_loaded != np.sum(1-spatial_data['mask']):
             raise Exception(f"There are {S_hist[0].shape[1]} pixels in the ICASAR sources that have been loaded, but"
                             f" {np.sum(1-spatial_data['mask'])} pixels in the current mask.  This normally happens when the"
                             f" FastICA results that are being loaded are from a different set of data.  If not, something "
@@ -390,8 +584,13 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
     
     # 3: Convert the sources from lists from each run to a single matrix.  
     if spatial:
-        if sica_tica == 'sica':                                                               # if its spatial dat and sica, sources are images
-            sources_all_r2, sources_all_r3 = sources_list_to_r2_r3(S_hist, mask)                            # convert to more useful format.  r2 one is (n_components x n_runs) x n_pixels, r3 one is (n_components x n_runs) x ny x nx, and a masked array
+        if sica_tica == 'sica' and sources_as_coefficients:                                   # if the sources are coefficients, they're only made into images when needed
+            sources_all_r2, _ = sources_list_to_r2_r3(S_hist)                                               # (n_components x n_runs) x n_ifgs
+            sources_all_r3 = lazy_sources_r3(sources_all_r2, mask, X_mc)                                     # behaves like a rank 3 array of all the sources, but only makes one when it's indexed.  
+        elif sica_tica == 'sica':                                                             # if its spatial dat and sica, sources are images
+            if sources_all_r2 is None:                                                                      # if they're not already in a single array (i.e. loaded from the .pkl)
+                sources_all_r2, _ = sources_list_to_r2_r3(S_hist)                                           # (n_components x n_runs) x n_pixels
+            sources_all_r3 = lazy_sources_r3(sources_all_r2, mask)                                          # behaves like a rank 3 array of all the sources (n_components x n_runs) x ny x nx, but only makes one when it's indexed.  
         elif sica_tica == 'tica':
             sources_all_r2 = S_hist[0]                                                                      # get the sources recovered by the first run
             for S_hist_one in S_hist[1:]:                                                                   # and then loop through the rest
@@ -403,7 +602,16 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
                         
        
     # 4: Do clustering and 2d manifold representation, plus get centrotypes of clusters, and make an interactive plot.   
-    S_ica, labels_hdbscan, xy_tsne, clusters_by_max_Iq_no_noise, Iq  = bootstrapped_sources_to_centrotypes(sources_all_r2, hdbscan_param, tsne_param)        # do the clustering and project to a 2d plane.  clusters_by_max_Iq_no_noise is an array of which cluster number is best (ie has the highest Iq)
+    if sources_as_coefficients:
+        S_ica, labels_hdbscan, xy_tsne, clusters_by_max_Iq_no_noise, Iq  = bootstrapped_sources_to_centrotypes(sources_all_r2, hdbscan_param, tsne_param, mixtures_mc = X_mc,   # as above, but the sources are coefficients of X_mc (and only the centrotypes are made)
+                                                                                                               dtype = sources_dtype, knn_param = knn_param, 
+                                                                                                               tsne_mode = tsne_mode, tsne_cache = out_folder / 'TSNE_xy.npy', tsne_method = tsne_method)
+    else:
+        S_ica, labels_hdbscan, xy_tsne, clusters_by_max_Iq_no_noise, Iq  = bootstrapped_sources_to_centrotypes(sources_all_r2, hdbscan_param, tsne_param,        # do the clustering and project to a 2d plane.  clusters_by_max_Iq_no_noise is an array of which cluster number is best (ie has the highest Iq)
+                                                                                                               memory_budget = memory_budget, dtype = sources_dtype, knn_param = knn_param,   # sources are read in blocks, so can be on disk.  
+                                                                                                               tsne_mode = tsne_mode, tsne_cache = out_folder / 'TSNE_xy.npy', tsne_method = tsne_method)
+    if S_ica is not None:
+        S_ica = np.asarray(S_ica, dtype = dtype)                                                     # centrotypes are float64, or made from float64 coefficients.  
     Iq_sorted = np.sort(Iq)[::-1]               
     n_clusters = S_ica.shape[0]                                                                     # the number of sources/centrotypes is equal to the number of clusters    
     labels_colours = prepare_point_colours_for_2d(labels_hdbscan, clusters_by_max_Iq_no_noise)                                                                # make a list of colours so that each point with the same label has the same colour, and all noise points are grey
@@ -415,35 +623,41 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
                       'xlabel' : 'TSNE dimension 1',
                       'ylabel' : 'TSNE dimension 2'}
         
-    if spatial:
-        if sica_tica == 'sica':
-            plot_2d_labels['title']
-            spatial_data_S_all = {'images_r3' : sources_all_r3}                                                                                            # spatial data stored in rank 3 format (ie n_imaces x height x width)
-            plot_2d_interactive_fig(xy_tsne.T, colours = labels_colours, spatial_data = spatial_data_S_all,                                                # make the 2d interactive plot
+    if fig_kwargs['figures'] != "none":
+        if not isinstance(xy_tsne, np.ndarray):
+            xy_tsne = xy_tsne.embedding()                                                                                                                     # the 2d manifold may not have been computed yet (see tsne_mode), but is needed now.  
+        if spatial:
+            if sica_tica == 'sica':
+                plot_2d_labels['title']
+                spatial_data_S_all = {'images_r3' : sources_all_r3}                                                                                            # spatial data stored in rank 3 format (ie n_imaces x height x width)
+                plot_2d_interactive_fig(xy_tsne.T, colours = labels_colours, spatial_data = spatial_data_S_all,                                                # make the 2d interactive plot
+                                        labels = plot_2d_labels, legend = legend_dict, markers = marker_dict, inset_axes_side = inset_axes_side,
+                                        fig_filename = plot_2d_labels['title'], **fig_kwargs)
+            elif sica_tica == 'tica':
+                temporal_data_S_all = {'tcs_r2' : sources_all_r2,
+                                       'xvals'  : np.cumsum(ifgs_dc.t_baselines) }                                                                               # make a dictionary of the sources recovered from each run
+                plot_2d_interactive_fig(xy_tsne.T, colours = labels_colours, temporal_data = temporal_data_S_all,                                        # make the 2d interactive plot
                                     labels = plot_2d_labels, legend = legend_dict, markers = marker_dict, inset_axes_side = inset_axes_side,
                                     fig_filename = plot_2d_labels['title'], **fig_kwargs)
-        elif sica_tica == 'tica':
+        else:
             temporal_data_S_all = {'tcs_r2' : sources_all_r2,
-                                   'xvals'  : np.cumsum(ifgs_dc.t_baselines) }                                                                               # make a dictionary of the sources recovered from each run
+                                   'xvals'  : temporal_data['xvals'] }                                                                               # make a dictionary of the sources recovered from each run
             plot_2d_interactive_fig(xy_tsne.T, colours = labels_colours, temporal_data = temporal_data_S_all,                                        # make the 2d interactive plot
-                                labels = plot_2d_labels, legend = legend_dict, markers = marker_dict, inset_axes_side = inset_axes_side,
-                                fig_filename = plot_2d_labels['title'], **fig_kwargs)
-    else:
-        temporal_data_S_all = {'tcs_r2' : sources_all_r2,
-                               'xvals'  : temporal_data['xvals'] }                                                                               # make a dictionary of the sources recovered from each run
-        plot_2d_interactive_fig(xy_tsne.T, colours = labels_colours, temporal_data = temporal_data_S_all,                                        # make the 2d interactive plot
-                                labels = plot_2d_labels, legend = legend_dict, markers = marker_dict, inset_axes_side = inset_axes_side,
-                                fig_filename = plot_2d_labels['title'], **fig_kwargs)
+                                    labels = plot_2d_labels, legend = legend_dict, markers = marker_dict, inset_axes_side = inset_axes_side,
+                                    fig_filename = plot_2d_labels['title'], **fig_kwargs)
 
 
 
     # 5: Make time courses using centrotypes (i.e. S_ica, the spatial patterns found by ICA), or viceversa if tICA 
     if spatial: 
         if sica_tica == 'sica':
-            inversion_results = bss_components_inversion(S_ica, [ifgs_dc.mixtures_mc_space, ifgs_all.mixtures_mc_space])                                           # invert to fit the incremetal ifgs and all ifgs using spatial patterns (that are in Sica)
+            if fig_kwargs['figures'] != "none":
+                inversion_results = bss_components_inversion(S_ica, [ifgs_dc.mixtures_mc_space, ifgs_all.mixtures_mc_space], return_model = False)                 # invert to fit the incremetal ifgs and all ifgs using spatial patterns (that are in Sica)
+                A_ica_all = inversion_results[1]['tcs'].T                                                                                                          # time courses to fit all possible interferograms.                                   
+            else:
+                inversion_results = bss_components_inversion(S_ica, [ifgs_dc.mixtures_mc_space], return_model = False)                                             # the time courses for all ifgs are only used in the figures.  
             source_residuals = inversion_results[0]['residual']                                                                                                    # also get how well each daisy chain (mean cenetered) interferogram is fit                 
             A_ica_dc = inversion_results[0]['tcs'].T                                                                                                               # in sICA, time courses are in A
-            A_ica_all = inversion_results[1]['tcs'].T                                                                                                              # time courses to fit all possible interferograms.                                   
             if fig_kwargs['figures'] != "none":                
                 dem_to_sources_comparisons, tcs_to_tempbaselines_comparisons =   two_spatial_signals_plot(S_ica, spatial_data['mask'], spatial_data['dem'], 
                                                                                                           A_ica_dc, A_ica_all, ifgs_dc.t_baselines, ifgs_all.t_baselines,
@@ -452,7 +666,7 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
             S_ica_cum = S_ica                                                                                                                                     # if temporal, sources are time courses, and are for the cumulative ifgs (as the transpose of these was given to the ICA function)
             S_ica_dc = np.diff(S_ica_cum, axis = 1, prepend = 0)                                                                                                  # the diff of the cumluative time courses is the incremnetal (daisy chain) time course.  Prepend a 0 to make it thesame size as the original diays chain (ie. the capture the difference between 0 and first value).  
             del S_ica           
-            inversion_results = bss_components_inversion(S_ica_cum, [ifgs_cum.mixtures_mc_time.T])                                                                # inversion to fit the time series for each pixel (why it's the transpose), using the sources which are time courses (as its tICA)
+            inversion_results = bss_components_inversion(S_ica_cum, [ifgs_cum.mixtures_mc_time.T], return_model = False)                                          # inversion to fit the time series for each pixel (why it's the transpose), using the sources which are time courses (as its tICA)
             A_ica = inversion_results[0]['tcs']                                                                                                                   # in tICA, spatial sources are row vectors.  
             source_residuals = inversion_results[0]['residual']                                                                                                   # how well the cumulative time courses are fit?  Not clear.  
             if fig_kwargs['figures'] != "none":
@@ -461,7 +675,7 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
                                                                                                         "03_ICA_sources", spatial_data['ifg_dates_dc'], fig_kwargs)                    
 
     else:
-        inversion_results = bss_components_inversion(S_ica, [X_mc])                                                 # invert to fit the mean centered mixture.    
+        inversion_results = bss_components_inversion(S_ica, [X_mc], return_model = False)                           # invert to fit the mean centered mixture.    
         source_residuals = inversion_results[0]['residual']                                                         # how well we fit those
         A_ica = inversion_results[0]['tcs'].T                                                                       # and the time coruses to remake them.                  
         plot_temporal_signals(S_ica, '04_ICASAR_sources', **fig_kwargs)
@@ -509,9 +723,15 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
         plt.switch_backend('Qt5Agg')
 
     # 9: Save the results: 
+    if isinstance(xy_tsne, np.ndarray):
+        xy_tsne_save = xy_tsne
+    else:
+        xy_tsne_save = None                                                                                  # not computed yet (see tsne_mode), but is saved to out_folder when it is (see lazy_tsne).  
     S_all_info = {'sources' : sources_all_r2,                                                                # package into a dict to return
                   'labels' : labels_hdbscan,
                   'xy' : xy_tsne       }
+    if sources_as_coefficients:
+        S_all_info['mixtures_mc'] = X_mc                                                                     # sources are coefficients, so these are needed to make them.  
     print('Saving the key results as a .pkl file... ', end = '')                                            # note that we don't save S_all_info as it's a huge file.  
     if spatial:
         with open(out_folder / 'ICASAR_results.pkl', 'wb') as f:
@@ -528,7 +748,7 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
             pickle.dump(source_residuals, f)
             pickle.dump(Iq_sorted, f)
             pickle.dump(n_clusters, f)
-            pickle.dump(xy_tsne, f)
+            pickle.dump(xy_tsne_save, f)
             pickle.dump(labels_hdbscan, f)
             if label_sources:
                 pickle.dump(label_sources_output, f)
@@ -553,7 +773,7 @@ def ICASAR(n_comp, spatial_data = None, temporal_data = None, figures = "window"
             pickle.dump(source_residuals, f)
             pickle.dump(Iq_sorted, f)
             pickle.dump(n_clusters, f)
-            pickle.dump(xy_tsne, f)
+            pickle.dump(xy_tsne_save, f)
             pickle.dump(labels_hdbscan, f)
         f.close()
         print("Done!")
@@ -578,7 +798,7 @@ def LiCSBAS_to_ICASAR(LiCSBAS_out_folder, filtered = False, figures = False, n_c
         figures | boolean | if True, make figures
         n_cols  | int | number of columns for figures.  May want to lower if plotting a long time series
         crop_pixels | tuple | coords to crop images to.  x start x stop y start y stop , 00 is top left.  e.g. (10, 500, 600, 900).  
-                                x_start, x_stop, y_start, y_stop, No checking that inputted values make sense.  
+                                x_start, x_stop, y_start, y_stop.  Values beyond the edges of the images are clipped, but the cropped region must contain some pixels.  
                                 Note, generally better to have cropped (cliped in LiCSBAS language) to the correct area in LiCSBAS_for_LiCSAlert
         return_r3 | boolean | if True, the rank 3 data is also returns (n_ifgs x height x width).  Not used by ICASAR, so default is False
         ref_area | boolean | If True, the reference area (in pixels, x then y) used by LiCSBAS is returned to the user.  
@@ -610,6 +830,9 @@ def LiCSBAS_to_ICASAR(LiCSBAS_out_folder, filtered = False, figures = False, n_c
     2021_11_15 | MEG | Use LiCSBAS reference pixel/area information to reference time series.  
     2021_11_17 | MEG | Add funtcionality to work with LiCSBAS bytes/string issue in reference area.  
     2022_02_02 | MEG | Iimprove masking, and add option to use the LiCSbas mask (i.e. pixels licsbas deems are incohere/poorly unwrapped etc.  )
+    2026_10_18 | AG | Only read the pixels in crop_pixels (from the h5 file and the images), and read the h5 file a few acquisitions at a time, 
+                       referencing each as it's read.  The rank 3 arrays are only made if return_r3.  
+    2026_10_18 | AG | Check that crop_pixels contains some pixels, and mask the figure of the cropped region with the mask of the whole frame.  
     """
 
     import h5py as h5
@@ -623,43 +846,10 @@ def LiCSBAS_to_ICASAR(LiCSBAS_out_folder, filtered = False, figures = False, n_c
     import pdb
     
     from icasar.aux2 import add_square_plot
-    from icasar.aux1 import col_to_ma
+    from icasar.aux1 import mask_pixels
     
     
 
-    def rank3_ma_to_rank2(ifgs_r3, consistent_mask = False):
-        """A function to take a time series of interferograms stored as a rank 3 array,
-        and convert it into the ICA(SAR) friendly format of a rank 2 array with ifgs as
-        row vectors, and an associated mask.
-
-        For use with ICA, the mask must be consistent (ie the same pixels are masked throughout the time series).
-
-        Inputs:
-            ifgs_r3 | r3 masked array | ifgs in rank 3 format
-            consistent_mask | boolean | If True, areas of incoherence are consistent through the whole stack
-                                        If false, a consistent mask will be made.  N.b. this step can remove the number of pixels dramatically.
-        """
-
-        n_ifgs = ifgs_r3.shape[0]
-        # 1: Deal with masking
-        mask_coh_water = ifgs_r3.mask                                                                                               #get the mask as a rank 3, still boolean
-        if consistent_mask:
-            mask_coh_water_consistent = mask_coh_water[0,]                                                                          # if all ifgs are masked in the same way, just grab the first one
-        else:
-            mask_coh_water_sum = np.sum(mask_coh_water, axis = 0)                                                                   # sum to make an image that shows in how many ifgs each pixel is incoherent
-            mask_coh_water_consistent = np.where(mask_coh_water_sum == 0, np.zeros(mask_coh_water_sum.shape),
-                                                                          np.ones(mask_coh_water_sum.shape)).astype(bool)           # make a mask of pixels that are never incoherent
-        ifgs_r3_consistent = ma.array(ifgs_r3, mask = ma.repeat(mask_coh_water_consistent[np.newaxis,], n_ifgs, axis = 0))          # mask with the new consistent mask
-
-        # 2: Convert from rank 3 to rank 2
-        n_pixs = ma.compressed(ifgs_r3_consistent[0,]).shape[0]                                                        # number of non-masked pixels
-        ifgs_r2 = np.zeros((n_ifgs, n_pixs))
-        for ifg_n, ifg in enumerate(ifgs_r3_consistent):
-            ifgs_r2[ifg_n,:] = ma.compressed(ifg)
-
-        return ifgs_r2, mask_coh_water_consistent
-
-
     def ts_quick_plot(ifgs_r3, title):
         """
         A quick function to plot a rank 3 array of ifgs.
@@ -714,13 +904,12 @@ def LiCSBAS_to_ICASAR(LiCSBAS_out_folder, filtered = False, figures = False, n_c
             baselines.append(-1 *(master - slave).days)    
         return baselines
     
-    def create_lon_lat_meshgrids(corner_lon, corner_lat, post_lon, post_lat, ifg):
-        """ Return a mesh grid of the longitudes and latitues for each pixels.  Not tested!
+    def create_lon_lat_meshgrids(corner_lon, corner_lat, post_lon, post_lat, window):
+        """ Return a mesh grid of the longitudes and latitues for each pixels in the window (slices in y and x) of the images.  Not tested!
         I think Corner is the top left, but not sure this is always the case
         """
-        ny, nx = ifg.shape
-        x = corner_lon +  (post_lon * np.arange(nx))
-        y = corner_lat +  (post_lat * np.arange(ny))
+        x = corner_lon +  (post_lon * np.arange(window[1].start, window[1].stop))
+        y = corner_lat +  (post_lat * np.arange(window[0].start, window[0].stop))
         xx, yy = np.meshgrid(x,y)
         geocode_info = {'lons_mg' : xx,
                         'lats_mg' : yy}
@@ -742,15 +931,19 @@ def LiCSBAS_to_ICASAR(LiCSBAS_out_folder, filtered = False, figures = False, n_c
         return value
     
         
-    def read_img(file, length, width, dtype=np.float32, endian='little'):
+    def read_img(file, length, width, window = None, dtype=np.float32, endian='little'):
         """
         Read image data into numpy array.
+        window: slices in y and x of the pixels to read, or None to read them all.  
         endian: 'little' or 'big' (not 'little' is regarded as 'big')
         """
+        data = np.memmap(file, dtype=dtype, mode = 'r', shape = (length, width))                 # nothing is read until it is indexed
+        if window is not None:
+            data = data[window]
         if endian == 'little':
-            data = np.fromfile(file, dtype=dtype).reshape((length, width))
+            data = np.array(data)
         else:
-            data = np.fromfile(file, dtype=dtype).byteswap().reshape((length, width))
+            data = np.array(data).byteswap()
         return data
 
     # -1: Check for common argument errors:
@@ -793,8 +986,8 @@ def LiCSBAS_to_ICASAR(LiCSBAS_out_folder, filtered = False, figures = False, n_c
     else:
         cumh5 = h5.File(LiCSBAS_out_folder / LiCSBAS_folders['TS_'] / 'cum.h5' ,'r')                            # or the non filtered file from LiCSBAS
     tbaseline_info["acq_dates"] = cumh5['imdates'][()].astype(str).tolist()                                     # get the acquisition dates
-    cumulative = cumh5['cum'][()]                                                                               # get cumulative displacements as a rank3 numpy array
-    cumulative *= 0.001                                                                                         # LiCSBAS default is mm, convert to m
+    cum_dataset = cumh5['cum']                                                                                  # cumulative displacements, but not read yet (so that only the pixels in crop_pixels are read)
+    n_acq = cum_dataset.shape[0]
 
 
     # 2: Open the parameter file to get the number of pixels in width and height (though this should agree with above)   
@@ -803,7 +996,19 @@ def LiCSBAS_to_ICASAR(LiCSBAS_out_folder, filtered = False, figures = False, n_c
         length = int(get_param_par(LiCSBAS_out_folder / LiCSBAS_folders['ifgs'] / 'slc.mli.par', 'azimuth_lines'))
     except:
         print(f"Failed to open the 'slc.mli.par' file, so taking the width and length of the image from the h5 file and trying to continue.  ")
-        (_, length, width) = cumulative.shape
+        (_, length, width) = cum_dataset.shape
+        
+    if crop_pixels is not None:
+        print(f"Cropping the images in x from {crop_pixels[0]} to {crop_pixels[1]} "
+              f"and in y from {crop_pixels[2]} to {crop_pixels[3]} (NB matrix notation - 0,0 is top left).  ")
+        window = (slice(*slice(crop_pixels[2], crop_pixels[3]).indices(length)),                                # the pixels to read, y then x.  As with slicing an array, values beyond the edges are clipped.  
+                  slice(*slice(crop_pixels[0], crop_pixels[1]).indices(width)))
+        if (window[0].stop <= window[0].start) or (window[1].stop <= window[1].start):
+            raise Exception("'crop_pixels' (x_start, x_stop, y_start, y_stop) must have starts that are less than the stops, and be at least partly within the "
+                            f"images (which are {width} pixels wide and {length} pixels long), but it is {crop_pixels}, so no pixels are in the cropped region.  Exiting.  ")
+    else:
+        window = (slice(0, length), slice(0, width))
+    
 
     # 3: Reference the time series
     ref_str = cumh5['refarea'][()] 
@@ -816,115 +1021,113 @@ def LiCSBAS_to_ICASAR(LiCSBAS_out_folder, filtered = False, figures = False, n_c
               'y_stop' : int(ref_str.split('/')[1].split(':')[1])}
     
     try:                                                                                                                                                             # reference the time series
-        ifg_offsets = np.nanmean(cumulative[:, ref_xy['y_start']: ref_xy['y_stop'], ref_xy['x_start']: ref_xy['x_stop']], axis = (1,2))                              # get the offset between the reference pixel/area and 0 for each time
-        cumulative = cumulative - np.repeat(np.repeat(ifg_offsets[:,np.newaxis, np.newaxis], cumulative.shape[1],  axis = 1), cumulative.shape[2], axis = 2)         # do the correction (first make ifg_offsets teh same size as cumulative).      
+        cumulative_ref_area = cum_dataset[:, ref_xy['y_start']: ref_xy['y_stop'], ref_xy['x_start']: ref_xy['x_stop']]                                              # only read the reference area (which might not be in the window)
+        cumulative_ref_area *= 0.001                                                                                                                                 # LiCSBAS default is mm, convert to m
+        ifg_offsets = np.nanmean(cumulative_ref_area, axis = (1,2))                                                                                                  # get the offset between the reference pixel/area and 0 for each time
         print(f"Succesfully referenced the LiCSBAS time series using the pixel/area selected by LiCSBAS.  ")
     except:
+        ifg_offsets = None
         print(f"Failed to reference the LiCSBAS time series - use with caution!  ")
     
     
-    #3: Open the mask and the DEM
-    mask_licsbas = read_img(LiCSBAS_out_folder / LiCSBAS_folders['TS_'] / 'results' /  'mask', length, width)                   # this is 1 for coherenct pixels, 0 for non-coherent/water, and masked for water
-    mask_licsbas = np.logical_and(mask_licsbas, np.invert(np.isnan(mask_licsbas)))                                          # add any nans to the mask (nans become 0)
-    mask_licsbas = np.invert(mask_licsbas)                                                                              # invert so that land is 0 (not masked), and water and incoherent are 1 (masked)
-    
-    dem = read_img(LiCSBAS_out_folder / LiCSBAS_folders['ifgs'] / 'hgt', length, width)
-    mask_dem = np.isnan(dem)
+    # 4: Read the cumulative displacements in the window, a few acquisitions at a time.  
+    cumulative = np.empty((n_acq, window[0].stop - window[0].start, window[1].stop - window[1].start), dtype = cum_dataset.dtype)
+    mask_cum = np.zeros(cumulative.shape[1:], dtype = bool)
+    n_acq_read = max(1, int(2**26 // max(1, cumulative[0].nbytes)))                                          # number of acquisitions to read at once (so ~64MB)
+    for acq_start in range(0, n_acq, n_acq_read):
+        acqs = slice(acq_start, min(acq_start + n_acq_read, n_acq))
+        cum_dataset.read_direct(cumulative, source_sel = np.s_[acqs, window[0], window[1]], dest_sel = np.s_[acqs])     # read only the window (a hyperslab) straight into cumulative
+        cumulative[acqs] *= 0.001                                                                               # LiCSBAS default is mm, convert to m
+        if ifg_offsets is not None:
+            cumulative[acqs] -= ifg_offsets[acqs, np.newaxis, np.newaxis]                                        # do the referencing (the offsets are broadcast to the size of the images)
+        mask_cum = np.logical_or(mask_cum, np.any(np.isnan(cumulative[acqs]), axis = 0))                        # if ever nan then must be masked at some point so mask.  
     
-    mask_cum = np.isnan(cumulative)                                                                       # get where masked
-    mask_cum = (np.sum(mask_cum, axis = 0) > 0)                                                             # sum all the pixels in time (dim 0), and if ever bigger than 0 then must be masked at some point so mask.  
     
-    if mask_type == 'dem':
-        mask = np.logical_or(mask_dem, mask_cum)                                                        # if dem, mask water (from DEM), and anything that's nan in cumulative (mask_cum)
-    elif mask_type == 'licsbas':
-        mask = np.logical_or(mask_licsbas, np.logical_or(mask_dem, mask_cum))
+    #5: Open the mask and the DEM
+    def make_mask(window, mask_cum):
+        """ The mask of the pixels in window (see mask_type), given the pixels that are ever nan in the cumulative displacements (mask_cum).  
+        """
+        mask_licsbas = read_img(LiCSBAS_out_folder / LiCSBAS_folders['TS_'] / 'results' /  'mask', length, width, window)           # this is 1 for coherenct pixels, 0 for non-coherent/water, and masked for water
+        mask_licsbas = np.logical_and(mask_licsbas, np.invert(np.isnan(mask_licsbas)))                                          # add any nans to the mask (nans become 0)
+        mask_licsbas = np.invert(mask_licsbas)                                                                              # invert so that land is 0 (not masked), and water and incoherent are 1 (masked)
+        mask_dem = np.isnan(read_img(LiCSBAS_out_folder / LiCSBAS_folders['ifgs'] / 'hgt', length, width, window))
+        if mask_type == 'dem':
+            mask = np.logical_or(mask_dem, mask_cum)                                                    # if dem, mask water (from DEM), and anything that's nan in cumulative (mask_cum)
+        elif mask_type == 'licsbas':
+            mask = np.logical_or(mask_licsbas, np.logical_or(mask_dem, mask_cum))
+        return mask
+    
+    dem = read_img(LiCSBAS_out_folder / LiCSBAS_folders['ifgs'] / 'hgt', length, width, window)
+    mask = make_mask(window, mask_cum)
         
-    mask_r3 = np.repeat(mask[np.newaxis,], cumulative.shape[0], 0)
     dem_ma = ma.array(dem, mask = mask)
     displacement_r2['dem'] = dem_ma                                                                      # and added to the displacement dict in the same was as the lons and lats
     displacement_r3['dem'] = dem_ma                                                                      # 
     
     
-    # 3: Mask the data  
-    displacement_r3["cumulative"] = ma.array(cumulative, mask=mask_r3)                                   # rank 3 masked array of the cumulative displacement
-    displacement_r3["incremental"] = np.diff(displacement_r3['cumulative'], axis = 0)                           # displacement between each acquisition - ie incremental
-    if displacement_r3["incremental"].mask.shape == ():                                                         # in the case where no pixels are masked, the diff operation on the mask collapses it to nothing.  
-        displacement_r3["incremental"].mask = mask_r3[1:]                                                # in which case, we can recreate the mask from the rank3 mask, but dropping one from the first dimension as incremental is always one smaller than cumulative.  
-    n_im, length, width = displacement_r3["cumulative"].shape                                   
+    # 6: Mask the data  
+    pixels = mask_pixels(mask)
+    displacement_r2['cumulative'] = np.zeros((n_acq, pixels.n_pixels))                                  # row vectors of the pixels that aren't masked
+    displacement_r2['mask'] = np.copy(mask)
+    displacement_r2['incremental'] = np.zeros((n_acq - 1, pixels.n_pixels))                              # displacement between each acquisition - ie incremental
+    for acq_start in range(0, n_acq, n_acq_read):                                                       # a few acquisitions at a time, so that there are no copies of all of cumulative
+        acq_stop = min(acq_start + n_acq_read, n_acq)
+        displacement_r2['cumulative'][acq_start : acq_stop] = pixels.gather(cumulative[acq_start : acq_stop])
+        displacement_r2['incremental'][acq_start : acq_stop - 1] = pixels.gather(np.diff(cumulative[acq_start : acq_stop], axis = 0))      # differences in the precision of the h5 file
+        if acq_start > 0:
+            displacement_r2['incremental'][acq_start - 1] = pixels.gather(cumulative[acq_start] - cumulative[acq_start - 1])                # the one between this and the previous read
+    
+    if return_r3:
+        mask_r3 = np.repeat(mask[np.newaxis,], n_acq, 0)
+        displacement_r3["cumulative"] = ma.array(cumulative, mask=mask_r3)                                   # rank 3 masked array of the cumulative displacement
+        displacement_r3["incremental"] = np.diff(displacement_r3['cumulative'], axis = 0)                           # displacement between each acquisition - ie incremental
+        if displacement_r3["incremental"].mask.shape == ():                                                         # in the case where no pixels are masked, the diff operation on the mask collapses it to nothing.  
+            displacement_r3["incremental"].mask = mask_r3[1:]                                                # in which case, we can recreate the mask from the rank3 mask, but dropping one from the first dimension as incremental is always one smaller than cumulative.  
+    del cumulative
 
     # if figures:                                                 
     #     ts_quick_plot(displacement_r3["cumulative"], title = 'Cumulative displacements')
     #     ts_quick_plot(displacement_r3["incremental"], title = 'Incremental displacements')
 
-    displacement_r2['cumulative'], displacement_r2['mask'] = rank3_ma_to_rank2(displacement_r3['cumulative'])      # convert from rank 3 to rank 2 and a mask
-    displacement_r2['incremental'], _ = rank3_ma_to_rank2(displacement_r3['incremental'])                          # also convert incremental, no need to also get mask as should be same as above
-
-    # 4: work with the acquisiton dates to produces names of daisy chain ifgs, and baselines
+    # 7: work with the acquisiton dates to produces names of daisy chain ifgs, and baselines
     tbaseline_info["ifg_dates"] = daisy_chain_from_acquisitions(tbaseline_info["acq_dates"])
     tbaseline_info["baselines"] = baseline_from_names(tbaseline_info["ifg_dates"])
     tbaseline_info["baselines_cumulative"] = np.cumsum(tbaseline_info["baselines"])                                                            # cumulative baslines, e.g. 12 24 36 48 etc
     
-    # 5: get the lons and lats of each pixel in the ifgs
+    # 8: get the lons and lats of each pixel in the ifgs
     geocode_info = create_lon_lat_meshgrids(cumh5['corner_lon'][()], cumh5['corner_lat'][()], 
-                                            cumh5['post_lon'][()], cumh5['post_lat'][()], displacement_r3['incremental'][0,:,:])             # create meshgrids of the lons and lats for each pixel
+                                            cumh5['post_lon'][()], cumh5['post_lat'][()], window)                                            # create meshgrids of the lons and lats for each pixel
     displacement_r2['lons'] = geocode_info['lons_mg']                                                                                        # add to the displacement dict
     displacement_r2['lats'] = geocode_info['lats_mg']
     displacement_r3['lons'] = geocode_info['lons_mg']                                                                                        # add to the displacement dict (rank 3 one)
     displacement_r3['lats'] = geocode_info['lats_mg']
 
-    # 6: Get the E N U files (these are the components of the ground to satellite look vector in east north up directions.  )   
+    # 9: Get the E N U files (these are the components of the ground to satellite look vector in east north up directions.  )   
     try:
         for component in ['E', 'N', 'U']:
-            look_vector_component = read_img(LiCSBAS_out_folder / LiCSBAS_folders['ifgs'] / f"{component}.geo", length, width)
+            look_vector_component = read_img(LiCSBAS_out_folder / LiCSBAS_folders['ifgs'] / f"{component}.geo", length, width, window)
             displacement_r2[component] = look_vector_component
             displacement_r3[component] = look_vector_component
     except:
         print(f"Failed to open the E N U files (look vector components), but trying to continue anyway.")
         
-    if crop_pixels is not None:
-        print(f"Cropping the images in x from {crop_pixels[0]} to {crop_pixels[1]} "
-              f"and in y from {crop_pixels[2]} to {crop_pixels[3]} (NB matrix notation - 0,0 is top left).  ")
-        
-        if figures:
-            ifg_n_plot = 1                                                                                      # which number ifg to plot.  Shouldn't need to change.  
-            title = f'Cropped region, ifg {ifg_n_plot}'
-            fig_crop, ax = plt.subplots()
-            fig_crop.canvas.manager.set_window_title(title)
-            ax.set_title(title)
-            ax.matshow(col_to_ma(displacement_r2['incremental'][ifg_n_plot,:], displacement_r2['mask']),
-                                interpolation='none', aspect='auto')                                            # plot the uncropped ifg
-        
-        #import pdb; pdb.set_trace()
-        for product in displacement_r3:
-            if len(displacement_r3[product].shape) == 2:                                                                                  # if it's a rank 2, assume only x, y
-                resized_r2 = displacement_r3[product][crop_pixels[2]:crop_pixels[3], crop_pixels[0]:crop_pixels[1]]               # and crop
-                displacement_r2[product] = resized_r2
-                displacement_r3[product] = resized_r2
-            elif len(displacement_r3[product].shape) == 3:                                                                                # if it's a rank 3, assume times, x, y
-                resized_r3 = displacement_r3[product][:, crop_pixels[2]:crop_pixels[3], crop_pixels[0]:crop_pixels[1]]            # and crop only last two dimensions
-                displacement_r3[product] = resized_r3
-                displacement_r2[product], displacement_r2['mask'] = rank3_ma_to_rank2(resized_r3)      # convert from rank 3 to rank 2 and a mask
-            else:
-                pass
-            
-    
-
-        # for product in displacement_r3:
-        #     print(f"{product} : {displacement_r3[product].shape}")
-        
-        # import pdb; pdb.set_trace()
-        # for disp_dict in [displacement_r2, displacement_r3]:
-        #     for product in disp_dict:
-        #         if len(disp_dict[product].shape) == 2:                                                                                  # if it's a rank 2, assume only x, y
-        #             disp_dict[product] = disp_dict[product][crop_pixels[2]:crop_pixels[3], crop_pixels[0]:crop_pixels[1]]               # and crop
-        #         elif len(disp_dict[product].shape) == 3:                                                                                # if it's a rank 3, assume times, x, y
-        #             disp_dict[product] = disp_dict[product][:, crop_pixels[2]:crop_pixels[3], crop_pixels[0]:crop_pixels[1]]            # and crop only last two dimensions
-        #         else:
-        #             pass
-    
-
-        if figures:
-            add_square_plot(crop_pixels[0], crop_pixels[1], crop_pixels[2], crop_pixels[3], ax)                 # draw a box showing the cropped region    
+    if (crop_pixels is not None) and figures:
+        ifg_n_plot = 1                                                                                          # which number ifg to plot.  Shouldn't need to change.  
+        title = f'Cropped region, ifg {ifg_n_plot}'
+        fig_crop, ax = plt.subplots()
+        fig_crop.canvas.manager.set_window_title(title)
+        ax.set_title(title)
+        ifg_uncropped = 0.001 * np.diff(cum_dataset[ifg_n_plot : ifg_n_plot + 2], axis = 0)[0]                # only the two acquisitions of this ifg are read, for the whole frame
+        if ifg_offsets is not None:
+            ifg_uncropped -= (ifg_offsets[ifg_n_plot + 1] - ifg_offsets[ifg_n_plot])
+        mask_cum_uncropped = np.zeros(ifg_uncropped.shape, dtype = bool)
+        n_acq_read_uncropped = max(1, int(2**26 // max(1, ifg_uncropped.nbytes)))                               # as in 4, but for the whole frame
+        for acq_start in range(0, n_acq, n_acq_read_uncropped):
+            mask_cum_uncropped |= np.any(np.isnan(cum_dataset[acq_start : acq_start + n_acq_read_uncropped]), axis = 0)     # if ever nan then must be masked at some point so mask (as in 4)
+        mask_uncropped = make_mask(None, mask_cum_uncropped)                                                   # the same as mask, but for the whole frame
+        ax.matshow(ma.array(ifg_uncropped, mask = mask_uncropped), interpolation='none', aspect='auto')        # plot the uncropped ifg
+        add_square_plot(crop_pixels[0], crop_pixels[1], crop_pixels[2], crop_pixels[3], ax)                     # draw a box showing the cropped region    
+    cumh5.close()
   
    
 
@@ -940,124 +1143,220 @@ def LiCSBAS_to_ICASAR(LiCSBAS_out_folder, filtered = False, figures = False, n_c
             return displacement_r2, tbaseline_info
 
 #%%
-def update_mask_sources_ifgs(mask_sources, sources, mask_ifgs, ifgs):
-    """ Given two masks of pixels, create a mask of pixels that are valid for both.  Also return the two sets of data with the new masks applied.  
+class sources_projector():
+    """ Fit the time courses of new interferograms using sources that have already been found (e.g. by ICASAR), without rerunning ICASAR.  
+    For each mask of the interferograms, the sources are remasked to the pixels that are in both (using mask_update_args) and 
+    their Gram matrix is factored (see bss_inversion) only once, and these are kept for the last n_masks masks, so fitting each new 
+    interferogram only needs products with the sources.  The mean and variance of the misfit (the root mean square of the residual, so that misfits 
+    of interferograms with different masks can be compared) of all the interferograms that have been fit are updated after each set is fit (Welford's 
+    algorithm), so how unusual the misfit of a new interferogram is can be found (e.g. to detect new deformation).  Misfits that are unusual 
+    (a z_score above z_threshold) aren't added, so that new deformation doesn't raise the mean of the misfits.  Can be pickled to keep it between runs (the remasked sources aren't pickled, and are made again when needed).  
     Inputs:
-        mask_sources | boolean rank 2| original mask
-        sources  | r2 array | sources as row vectors
-        mask_ifgs | boolean rank 2| new mask
-        ifgs  | r2 array | ifgs as row vectors
-    Returns:
-        ifgs_new_mask
-        sources_new_mask
-        mask_both | boolean rank 2| original mask
+        sources | rank 2 array | n_sources x n_pixels, e.g. S_ica from ICASAR.  
+        mask | rank 2 boolean | to convert a row of sources into a rank 2 masked array (True is masked).  
+        n_masks | int | the number of masks of the interferograms to keep the remasked sources for (the least recently used are removed first).  
+        z_threshold | float | misfits with a z_score above this aren't added to the mean and variance of the misfits.  
     History:
-        2020/02/19 | MEG |  Written      
-        2020/06/26 | MEG | Major rewrite.  
-        2021_04_20 | MEG | Add check that sources and ifgs are both rank 2 (use row vectors if only one source, but it must be rank2 and not rank 1)
+        2026_10_18 | AG | Written
+        2026_10_18 | AG | Remask with mask_update_args, rather than update_mask_sources_ifgs of an arange of the pixels.  
+        2026_10_18 | AG | Only keep the remasked sources for the last n_masks masks, don't pickle them, and don't divide by a standard deviation of 0.  
+        2026_10_18 | AG | Score all the interferograms in a set against the misfits from before it, use the root mean square of the residual, and add z_threshold.  
     """
-    import numpy as np
-    import numpy.ma as ma
-    from icasar.aux1 import col_to_ma
-
+    def __init__(self, sources, mask, n_masks = 4, z_threshold = 5.):
+        self.sources = sources
+        self.mask = mask
+        self.n_masks = n_masks
+        self.z_threshold = z_threshold
+        self.inversions = {}                                                                        # for each mask of the interferograms, the arguments of the interferogram pixels to use and a bss_inversion
+        self.n_ifgs = 0                                                                             # number of interferograms that have been fit, and the mean and sum of squared differences from the mean of their misfits (root mean square residuals)
+        self.l2_norm_mean = 0.
+        self.l2_norm_m2 = 0.
         
+    def inversion_for_mask(self, mask_ifgs):
+        """ The arguments of the pixels of the interferograms that are also in the sources, and a bss_inversion of the sources for just these pixels.  
+        Only computed the first time that each mask is used (or if it hasn't been used in the last n_masks masks).  
+        """
+        import numpy as np
+        from icasar.aux1 import bss_inversion
+        from icasar.aux2 import mask_update_args
+        if mask_ifgs is None:
+            mask_ifgs = self.mask
+        key = (mask_ifgs.shape, np.packbits(mask_ifgs).tobytes())
+        if key in self.inversions:
+            self.inversions[key] = self.inversions.pop(key)                                       # move it to the end, as it's now the most recently used
+        else:
+            if len(self.inversions) >= self.n_masks:
+                del self.inversions[next(iter(self.inversions))]                                    # remove the least recently used mask
+            if np.array_equal(mask_ifgs, self.mask):
+                ifg_args = None                                                                     # all the pixels of the interferograms are used
+                sources = self.sources
+            else:
+                ifg_args = mask_update_args(mask_ifgs, self.mask)                                  # the pixels of the interferograms that are also in the sources
+                sources = np.take(self.sources, mask_update_args(self.mask, mask_ifgs), axis = 1)  # and vice versa
+            self.inversions[key] = (ifg_args, bss_inversion(sources))
+        return self.inversions[key]
     
-    def apply_new_mask(ifgs, mask_old, mask_new):
-        """Apply a new mask to a collection of ifgs (or sources) that are stored as row vectors with an accompanying mask.  
+    def fit(self, ifgs, mask_ifgs = None, update_statistics = True):
+        """ Fit some interferograms using the sources.  
         Inputs:
-            ifgs | r2 array | ifgs as row vectors
-            mask_old | r2 array | mask to convert a row of ifg into a rank 2 masked array
-            mask_new | r2 array | the new mask to be applied.  Note that it must not unmask any pixels that are already masked.  
+            ifgs | rank 1 or 2 array | one interferogram, or several as row vectors (n_ifgs x n_pixels).  Each is mean centered before it's fit (but isn't changed).  
+            mask_ifgs | rank 2 boolean or None | the mask of the interferograms, if different to that of the sources.  
+            update_statistics | boolean | if True, the misfits of these interferograms (except those with a z_score above z_threshold) are added to the mean 
+                                          and variance of all the misfits, after all of them have been scored.  
         Returns:
-            ifgs_new_mask | r2 array | as per ifgs, but with a new mask.  
-        History:
-            2020/06/26 | MEG | Written
+            tcs | rank 2 array | n_sources x n_ifgs, the strength of each source in each interferogram.  
+            l2_norms | rank 1 array | the misfit of each interferogram (see bss_inversion).  
+            z_scores | rank 1 array | how many standard deviations the root mean square of each residual is from the mean of those of the interferograms fit 
+                                      before this call (so the order of the interferograms doesn't matter).  nan until two interferograms have been fit, or if 
+                                      their misfits are all the same.  
         """
-        n_pixs_new = len(np.argwhere(mask_new == False))                                        
-        ifgs_new_mask = np.zeros((ifgs.shape[0], n_pixs_new))                        # initiate an array to store the modified sources as row vectors    
-        for ifg_n, ifg in enumerate(ifgs):                                 # Loop through each source
-            ifg_r2 = col_to_ma(ifg, mask_old)                             # turn it from a row vector into a rank 2 masked array        
-            ifg_r2_new_mask = ma.array(ifg_r2, mask = mask_new)              # apply the new mask   
-            ifgs_new_mask[ifg_n, :] = ma.compressed(ifg_r2_new_mask)       # convert to row vector and places in rank 2 array of modified sources
-        return ifgs_new_mask
-    
-    
-    # check some inputs.  Not exhuastive!
-    if (len(sources.shape) != 2) or (len(ifgs.shape) != 2):
-        raise Exception(f"Both 'sources' and 'ifgs' must be rank 2 arrays (even if they are only a single source).  Exiting. ")
-    
-    mask_both = ~np.logical_and(~mask_sources, ~mask_ifgs)                                       # make a new mask for pixels that are in the sources AND in the current time series
-    n_pixs_sources = len(np.argwhere(mask_sources == False))                                  # masked pixels are 1s, so invert with 1- bit so that non-masked are 1s, then sum to get number of pixels
-    n_pixs_new = len(np.argwhere(mask_ifgs == False))                                          # ditto for new mask
-    n_pixs_both = len(np.argwhere(mask_both == False))                                        # ditto for the mutual mask
-    print(f"Updating masks and ICA sources.  Of the {n_pixs_sources} in the sources and {n_pixs_new} in the current LiCSBAS time series, "
-          f"{n_pixs_both} are in both and can be used in this iteration of LiCSAlert.  ")
-    
-    ifgs_new_mask = apply_new_mask(ifgs, mask_ifgs, mask_both)                                  # apply the new mask to the old ifgs and return the non-masked elemts as row vectors.  
-    sources_new_mask = apply_new_mask(sources, mask_sources, mask_both)                         # ditto for the sources.  
-    
-    return ifgs_new_mask, sources_new_mask, mask_both
+        import numpy as np
+        ifgs = np.atleast_2d(ifgs)
+        ifg_args, inversion = self.inversion_for_mask(mask_ifgs)
+        if ifg_args is not None:
+            ifgs = ifgs[:, ifg_args]
+        inversion_results = inversion.fit([ifg[np.newaxis, :] for ifg in ifgs])                    # each one is a set of interferograms, so each is mean centered separately
+        tcs = np.concatenate([inversion_result['tcs'] for inversion_result in inversion_results], axis = 1)
+        l2_norms = np.array([inversion_result['l2_norm'] for inversion_result in inversion_results])
+        rms_residuals = l2_norms * np.sqrt(ifgs.shape[1])                                          # l2_norm is divided by the number of pixels, so this doesn't depend on the mask
+        l2_norm_std = self.l2_norm_std
+        if l2_norm_std > 0:
+            z_scores = (rms_residuals - self.l2_norm_mean) / l2_norm_std                            # all against the misfits from before this set
+        else:
+            z_scores = np.full(l2_norms.shape, np.nan)                                              # not enough misfits yet (or they're all the same)
+        if update_statistics:
+            for rms_residual, z_score in zip(rms_residuals, z_scores):
+                if z_score > self.z_threshold:                                                      # e.g. new deformation, so not added (nan is added)
+                    continue
+                self.n_ifgs += 1
+                delta = rms_residual - self.l2_norm_mean
+                self.l2_norm_mean += delta / self.n_ifgs
+                self.l2_norm_m2 += delta * (rms_residual - self.l2_norm_mean)
+        return tcs, l2_norms, z_scores
+    
+    @property
+    def l2_norm_std(self):
+        """ The standard deviation of the misfits (root mean square residuals) of all the interferograms that have been fit (with update_statistics).  
+        """
+        import numpy as np
+        return np.sqrt(self.l2_norm_m2 / (self.n_ifgs - 1)) if self.n_ifgs > 1 else np.nan
     
+    def __getstate__(self):
+        """ The remasked sources (and their bss_inversions) are as large as the sources, so aren't pickled.  
+        """
+        state = self.__dict__.copy()
+        state['inversions'] = {}
+        return state
 
 
 
 
 #%%
 
-def bootstrapped_sources_to_centrotypes(sources_r2, hdbscan_param, tsne_param):
+def bootstrapped_sources_to_centrotypes(sources_r2, hdbscan_param, tsne_param, mixtures_mc = None, memory_budget = None, dtype = 'float64',
+                                        knn_param = None, tsne_mode = 'now', tsne_cache = None, tsne_method = 'barnes_hut'):
     """ Given the products of the bootstrapping, run the 2d manifold and clustering algorithms to create centrotypes.  
     Inputs:
         sources_r2      | rank 2 array | all the sources recovered after bootstrapping.  If 5 components and 100 bootstrapped runs, this will be 500 x n_pixels (or n_times)
         hdbscan_param  | tuple | Used to control the clustering (min_cluster_size, min_samples)
         tsne_param     | tuple | Used to control the 2d manifold learning  (perplexity, early_exaggeration)
+        mixtures_mc | rank 2 array or None | If provided, sources_r2 are the coefficients that make the sources from these mean centered mixtures 
+                                            (i.e. sources = sources_r2 @ mixtures_mc, see perform_multiple_ICA_runs).  Only the centrotypes are then made.
+        memory_budget | float or None | If provided, sources_r2 is read in blocks of about this many bytes (see pairwise_comparison).  Only the 
+                                        centrotypes are then read in full, so sources_r2 can be on disk (e.g. a numpy memmap).  
+        dtype | string | 'float64' or 'float32'.  The precision the similarities (and distances) between the sources are computed in.  
+        knn_param | tuple or None | If None, the similarities between all the sources are used.  If a tuple, (n_neighbours, 'exact' or 'approximate'), 
+                                    and only the similarities between each source and its n_neighbours most similar sources are used (see knn_similarity_graph).  
+                                    HDBSCAN, the 2d manifold, and Iq then all work with this sparse graph (missing similarities are treated as 0), so can be used 
+                                    with many more sources.  n_neighbours is increased if HDBSCAN (min_samples) or TSNE (3 x perplexity + 2) need more.  
+        tsne_mode | string | 'now', 'lazy' or 'background'.  If 'now', the 2d manifold is computed before returning.  If 'lazy', xy_tsne is instead a lazy_tsne, 
+                             which only computes it when its embedding method is called (and the distances are computed again then).  If 'background', 
+                             xy_tsne is also a lazy_tsne, but it starts computing it in a background thread straight away (using a copy of the distances).  
+        tsne_cache | Path or None | If provided and tsne_mode isn't 'now', the 2d manifold is saved to a .npy file named from this (see lazy_tsne) once it has been computed.  
+        tsne_method | string | 'barnes_hut', 'barnes_hut_knn', 'fft', or 'umap'.  How the 2d manifold is computed, see tsne_embedding.  The methods other than 
+                               'barnes_hut' only use the distances to each source's nearest neighbours (or the sparse graph from knn_param), so are faster.  
     Returns:
         S_best | rank 2 array | the recovered sources as row vectors (e.g. 5 x 1230)
         labels_hdbscan | rank 2 array | the cluster number for each of the sources in sources_all_r2 e.g 1000,
-        xy_tsne | rank 2 array | the x and y coordinates of where each space is in the 2D space.  e.g. 1000x2
+        xy_tsne | rank 2 array or lazy_tsne | the x and y coordinates of where each space is in the 2D space.  e.g. 1000x2.  See tsne_mode.  
         clusters_by_max_Iq_no_noise | rank 1 array | clusters ranked by quality index (Iq).  e.g. 3,0,1,4,2
         Iq | list | cluster quality index for each cluster.  Entry 0 is Iq (cluster quality index) for the first cluster
 
     History:
         2020/08/26 | MEG | Created from a script.  
         2021_04_16 | MEG | Remove unused figure arguments.  
+        2026_10_18 | AG | Add mixtures_mc, for sources stored as coefficients of the mixtures (their similarities then come from the Gram matrix of the mixtures).  
+        2026_10_18 | AG | Add memory_budget, so that the sources are read in blocks of pixels (e.g. from a memmap).  
+        2026_10_18 | AG | Keep only one n_sources x n_sources matrix (similarities or distances), and add dtype option.  
+        2026_10_18 | AG | Add knn_param (see knn_similarity_graph).  
+        2026_10_18 | AG | Find the centrotypes from the sums computed by cluster_similarity_sums, rather than looping through the clusters.  
+        2026_10_18 | AG | Add tsne_mode and tsne_cache ('lazy' and 'background' return a lazy_tsne as the 2d manifold).  
+        2026_10_18 | AG | Add tsne_method, which is passed to tsne_embedding.  
     """
     import numpy as np
     import hdbscan                                                               # used for clustering
-    from sklearn.manifold import TSNE                                            # t-distributed stochastic neighbour embedding
 
+    if tsne_mode not in ['now', 'lazy', 'background']:
+        raise Exception(f"'tsne_mode' must be either 'now', 'lazy', or 'background', but is {tsne_mode}.  Exiting.  ")
+    if tsne_method not in ['barnes_hut', 'barnes_hut_knn', 'fft', 'umap']:
+        raise Exception(f"'tsne_method' must be either 'barnes_hut', 'barnes_hut_knn', 'fft', or 'umap', but is {tsne_method}.  Exiting.  ")
     
     perplexity = tsne_param[0]                                                   # unpack tuples
-    early_exaggeration = tsne_param[1]
     min_cluster_size = hdbscan_param[0]                                              
     min_samples = hdbscan_param[1] 
 
     
 
-    # 1: Create the pairwise comparison matrix
+    # 1: Create the pairwise distance matrix
     print('\nStarting to compute the pairwise distance matrices....', end = '')
-    D, S = pairwise_comparison(sources_r2)                                              # each row is a source, is column is a pixel.  There ar n_comp * n_bootstrapping sources.  
-    print('Done!')                                                                      # D are distances, S are similiarities (so just 1 - each other).  n_sources * n_sources (so square).  
+    distances_param = {'sources_r2'        : sources_r2,                                                  # each row is a source, is column is a pixel.  There ar n_comp * n_bootstrapping sources.  
+                       'mixtures_mc'       : mixtures_mc,
+                       'memory_budget'     : memory_budget,
+                       'dtype'             : dtype,
+                       'knn_param'         : knn_param,
+                       'n_neighbours_min'  : max(min_samples, int(3 * perplexity + 1) + 1)}                   # as required by HDBSCAN (min_samples) and TSNE (3 x perplexity + 2)
+    D = sources_distances(**distances_param)                                                              # D are distances (1 - similarities).  Only one n_sources * n_sources matrix is kept (or a sparse one if knn_param is used)
+    print('Done!')                                                                      
 
 
     #  2: Clustering with all the recovered sources   
     print('Starting to cluster the sources using HDBSCAN....', end = "")  
     clusterer_precom = hdbscan.HDBSCAN(metric = 'precomputed', min_cluster_size = min_cluster_size, 
                                        min_samples = min_samples, cluster_selection_method = 'leaf')
-    labels_hdbscan = clusterer_precom.fit_predict(D)                                                                  # D is n_samples x n_samples, then returns a rank 1 which is the cluster number (ie label) for each source
-    Iq = cluster_quality_index(labels_hdbscan, S)                                                                     # calculate the cluster quality index, using S (n_samples x n_samples), and the label for each one
-                                                                                                                      # note that Iq is ordered by cluster, so the first value is the cluster quality index for 1st cluster (which is usually labelled -1 and the noise points)
-    if np.min(labels_hdbscan) == (-1):                                                                                # if HDBSCAN has identified noise
-        Iq = Iq[1:]                                                                                                   # delete the first entry, as this is the Iq of the noise (which isn't a cluster)
-    clusters_by_max_Iq_no_noise = np.argsort(Iq)[::-1]                                                                # clusters by best Iqfirst (ie cluster)
+    labels_hdbscan = clusterer_precom.fit_predict(D.astype(np.float64, copy = False))                                 # D is n_samples x n_samples, then returns a rank 1 which is the cluster number (ie label) for each source.  HDBSCAN requires (and copies) float64.  
     print('Done!')
 
 
     # 3:  2d manifold with all the recovered sources
-    print('Starting to calculate the 2D manifold representation....', end = "")
-    manifold_tsne = TSNE(n_components = 2, metric = 'precomputed', perplexity = perplexity, early_exaggeration = early_exaggeration,
-                         init = 'random', learning_rate = 200.0, square_distances=True)                                                                               # default will change to pca in 1.2.  May be worth experimenting with.  
-    xy_tsne = manifold_tsne.fit(D).embedding_
-    print('Done!' )
+    if tsne_mode == 'now':
+        print('Starting to calculate the 2D manifold representation....', end = "")
+        xy_tsne = tsne_embedding(D, tsne_param, tsne_method = tsne_method)
+        print('Done!' )
+    elif tsne_mode == 'background':
+        print('Starting to calculate the 2D manifold representation in the background.  ')
+        if (tsne_method != 'barnes_hut') and (knn_param is None):
+            D_tsne = knn_distances(D, int(3 * perplexity + 1) + 1)                                                        # only these are used, so no need to copy all of D
+        else:
+            D_tsne = D.copy()                                                                                             # the copy of D is used by the background thread, as D is changed below.  
+        xy_tsne = lazy_tsne(distances_param, tsne_param, D = D_tsne, background = True, cache_path = tsne_cache, tsne_method = tsne_method)
+    elif tsne_mode == 'lazy':
+        print('The 2D manifold representation will only be calculated when it is needed.  ')
+        xy_tsne = lazy_tsne(distances_param, tsne_param, cache_path = tsne_cache, tsne_method = tsne_method)             # D will be computed again when it's needed.  
+    if knn_param is None:
+        S = np.subtract(1, D, out = D)                                                                                # distances are no longer needed, so back to similarities.  
+    else:
+        S = D
+        np.subtract(1, S.data, out = S.data)
+    del D
+    
+    
+    # 4: Cluster quality index
+    similarity_sums = cluster_similarity_sums(labels_hdbscan, S)                                                      # sums of the similarities in and between each cluster, used for both Iq and the centrotypes
+    Iq = cluster_quality_index(labels_hdbscan, S, similarity_sums)                                                    # calculate the cluster quality index, using S (n_samples x n_samples), and the label for each one
+                                                                                                                      # note that Iq is ordered by cluster, so the first value is the cluster quality index for 1st cluster (which is usually labelled -1 and the noise points)
+    if np.min(labels_hdbscan) == (-1):                                                                                # if HDBSCAN has identified noise
+        Iq = Iq[1:]                                                                                                   # delete the first entry, as this is the Iq of the noise (which isn't a cluster)
+    clusters_by_max_Iq_no_noise = np.argsort(Iq)[::-1]                                                                # clusters by best Iqfirst (ie cluster)
     
 # testing.      
 #     def test_tsne(n_comp, D, perplexity, early_exaggeration):
@@ -1086,7 +1385,7 @@ def bootstrapped_sources_to_centrotypes(sources_r2, hdbscan_param, tsne_param):
     
     #%%
     
-    # 4: Determine the number of clusters from HDBSCAN
+    # 5: Determine the number of clusters from HDBSCAN
     if np.min(labels_hdbscan) == (-1):                                      # if we have noise (which is labelled as -1 byt HDBSCAN), 
         n_clusters = np.size(np.unique(labels_hdbscan)) - 1                 # noise doesn't count as a cluster so we -1 from number of clusters
     else:
@@ -1098,40 +1397,392 @@ def bootstrapped_sources_to_centrotypes(sources_r2, hdbscan_param, tsne_param):
         return None, labels_hdbscan, xy_tsne, clusters_by_max_Iq_no_noise, Iq
     
     else:
-        # 4:  Centrotypes (object that is most similar to all others in the cluster)
+        # 6:  Centrotypes (object that is most similar to all others in the cluster)
         print('Calculating the centrotypes and associated time courses...', end = '')
-        S_best_args = np.zeros((n_clusters, 1)).astype(int)                         
-        for i, clust_number in enumerate(clusters_by_max_Iq_no_noise):                              # loop through each cluster in order of how good they are (i.e. highest Iq first)
-            source_index = np.ravel(np.argwhere(labels_hdbscan == clust_number))                    # get the indexes of sources in this cluster
-            S_this_cluster = np.copy(S[source_index, :][:, source_index])                           # similarities for just this cluster
-            in_cluster_arg = np.argmax(np.sum(S_this_cluster, axis = 1))                            # the sum of a column of S_this... is the similarity between 1 source and all the others.  Look for the column that's the maximum
-            S_best_args[i,0] = source_index[in_cluster_arg]                                         # conver the number in the cluster to the number overall (ie 2nd in cluster is actually 120th source)     
-        S_best = np.copy(sources_r2[np.ravel(S_best_args),:])                                       # these are the centrotype sources
+        S_point_intra_sums = similarity_sums[0]                                                     # the similarity between each source and all the others in its cluster
+        sources_order = np.lexsort((-S_point_intra_sums, labels_hdbscan))                           # sort by cluster, then by similarity to the others in the cluster (most similar first, and for ties the first source)
+        cluster_starts = np.concatenate(([0], np.flatnonzero(np.diff(labels_hdbscan[sources_order])) + 1))
+        centrotype_args = sources_order[cluster_starts]                                             # the centrotype of each cluster, in the order of np.unique(labels_hdbscan)
+        S_best_args = centrotype_args[np.searchsorted(np.unique(labels_hdbscan), clusters_by_max_Iq_no_noise)]    # and in order of how good the clusters are (i.e. highest Iq first)
+        S_best = np.array(sources_r2[S_best_args,:], dtype = np.float64)                            # these are the centrotype sources (and only these are read if sources_r2 is on disk)
+        if mixtures_mc is not None:
+            S_best = S_best @ mixtures_mc                                                           # which are made from their coefficients.  
         print('Done!' )
     
         return S_best, labels_hdbscan, xy_tsne, clusters_by_max_Iq_no_noise, Iq
 
 
+#%%
+
+def sources_distances(sources_r2, mixtures_mc = None, memory_budget = None, dtype = 'float64', knn_param = None, n_neighbours_min = 0):
+    """ Compute the distances (1 - the absolute value of the correlation) between the sources recovered by all the runs of FastICA, either 
+    between all of them (pairwise_similarity), or between each and its nearest neighbours (knn_similarity_graph).  
+    Inputs:
+        sources_r2 | rank 2 array | sources as row vectors.  Can be a numpy memmap (see sources_store).  
+        mixtures_mc | rank 2 array or lazy_ifgs_all or None | If provided, sources_r2 are the coefficients that make the sources from these mean centered mixtures.  
+        memory_budget | float or None | see pairwise_similarity.  
+        dtype | string | 'float64' or 'float32'.  
+        knn_param | tuple or None | see bootstrapped_sources_to_centrotypes.  
+        n_neighbours_min | int | if knn_param is used, the minimum number of neighbours (e.g. as required by HDBSCAN and TSNE).  
+    Returns:
+        D | rank 2 array or sparse csr matrix | n_sources x n_sources distances.  If sparse, distances of 0 are stored as the smallest positive value 
+                                               (as distances that aren't stored are missing).  
+    History:
+        2026_10_18 | AG | Written, so that lazy_tsne can compute the distances later.  
+    """
+    import numpy as np
+    from icasar.aux1 import lazy_ifgs_all
+    from icasar.blind_signal_separation import gram_matrix
+    
+    if mixtures_mc is None:
+        mixtures_gram = None
+    elif isinstance(mixtures_mc, lazy_ifgs_all):
+        mixtures_gram = mixtures_mc.gram()
+    else:
+        mixtures_gram = gram_matrix(mixtures_mc)                                                          # each row is the coefficients for a source, so only the small (n_ifgs x n_ifgs) Gram matrix of the mixtures is needed.  
+    if knn_param is None:
+        S = pairwise_similarity(sources_r2, mixtures_gram, memory_budget, dtype)
+        D = np.subtract(1, S, out = S)                                                                    # S is no longer needed, so becomes D
+    else:
+        n_neighbours = max(knn_param[0], n_neighbours_min)
+        if n_neighbours > knn_param[0]:
+            print(f"Increasing the number of neighbours from {knn_param[0]} to {n_neighbours}, as required by HDBSCAN (min_samples) and TSNE (3 x perplexity + 2).  ", end = '')
+        if memory_budget is None:
+            memory_budget = 1e9
+        S = knn_similarity_graph(sources_r2, n_neighbours, mixtures_gram, approximate = (knn_param[1] == 'approximate'), 
+                                 memory_budget = memory_budget, dtype = dtype)
+        D = S                                                                                             # as above, but sparse so only the stored values change
+        np.subtract(1, D.data, out = D.data)
+        np.maximum(D.data, np.finfo(D.dtype).eps, out = D.data)                                           # as distances of 0 would be treated as missing.  
+    return D
+
+
+
+def tsne_embedding(D, tsne_param, random_state = None, tsne_method = 'barnes_hut'):
+    """ Compute the 2d manifold representation of the sources using TSNE (or UMAP).  
+    Inputs:
+        D | rank 2 array or sparse csr matrix | distances between the sources (see sources_distances).  
+        tsne_param | tuple | Used to control the 2d manifold learning  (perplexity, early_exaggeration)
+        random_state | int or None | passed to TSNE.  If None, numpy's global random state is used.  
+        tsne_method | string | 'barnes_hut', 'barnes_hut_knn', 'fft', or 'umap'.  
+                               'barnes_hut': sklearn's TSNE using D (either all the distances, or the sparse graph if D is sparse).  
+                               'barnes_hut_knn': as above, but only the distances to each source's 3 x perplexity + 2 nearest neighbours are used 
+                                                 (the sparse graph is used if D is already sparse).  
+                               'fft': as above, but uses FFT accelerated interpolation (FIt-SNE), which is much faster for many sources.  Requires openTSNE.  
+                               'umap': UMAP of the same nearest neighbour graph (using each source's 15 nearest neighbours).  Requires umap-learn.  
+    Returns:
+        xy_tsne | rank 2 array | the x and y coordinates of where each source is in the 2D space.  e.g. 1000x2
+    History:
+        2026_10_18 | AG | Written, moving the TSNE call out of bootstrapped_sources_to_centrotypes.  
+        2026_10_18 | AG | Add tsne_method, so that only each source's nearest neighbours are used ('barnes_hut_knn' and 'umap'), or FIt-SNE ('fft').  
+    """
+    import numpy as np
+    from scipy import sparse
+    
+    perplexity = tsne_param[0]                                                   # unpack tuples
+    early_exaggeration = tsne_param[1]
+    
+    if tsne_method not in ['barnes_hut', 'barnes_hut_knn', 'fft', 'umap']:
+        raise Exception(f"'tsne_method' must be either 'barnes_hut', 'barnes_hut_knn', 'fft', or 'umap', but is {tsne_method}.  Exiting.  ")
+    if (tsne_method != 'barnes_hut') and (not sparse.issparse(D)):
+        D = knn_distances(D, int(3 * perplexity + 1) + 1)                       # only keep the distances to each source's nearest neighbours (as many as TSNE uses)
+    if (tsne_method in ['fft', 'umap']) and (random_state is None):
+        random_state = np.random.randint(0, 2**31 - 1)                          # openTSNE and UMAP don't use numpy's global random state.  
+    
+    if tsne_method in ['barnes_hut', 'barnes_hut_knn']:
+        from sklearn.manifold import TSNE                                            # t-distributed stochastic neighbour embedding
+        manifold_tsne = TSNE(n_components = 2, metric = 'precomputed', perplexity = perplexity, early_exaggeration = early_exaggeration,
+                             init = 'random', learning_rate = 200.0, square_distances=True, random_state = random_state)                                                   # default will change to pca in 1.2.  May be worth experimenting with.  
+        if sparse.issparse(D):
+            D_tsne = D.copy()                                                                                             # TSNE expects the distances in each row of a sparse graph to be in ascending order
+            D_tsne_rows = np.repeat(np.arange(D.shape[0]), np.diff(D.indptr))
+            D_tsne_order = np.lexsort((D.data, D_tsne_rows))
+            D_tsne.indices, D_tsne.data = D.indices[D_tsne_order], D.data[D_tsne_order]
+            D_tsne.has_sorted_indices = False
+            xy_tsne = manifold_tsne.fit(D_tsne).embedding_
+        else:
+            xy_tsne = manifold_tsne.fit(D).embedding_
+    
+    elif tsne_method == 'fft':
+        import openTSNE                                                                                                   # optional, so only imported if used.  
+        P = tsne_affinities(D, perplexity)
+        xy_init = np.random.RandomState(random_state).normal(0, 1e-4, (D.shape[0], 2))                                   # as TSNE with init = 'random'
+        manifold_tsne = openTSNE.TSNE(n_components = 2, early_exaggeration = early_exaggeration, negative_gradient_method = 'fft', 
+                                      random_state = random_state)
+        xy_tsne = np.asarray(manifold_tsne.fit(affinities = openTSNE.affinity.PrecomputedAffinities(P), initialization = xy_init))
+    
+    elif tsne_method == 'umap':
+        import umap                                                                                                       # optional, so only imported if used.  
+        n_neighbours = min(15, int(np.min(np.diff(D.indptr))))                                                           # UMAP's default, unless some sources have fewer neighbours.  
+        manifold_umap = umap.UMAP(n_components = 2, n_neighbors = n_neighbours, metric = 'precomputed', random_state = random_state)
+        xy_tsne = manifold_umap.fit_transform(D)                                                                          # missing distances in D are treated as large.  
+    
+    return xy_tsne
+
+
+
+def knn_distances(D, n_neighbours):
+    """ Make a sparse graph of the distances between each source and its n_neighbours nearest neighbours from all the distances between them.  
+    Inputs:
+        D | rank 2 array | n_sources x n_sources distances (e.g. 1 - the absolute value of the correlation).  
+        n_neighbours | int | number of nearest neighbours to keep for each source (not including itself).  
+    Returns:
+        D_knn | sparse csr matrix | n_sources x n_sources distances.  Symmetric, so sources can have more than n_neighbours neighbours.  
+                                    Distances of 0 are stored as the smallest positive value (as distances that aren't stored are missing).  
+    History:
+        2026_10_18 | AG | Written
+    """
+    import numpy as np
+    from scipy import sparse
+    
+    n_sources = D.shape[0]
+    n_neighbours = min(n_neighbours, n_sources - 1)
+    n_rows_block = 1000
+    
+    neighbours = np.zeros((n_sources, n_neighbours), dtype = np.int64)
+    for row_start in range(0, n_sources, n_rows_block):                                                         # loop through blocks of rows so that only one block is copied at a time.  
+        D_block = np.array(D[row_start : row_start + n_rows_block], copy = True)
+        D_block[np.arange(D_block.shape[0]), np.arange(row_start, row_start + D_block.shape[0])] = np.inf      # a source isn't its own neighbour.  
+        neighbours[row_start : row_start + n_rows_block] = np.argpartition(D_block, n_neighbours - 1, axis = 1)[:, :n_neighbours]
+    rows = np.repeat(np.arange(n_sources), n_neighbours)
+    cols = np.ravel(neighbours)
+    D_knn = sparse.csr_matrix((np.maximum(D[rows, cols], np.finfo(D.dtype).eps), (rows, cols)), shape = (n_sources, n_sources))
+    D_knn = D_knn.maximum(D_knn.T).tocsr()                                                                      # symmetric, so if i is a neighbour of j, j is a neighbour of i.  Distances are positive, so this is their union.  
+    D_knn.sort_indices()
+    return D_knn
+
+
+
+def tsne_affinities(D, perplexity, n_iterations = 100, tolerance = 1e-5):
+    """ Compute the joint probabilities used by TSNE from a sparse graph of the distances between each source and its nearest neighbours.  
+    The width of the Gaussian for each source is found by a binary search (for all sources at once) so that the conditional 
+    probabilities have the desired perplexity, as in sklearn's TSNE (which uses the distances as given when they are precomputed).  
+    Inputs:
+        D | sparse csr matrix | n_sources x n_sources distances (see knn_distances).  
+        perplexity | float | TSNE perplexity.  
+        n_iterations | int | maximum number of steps of the binary search.  
+        tolerance | float | the binary search stops when all the entropies are within this of log(perplexity).  
+    Returns:
+        P | sparse csr matrix | n_sources x n_sources joint probabilities.  Symmetric and sums to 1.  
+    History:
+        2026_10_18 | AG | Written
+    """
+    import numpy as np
+    from scipy import sparse
+    
+    n_sources = D.shape[0]
+    rows = np.repeat(np.arange(n_sources), np.diff(D.indptr))
+    distances = D.data.astype(np.float64)
+    entropy_target = np.log(perplexity)
+    
+    beta = np.ones(n_sources)                                                                          # 1 / (2 * sigma ** 2) for each source
+    beta_min = np.zeros(n_sources)
+    beta_max = np.full(n_sources, np.inf)
+    for iteration in range(n_iterations):
+        p = np.exp(-distances * beta[rows])
+        p_sums = np.maximum(np.bincount(rows, p, n_sources), np.finfo(np.float64).tiny)
+        entropy = np.log(p_sums) + beta * np.bincount(rows, distances * p, n_sources) / p_sums
+        if np.max(np.abs(entropy - entropy_target)) < tolerance:
+            break
+        too_wide = entropy > entropy_target                                                            # these need a larger beta (narrower Gaussian)
+        beta_min[too_wide] = beta[too_wide]
+        beta_max[~too_wide] = beta[~too_wide]
+        beta = np.where(np.isinf(beta_max), beta * 2, (beta_min + beta_max) / 2)
+    
+    P = sparse.csr_matrix((p / p_sums[rows], D.indices, D.indptr), shape = D.shape)                 # conditional probabilities, each row sums to 1
+    P = P + P.T                                                                                        # symmetric
+    P = P / P.sum()
+    return P
+
+
+
+class lazy_tsne():
+    """ The 2d manifold representation of the sources (from TSNE), which is only computed when it is needed (i.e. when the embedding method is called), 
+    or in a background thread.  As this is normally only used for figures, this avoids computing it if no figures are made.  
+    Inputs:
+        distances_param | dict | arguments for sources_distances, used to compute the distances between the sources when they're needed.  
+        tsne_param | tuple | Used to control the 2d manifold learning  (perplexity, early_exaggeration)
+        D | rank 2 array or sparse csr matrix or None | If provided, these distances are used (rather than computing them again).  
+        background | boolean | If True, start computing the 2d manifold in a background thread straight away.  
+        cache_path | Path or None | If provided, the 2d manifold is saved to a .npy file with this name and the number of sources and random state 
+                                    appended (e.g. TSNE_xy_1000_1234.npy) once computed, or loaded from it if it already exists (and has a row for each source).  
+                                    The file is then only used by this run (or copies of this lazy_tsne), even if the folder is reused.  
+        tsne_method | string | see tsne_embedding.  
+    History:
+        2026_10_18 | AG | Written
+        2026_10_18 | AG | Can be pickled (the lock and background thread aren't, and a new lock is made when it's unpickled).  
+        2026_10_18 | AG | Add the number of sources and the random state to the name of the cache file, and check its size when it's loaded.  
+        2026_10_18 | AG | Don't keep (or pickle) distances_param once the 2d manifold has been computed.  
+    """
+    def __init__(self, distances_param, tsne_param, D = None, background = False, cache_path = None, tsne_method = 'barnes_hut'):
+        import numpy as np
+        import threading
+        from pathlib import Path
+        self.distances_param = distances_param
+        self.tsne_param = tsne_param
+        self.tsne_method = tsne_method
+        self.D = D
+        self.random_state = np.random.randint(0, 2**31 - 1)                             # so that the result doesn't depend on when it's computed.  
+        self.n_sources = D.shape[0] if D is not None else distances_param['sources_r2'].shape[0]
+        if cache_path is not None:
+            cache_path = Path(cache_path)
+            cache_path = cache_path.with_name(f"{cache_path.stem}_{self.n_sources}_{self.random_state}{cache_path.suffix}")      # so a file from another run isn't loaded
+        self.cache_path = cache_path
+        self.xy = None
+        self.lock = threading.Lock()
+        if background:
+            self.thread = threading.Thread(target = self.embedding, daemon = True)
+            self.thread.start()
+        
+    def embedding(self):
+        """ Return the 2d manifold representation of the sources (n_sources x 2), computing it if it hasn't been already.  
+        """
+        import numpy as np
+        import os
+        with self.lock:                                                                  # if it's being computed in the background, wait until it's finished.  
+            if self.xy is None:
+                if (self.cache_path is not None) and os.path.exists(self.cache_path):
+                    xy = np.load(self.cache_path)
+                    if xy.shape == (self.n_sources, 2):
+                        self.xy = xy
+                if self.xy is None:
+                    if self.D is None:
+                        self.D = sources_distances(**self.distances_param)
+                    self.xy = tsne_embedding(self.D, self.tsne_param, self.random_state, self.tsne_method)
+                    if self.cache_path is not None:
+                        np.save(self.cache_path, self.xy)
+                self.D = None                                                            # distances are no longer needed
+                self.distances_param = None                                              # nor are the sources to compute them
+        return self.xy
+    
+    def __array__(self, dtype = None, copy = None):
+        import numpy as np
+        return np.asarray(self.embedding(), dtype = dtype)
+    
+    def __getstate__(self):
+        """ The lock and thread can't be pickled.  If the 2d manifold is being computed in the background, this waits until it's finished.  
+        Once the 2d manifold has been computed, the sources (in distances_param) aren't pickled either.  
+        """
+        with self.lock:
+            state = dict(self.__dict__)
+        state.pop('lock')
+        state.pop('thread', None)
+        if state['xy'] is not None:
+            state['distances_param'] = None
+            state['D'] = None
+        return state
+    
+    def __setstate__(self, state):
+        import threading
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
 #%%
 
 def perform_multiple_ICA_runs(n_comp, mixtures_mc, bootstrapping_param, ica_param,
-                              mixtures_white = None, dewhiten_matrix = None, ica_verbose = 'long'):
+                              mixtures_white = None, dewhiten_matrix = None, ica_verbose = 'long', n_jobs = 1, batch_no_bootstrapping = True,
+                              bootstrap_from_gram = True, sources_as_coefficients = False, whiten_matrix = None, sources_store = None,
+                              minibatch_param = None):
     """
     ICASAR requires ICA to be run many times, wither with or without bootstrapping.  This function performs this.  
     Inputs:
         n_comp | int | the number of souces we aim to recover.  
-        mixutres_mc | rank 2 array | mixtures as rows, mean centered along rows.  I.e. of size n_varaibles x n_observations.  
+        mixutres_mc | rank 2 array or lazy_ifgs_all | mixtures as rows, mean centered along rows.  I.e. of size n_varaibles x n_observations.  
         bootstrapping_param | tuple | (number of ICA runs with bootstrap, number of ICA runs without bootstrapping )  e.g. (100,10)
         ica_param | tuple | Used to control ICA, (ica_tol, ica_maxit)
         mixtures_white | rank 2 | mean centered and decorellated and unit variance in each dimension (ie whitened).  As per mixtures, row vectors.  
         dewhiten_matrix | rank 2 | n_comp x n_comp.  mixtures_mc = dewhiten_matrix @ mixtures_white
         ica_verbose | 'long' or 'short' | if long, full details of ICA runs are given.  If short, only the overall progress 
+        n_jobs | int | number of processes to spread the ICA runs over.  1 runs them in this process.  Each run is seeded from its position in the 
+                       sequence of runs, so the results are the same regardless of n_jobs.  
+        batch_no_bootstrapping | boolean | if True, the runs without bootstrapping (which all use the same whitened data) are iterated together as one 
+                                           batch using fastica_MEG_batch, rather than one after the other.  The results are the same.  
+        bootstrap_from_gram | boolean | if True, the Gram matrix of the mixtures (n_ifgs x n_ifgs) is computed once, and each bootstrapped sample is whitened
+                                        using this (rather than PCA of the bootstrapped mixtures).  Only used if PCA_meg2 wouldn't use the compact trick.  
+        sources_as_coefficients | boolean | if True, each source is returned as the coefficients that make it from the mixtures (i.e. sources = coefficients @ mixtures_mc), 
+                                            which for sICA is a vector of length n_ifgs rather than n_pixels.  
+        whiten_matrix | rank 2 | mixtures_white = whiten_matrix @ mixtures_mc.  Only needed for sources_as_coefficients with runs without bootstrapping.  
+        sources_store | sources_store or None | If provided, the sources from each run are written to this as the run converges, and the sources 
+                                                returned are views of these (so the sources can be kept on disk, see sources_store).  
+        minibatch_param | tuple or None | (n_samples_batch, batch_growth).  If a tuple, each run first iterates using random selections of the samples.  
+                                          See fastica_MEG.  If the runs without bootstrapping are batched, they share the same selections.  
     Returns:
         S_best | list of rank 2 arrays | the sources from each run of the FastICA algorithm, n_comp x n_pixels.  Bootstrapped ones first, non-bootstrapped second.  
+                                         If sources_as_coefficients, these are instead n_comp x n_ifgs and the sources are these @ mixtures_mc
         A_hist | list of rank 2 arrays | the time courses from each run of the FastICA algorithm.  n_ifgs x n_comp.  Bootstrapped ones first, non-bootstrapped second.  
     History:
         2021_04_23 | MEG | Written
+        2026_10_18 | AG | Add n_jobs.  Each run is seeded from its position in the sequence of runs, so the results don't depend on n_jobs.  
+        2026_10_18 | AG | Add batch_no_bootstrapping, to iterate the runs without bootstrapping together (fastica_MEG_batch).  
+        2026_10_18 | AG | Add bootstrap_from_gram, to whiten each bootstrapped sample from the Gram matrix of the mixtures rather than a new PCA.  
+        2026_10_18 | AG | Add sources_as_coefficients and whiten_matrix.  
+        2026_10_18 | AG | Add sources_store.  
+        2026_10_18 | AG | mixtures_mc can be a lazy_ifgs_all (the Gram matrix is then made from its products).  
+        2026_10_18 | AG | Add minibatch_param, which is passed to each run.  
+        2026_10_18 | AG | Keep the runs without bootstrapping batched when minibatch_param is used.  
+        2026_10_18 | AG | With n_jobs, only submit as many runs as are still needed (rather than at least n_jobs).  
     """
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+    from icasar.aux1 import lazy_ifgs_all
+    from icasar.blind_signal_separation import gram_matrix
+    
+    def ica_runs_until_converged(n_converge_needed, bootstrap, seed_base, executor):
+        """ Perform ICA runs until n_converge_needed of them have converged.  Runs are made in batches (when there is an executor, of as many runs 
+        as are still needed, with more batches if some don't converge), and the results are considered in the order the runs were made so that the 
+        converged runs kept are the same as in serial.  
+        Inputs:
+            n_converge_needed | int | number of converged runs required.  
+            bootstrap | boolean | if True, the mixtures are bootstrapped for each run.  
+            seed_base | int | each run is seeded with this and its run number.  
+            executor | ProcessPoolExecutor or None | if None, the runs are performed in this process.  
+        Returns:
+            S_hist_runs | list of rank 2 arrays | sources from each converged run.  
+            A_hist_runs | list of rank 2 arrays | time courses from each converged run.  
+        """
+        if bootstrap:
+            run_name = 'with'
+        else:
+            run_name = 'without'
+        S_hist_runs = []
+        A_hist_runs = []
+        n_ica_converge = 0
+        n_ica_fail = 0
+        n_run = 0
+        if ica_verbose == 'short' and n_converge_needed > 0:                                             # if we're only doing short version of verbose, and will be doing these runs
+            print(f"FastICA progress {run_name} bootstrapping: ", end = '')
+        while n_ica_converge < n_converge_needed:
+            if (not bootstrap) and batch_no_bootstrapping:
+                n_runs_batch = n_converge_needed - n_ica_converge                                        # as batched, enough runs to finish if they all converge.  
+            elif executor is None:
+                n_runs_batch = 1                                                                         # in serial, a single run at a time.  
+            else:
+                n_runs_batch = n_converge_needed - n_ica_converge                                        # in parallel, enough runs to finish if they all converge (no more, as extra runs would be discarded)
+            seeds = [(seed_base, n_run + i) for i in range(n_runs_batch)]
+            n_run += n_runs_batch
+            if (not bootstrap) and batch_no_bootstrapping:
+                run_results = ica_worker_run_batch(seeds)                                                # batched runs are done in this process.  
+            elif executor is None:
+                run_results = (ica_worker_run(seed, bootstrap) for seed in seeds)
+            else:
+                run_results = executor.map(ica_worker_run, seeds, [bootstrap] * n_runs_batch)
+            for S, A, ica_converged in run_results:                                                       # results are in the order the runs were made.  
+                if n_ica_converge == n_converge_needed:                                                   # runs beyond the number needed are discarded
+                    break
+                if ica_converged:
+                    n_ica_converge += 1
+                    if sources_store is not None:
+                        S = sources_store.append(S)                                                       # write to the store, and keep only a view of it.  
+                    A_hist_runs.append(A)                                                                 # record results
+                    S_hist_runs.append(S)                                                                 # record results
+                else:
+                    n_ica_fail += 1
+                if ica_verbose == 'long':
+                    print(f"sICA {run_name} bootstrapping has converged {n_ica_converge} of {n_converge_needed} times.   \n")              # longer (more info) update to terminal
+                else:
+                    print(f"{int(100*(n_ica_converge/n_converge_needed))}% ", end = '')                                                     # short update to terminal
+        return S_hist_runs, A_hist_runs
     
     # 1: unpack a tuple and check a few inputs.  
     n_converge_bootstrapping = bootstrapping_param[0]                 # unpack input tuples
@@ -1141,49 +1792,38 @@ def perform_multiple_ICA_runs(n_comp, mixtures_mc, bootstrapping_param, ica_para
         raise Exception(f"If runs without bootstrapping are to be performed, the whitened data and the dewhitening matrix must be provided, yet one "
                         f"or more of these are 'None'.  This is as PCA is performed to whiten the data, yet if bootstrapping is not being used "
                         f"the data don't change, so PCA doesn't need to be run (and it can be computationally expensive).  Exiting.  ")
-    
-    # 2: do ICA multiple times   
-    # First with bootstrapping
-    A_hist_BS = []                                                                                      # ditto but with bootstrapping
-    S_hist_BS = []
-    n_ica_converge = 0
-    n_ica_fail = 0
-    if ica_verbose == 'short' and n_converge_bootstrapping > 0:                                 # if we're only doing short version of verbose, and will be doing bootstrapping
-        print(f"FastICA progress with bootstrapping: ", end = '')
-    while n_ica_converge < n_converge_bootstrapping:
-        S, A, ica_converged = bootstrap_ICA(mixtures_mc, n_comp, bootstrap = True, ica_param = ica_param, verbose = ica_verbose)                # note that this will perform PCA on the bootstrapped samples, so can be slow.  
-        if ica_converged:
-            n_ica_converge += 1
-            A_hist_BS.append(A)                                     # record results
-            S_hist_BS.append(S)                                     # record results
-        else:
-            n_ica_fail += 1
-        if ica_verbose == 'long':
-            print(f"sICA with bootstrapping has converged {n_ica_converge} of {n_converge_bootstrapping} times.   \n")              # longer (more info) update to terminal
-        else:
-            print(f"{int(100*(n_ica_converge/n_converge_bootstrapping))}% ", end = '')                                              # short update to terminal
-
-    # and without bootstrapping
-    A_hist_no_BS = []                                                                        # initiate to store time courses without bootstrapping
-    S_hist_no_BS = []                                                                        # and recovered sources        
-    n_ica_converge = 0                                                                       # reset the counters for the second lot of ica
-    n_ica_fail = 0
-    if ica_verbose == 'short' and n_converge_no_bootstrapping > 0:                           # if we're only doing short version of verbose, and are actually doing ICA with no bootstrapping
-        print(f"FastICA progress without bootstrapping: ", end = '')
-    while n_ica_converge < n_converge_no_bootstrapping:
-        S, A, ica_converged = bootstrap_ICA(mixtures_mc, n_comp, bootstrap = False, ica_param = ica_param,
-                                            X_whitened = mixtures_white, dewhiten_matrix = dewhiten_matrix, verbose = ica_verbose)               # no bootstrapping, so PCA doesn't need to be run each time and we can pass it the whitened data.  
-        
-        if ica_converged:
-            n_ica_converge += 1
-            A_hist_no_BS.append(A)                                     # record results
-            S_hist_no_BS.append(S)                                     # record results
-        else:
-            n_ica_fail += 1
-        if ica_verbose == 'long':
-            print(f"sICA without bootstrapping has converged {n_ica_converge} of {n_converge_no_bootstrapping} times.   \n",)
-        else:
-            print(f"{int(100*(n_ica_converge/n_converge_no_bootstrapping))}% ", end = '')
+    if (n_converge_no_bootstrapping > 0) and sources_as_coefficients and (whiten_matrix is None):
+        raise Exception(f"If runs without bootstrapping are to return the sources as coefficients, 'whiten_matrix' must be provided.  Exiting.  ")
+    if n_jobs < 1:
+        raise Exception(f"'n_jobs' must be 1 or more, but is {n_jobs}.  Exiting.  ")
+    
+    # 2: do ICA multiple times, either in this process or in a pool of processes (which each get a copy of the data once, when they start).  
+    n_mixtures, n_samples = mixtures_mc.shape
+    if isinstance(mixtures_mc, lazy_ifgs_all) and (n_converge_bootstrapping > 0):                                                 # the mixtures are never made, so the bootstrapped samples must be whitened from the Gram matrix.  
+        mixtures_means = np.mean(mixtures_mc, axis = 1)
+        mixtures_gram = mixtures_mc.gram() - n_samples * np.outer(mixtures_means, mixtures_means)
+    elif bootstrap_from_gram and (n_converge_bootstrapping > 0) and not ((n_samples < n_mixtures) and (n_mixtures > 100)):        # as PCA_meg2 uses the compact trick in this case, which doesn't lead to the same whitening
+        mixtures_means = np.mean(mixtures_mc, axis = 1)                                                                              # should be 0, but this ensures the Gram matrix is for mean centered mixtures.  
+        mixtures_gram = gram_matrix(mixtures_mc) - n_samples * np.outer(mixtures_means, mixtures_means)
+    else:
+        mixtures_gram = None
+    
+    seed_bases = np.random.randint(0, 2**31 - 1, 2)                                                     # draws from the global random state for the runs with and without bootstrapping, each run is then seeded using one of these and its run number.  
+    worker_data = (mixtures_mc, mixtures_white, dewhiten_matrix, n_comp, ica_param, ica_verbose, mixtures_gram, whiten_matrix, sources_as_coefficients, 
+                   minibatch_param)
+    random_state = np.random.get_state()                                                                                 # runs in this process reseed the global random state, so keep a copy to restore afterwards.  
+    ica_worker_init(*worker_data)                                                                                        # runs can be done in this process (even with a pool, as batched runs are), so they need the data.  
+    if n_jobs == 1:
+        S_hist_BS, A_hist_BS = ica_runs_until_converged(n_converge_bootstrapping, True, seed_bases[0], None)              # First with bootstrapping
+        S_hist_no_BS, A_hist_no_BS = ica_runs_until_converged(n_converge_no_bootstrapping, False, seed_bases[1], None)    # and without bootstrapping
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs, initializer = ica_worker_init, initargs = worker_data) as executor:
+            S_hist_BS, A_hist_BS = ica_runs_until_converged(n_converge_bootstrapping, True, seed_bases[0], executor)      # First with bootstrapping
+            S_hist_no_BS, A_hist_no_BS = ica_runs_until_converged(n_converge_no_bootstrapping, False, seed_bases[1], executor)    # and without bootstrapping
+    ica_worker_data.clear()                                                                                              # don't keep references to the data once finished.  
+    np.random.set_state(random_state)
+    if sources_store is not None:
+        sources_store.flush()
        
     # 3: change data structure for sources, and compute similarities and distances between them.  
     A_hist = A_hist_BS + A_hist_no_BS                                                                   # list containing the time courses from each run.  i.e. each is: times x n_components
@@ -1192,11 +1832,105 @@ def perform_multiple_ICA_runs(n_comp, mixtures_mc, bootstrapping_param, ica_para
     return S_hist, A_hist
 
 
+#%%
+
+ica_worker_data = {}                                                                                    # data used by ica_worker_run, set once per process by ica_worker_init
+
+def ica_worker_init(mixtures_mc, mixtures_white, dewhiten_matrix, n_comp, ica_param, ica_verbose, mixtures_gram = None,
+                    whiten_matrix = None, sources_as_coefficients = False, minibatch_param = None):
+    """ Store the data needed for the ICA runs in this process, so that it is only sent to each process in a pool once (and not with every run).  
+    Inputs:
+        As per perform_multiple_ICA_runs.  
+    Returns:
+        ica_worker_data is updated.  
+    History:
+        2026_10_18 | AG | Written
+    """
+    ica_worker_data.update({'mixtures_mc'     : mixtures_mc,
+                            'mixtures_white'  : mixtures_white,
+                            'dewhiten_matrix' : dewhiten_matrix,
+                            'n_comp'          : n_comp,
+                            'ica_param'       : ica_param,
+                            'ica_verbose'     : ica_verbose,
+                            'mixtures_gram'   : mixtures_gram,
+                            'whiten_matrix'   : whiten_matrix,
+                            'sources_as_coefficients' : sources_as_coefficients,
+                            'minibatch_param' : minibatch_param})
+
+
+def ica_worker_run(seed, bootstrap):
+    """ Perform one run of ICA (with or without bootstrapping) using the data stored by ica_worker_init.  
+    Inputs:
+        seed | tuple of ints | used to seed numpy's random state, so the bootstrap sample and initial unmixing matrix depend only on this.  
+        bootstrap | boolean | if True, the mixtures are bootstrapped.  
+    Returns:
+        As per bootstrap_ICA
+    History:
+        2026_10_18 | AG | Written
+    """
+    import numpy as np
+    
+    np.random.seed(seed)
+    d = ica_worker_data
+    if bootstrap:
+        return bootstrap_ICA(d['mixtures_mc'], d['n_comp'], bootstrap = True, ica_param = d['ica_param'], verbose = d['ica_verbose'],
+                             X_gram = d['mixtures_gram'], return_coefficients = d['sources_as_coefficients'], minibatch_param = d['minibatch_param'])                                # note that if X_gram is None, this will perform PCA on the bootstrapped samples, so can be slow.  
+    else:
+        return bootstrap_ICA(d['mixtures_mc'], d['n_comp'], bootstrap = False, ica_param = d['ica_param'],
+                             X_whitened = d['mixtures_white'], dewhiten_matrix = d['dewhiten_matrix'], verbose = d['ica_verbose'],             # no bootstrapping, so PCA doesn't need to be run each time and we can pass it the whitened data.  
+                             whiten_matrix = d['whiten_matrix'], return_coefficients = d['sources_as_coefficients'], minibatch_param = d['minibatch_param'])
+
+
+def ica_worker_run_batch(seeds):
+    """ Perform several runs of ICA without bootstrapping (using the data stored by ica_worker_init) as a single batch.  
+    The initial unmixing matrix for each run is the same as the one ica_worker_run would use with that seed, so the results are the same
+    (unless minibatch_param is used, as all the runs then share the random selections of the samples, which are seeded with the first seed).  
+    Inputs:
+        seeds | list of tuples of ints | one for each run, see ica_worker_run
+    Returns:
+        run_results | list of tuples | (S, A, ica_success) for each run, as per bootstrap_ICA
+    History:
+        2026_10_18 | AG | Written
+        2026_10_18 | AG | Pass minibatch_param to fastica_MEG_batch.  
+    """
+    import numpy as np
+    from icasar.blind_signal_separation import fastica_MEG_batch
+    from icasar.aux1 import  maps_tcs_rescale
+    
+    d = ica_worker_data
+    n_comp = d['n_comp']
+    X_whitened = d['mixtures_white'][:n_comp,]                                                                          # reduce dimensionality ready for ICA
+    w_inits = np.stack([np.random.RandomState(seed).normal(size=(n_comp, n_comp)) for seed in seeds])                   # as per the first draw fastica_MEG would make after seeding
+    np.random.seed(seeds[0])                                                                                            # for the selections of the samples, if minibatch_param is used.  
+    Ws, ica_convergeds = fastica_MEG_batch(X_whitened, w_inits, maxit = d['ica_param'][1], tol = d['ica_param'][0], verbose = d['ica_verbose'],
+                                           minibatch_param = d['minibatch_param'])
+    
+    run_results = []
+    for W, ica_converged in zip(Ws, ica_convergeds):
+        if ica_converged:
+            try:
+                S = W.astype(X_whitened.dtype, copy = False) @ X_whitened
+                A_white = np.linalg.inv(W)
+                A = d['dewhiten_matrix'][:,0:n_comp] @ A_white                                                          # turn ICA mixing matrix back into a time courses (ie dewhiten/ undo dimensonality reduction)
+                if d['sources_as_coefficients']:
+                    S_coefs = (W @ d['whiten_matrix'][:n_comp,]) / np.ptp(S, axis = 1)[:, np.newaxis]                   # as per bootstrap_ICA
+                S, A = maps_tcs_rescale(S, A)                                                                           # rescale so spatial maps have a range or 1 (so easy to compare)
+                if d['sources_as_coefficients']:
+                    S = S_coefs
+                run_results.append((S, A, True))
+            except:
+                print(f"A FastICA run has failed, continuing anyway.  ")
+                run_results.append((None, None, False))
+        else:
+            run_results.append((None, None, False))
+    return run_results
+
      
 #%%
 
 def bootstrap_ICA(X, n_comp, bootstrap = True, ica_param = (1e-4, 150), 
-                  X_whitened = None, dewhiten_matrix = None, verbose = True):
+                  X_whitened = None, dewhiten_matrix = None, verbose = True, X_gram = None,
+                  whiten_matrix = None, return_coefficients = False, minibatch_param = None):
     """  A function to perform ICA either with or without boostrapping.  
     If not performing bootstrapping, performance can be imporoved by passing the whitened data and the dewhitening matrix
     (so that PCA does not have to be peroformed).  
@@ -1214,19 +1948,29 @@ def bootstrap_ICA(X, n_comp, bootstrap = True, ica_param = (1e-4, 150),
                                         X = dewhiten x A x S
                                         Needed if not bootstrapping and don't want to  do PCA each time (as above)
         verbose | boolean | If True, the FastICA algorithm returns how many times it took to converge (or if it didn't converge)
+        X_gram | rank2 array or None | Gram matrix of the (mean centered) X, i.e. X @ X.T.  If provided when bootstrapping, the bootstrapped sample is 
+                                       whitened from this (using PCA_meg2_gram), so PCA of the bootstrapped data (which uses all the pixels) isn't needed.
+        whiten_matrix | rank2 array or None | X_whitened = whiten_matrix @ X.  Only needed if return_coefficients is True, and X_whitened is provided.  
+        return_coefficients | boolean | if True, rather than the sources, the coefficients that make them from the (mean centered) X are returned 
+                                        (i.e. sources = coefficients @ X).  These are much smaller than the sources if X has few rows and many columns.  
+        minibatch_param | tuple or None | (n_samples_batch, batch_growth), to first iterate FastICA using random selections of the samples.  See fastica_MEG.  
     
     Returns:
-        S | rank2 array | sources as row vectors (ie n_sources x n_samples)
+        S | rank2 array | sources as row vectors (ie n_sources x n_samples), or if return_coefficients is True, the coefficients (n_sources x n_variables)
         A | rank 2 array | time courses as columns (ie n_ifgs x n_sources)
         ica_success | boolean | True is the FastICA algorithm does converge.  
         
     History:
         2020/06/05 | MEG | Written
         2020/06/09 | MEG | Update to able to hand the case in which PCA fails (normally to do with finding the inverse of a matrix)
+        2026_10_18 | AG | Add X_gram, so that a bootstrapped sample is whitened by selecting rows and columns of the Gram matrix, rather than by PCA of the sample.  
+        2026_10_18 | AG | Add return_coefficients (the sources are then W @ whiten_coefs, rescaled as per maps_tcs_rescale).  
+        2026_10_18 | AG | Add minibatch_param, which is passed to fastica_MEG.  
+        2026_10_18 | AG | PCA of the bootstrapped data only computes the first n_comp components.  
     
     """
     import numpy as np
-    from icasar.blind_signal_separation import PCA_meg2, fastica_MEG
+    from icasar.blind_signal_separation import PCA_meg2, PCA_meg2_gram, fastica_MEG
     from icasar.aux1 import  maps_tcs_rescale
     
     n_loop_max = 1000                                                               # when trying to make bootstrapped samples, if one can't be found after this many attempts, raise an error.  Best left high.  
@@ -1235,7 +1979,6 @@ def bootstrap_ICA(X, n_comp, bootstrap = True, ica_param = (1e-4, 150),
     
     # 0: do the bootstrapping and determine if we need to do PCA
     if bootstrap:
-        pca_needed = True                                                                                            # PCA will always be needed if bootstrapping 
         input_ifg_args = np.arange(n_comp-1)                                                                          # initiate as a crude way to get into the loop
         n_loop = 0                                                                                                   # to count how many goes it takes to generate a good bootstrap sample
         while len(np.unique(input_ifg_args)) < n_comp and n_loop < 100:                                              # try making a list of samples to bootstrap with providing it has enough unique items for subsequent pca to work
@@ -1245,12 +1988,34 @@ def bootstrap_ICA(X, n_comp, bootstrap = True, ica_param = (1e-4, 150),
             raise Exception(f'Unable to bootstrap the data as the number of training data must be sufficently'
                             f' bigger than "n_components" sought that there are "n_components" unique items in'
                             f' a bootsrapped sample.  ')                                                             # error message
-        X = X[input_ifg_args, :]                                                                              # bootstrapped smaple
+        bootstrap_selection = np.zeros((n_ifgs, n_ifgs))                                                            # the bootstrapped sample is bootstrap_selection @ X
+        bootstrap_selection[np.arange(n_ifgs), input_ifg_args] = 1
+        if X_gram is not None:                                                                                      # whiten using the Gram matrix, so PCA isn't needed.  
+            pca_needed = False
+            try:
+                _, _, whiten_matrix_bs, dewhiten_matrix = PCA_meg2_gram(X_gram[np.ix_(input_ifg_args, input_ifg_args)],      # Gram matrix of the bootstrapped sample is just a selection from the Gram matrix of X
+                                                                        X.shape[1], n_comp)
+                whiten_coefs = whiten_matrix_bs @ bootstrap_selection                                               # so the whitened bootstrapped sample is whiten_coefs @ X
+                X_means = np.mean(X, axis = 1)                                                                      # X should be mean centered, but PCA_meg2 would mean centre the bootstrapped sample
+                X_whitened = (whiten_coefs.astype(X.dtype, copy = False) @ X) - (whiten_coefs @ X_means).astype(X.dtype)[:, np.newaxis]      # the only step that uses all the pixels (so in the precision of X).  
+                pca_success = True
+            except:
+                pca_success = False
+        else:
+            pca_needed = True
+            X_pca = X[input_ifg_args, :]                                                                              # bootstrapped smaple
     else:                                                                                                           # if we're not bootstrapping, need to work out if we actually need to do PCA
         if X_whitened is not None and dewhiten_matrix is not None:
             pca_needed = False
+            pca_success = True
+            if whiten_matrix is not None:
+                whiten_coefs = whiten_matrix[:n_comp,]
+            elif return_coefficients:
+                raise Exception(f"To return the sources as coefficients when 'X_whitened' is provided, 'whiten_matrix' must also be provided.  Exiting.  ")
         else:
             pca_needed = True
+            X_pca = X
+            bootstrap_selection = np.eye(n_ifgs)
             print(f"Even though bootstrapping is not being used, PCA is being performed.  "
                   f"This step could be sped up significantly by running PCA beforehand and "
                   f"computing 'X_whiten' and 'dewhiten_matrix' only once.  ")
@@ -1258,20 +2023,24 @@ def bootstrap_ICA(X, n_comp, bootstrap = True, ica_param = (1e-4, 150),
     # 1 get whitened data using PCA, if we need to (ie if X_whitened and dewhiten_matrix aren't provided)
     if pca_needed:
         try:
-            pca_vecs, _, _, dewhiten_matrix, _, _, X_whitened = PCA_meg2(X, verbose = False)                               # pca on bootstrapped data
+            pca_vecs, _, whiten_matrix_bs, dewhiten_matrix, _, _, X_whitened = PCA_meg2(X_pca, verbose = False, n_comp = n_comp)          # pca on bootstrapped data, only for the components that are used
+            whiten_coefs = whiten_matrix_bs[:n_comp,] @ bootstrap_selection                                                   # the whitened data are whiten_coefs @ X (X is mean centered)
             pca_success = True
         except:
             pca_success = False
-    else:
-        pca_success = True
             
     if pca_success:                                                                                         # If PCA was a success, do ICA (note, if not neeed, success is set to True)
         X_whitened = X_whitened[:n_comp,]                                                                                                       # reduce dimensionality ready for ICA
         try:                                                                                                                                    # try ICA, as it can occasionaly fail (nans etc)
             W, S, A_white, _, _, ica_success = fastica_MEG(X_whitened, n_comp=n_comp,  algorithm="parallel",        
-                                                           whiten=False, maxit=ica_param[1], tol = ica_param[0], verbose = verbose)         # do ICA
+                                                           whiten=False, maxit=ica_param[1], tol = ica_param[0], verbose = verbose,         # do ICA
+                                                           minibatch_param = minibatch_param)
             A = dewhiten_matrix[:,0:n_comp] @ A_white                                                                                       # turn ICA mixing matrix back into a time courses (ie dewhiten/ undo dimensonality reduction)
+            if return_coefficients:
+                S_coefs = (W @ whiten_coefs) / np.ptp(S, axis = 1)[:, np.newaxis]                                                         # S = W @ whiten_coefs @ X, and rescaled as per maps_tcs_rescale
             S, A = maps_tcs_rescale(S, A)                                                                                                   # rescale so spatial maps have a range or 1 (so easy to compare)
+            if return_coefficients:
+                S = S_coefs
         except:
             print(f"A FastICA run has failed, continuing anyway.  ")
             ica_success = False
@@ -1287,29 +2056,245 @@ def bootstrap_ICA(X, n_comp, bootstrap = True, ica_param = (1e-4, 150),
 #%%
 
 
-def pairwise_comparison(sources_r2):
+def pairwise_comparison(sources_r2, mixtures_gram = None, memory_budget = None):
     """ Compte the pairwise distances and similarities for ICA sources.  
         Note that this uses the absolute value of the similarities, so is invariant to sign flips of the data.  
+        As this returns two n_sources x n_sources matrices, pairwise_similarity (which returns one) is better for large numbers of sources.  
     Inputs:
-        sources_r2 | rank 2 array | sources as row vectors
+        sources_r2 | rank 2 array | sources as row vectors.  Can be a numpy memmap (see sources_store).  
+        mixtures_gram | rank 2 array or None | see pairwise_similarity
+        memory_budget | float or None | see pairwise_similarity
+    History:
+        2026_10_18 | AG | Add mixtures_gram, for sources that are coefficients of the mixtures.  
+        2026_10_18 | AG | Add memory_budget, to read the sources in blocks of pixels.  
+        2026_10_18 | AG | The similarities are made by pairwise_similarity, so only the distances are made here.  
     """
-    import numpy as np
-    
-    S = np.corrcoef(sources_r2)                                                  # Similarity matrix, Return Pearson product-moment correlation coefficients
-    S = np.abs(S)                                                                # covariance of 1 and -1 are equivalent for our case
+    S = pairwise_similarity(sources_r2, mixtures_gram, memory_budget)
     D = 1 - S                                                                   # convert to dissimilarity    
     return D, S
     
+
+def pairwise_similarity(sources_r2, mixtures_gram = None, memory_budget = None, dtype = 'float64'):
+    """ Compute the absolute value of the correlation between each pair of sources (so it is invariant to sign flips of the data), as a single 
+    n_sources x n_sources matrix.  The distances (1 - this) can be made from it in place (e.g. np.subtract(1, S, out = S)) if the similarities are 
+    no longer needed.  Each source is mean centered and normalised once, and then the correlations are accumulated over blocks of pixels using a 
+    symmetric rank k update (BLAS syrk), so only the upper triangle is computed.  
+    Inputs:
+        sources_r2 | rank 2 array | sources as row vectors.  Can be a numpy memmap (see sources_store).  
+        mixtures_gram | rank 2 array or None | If provided, sources_r2 are the coefficients that make the sources from some mean centered mixtures 
+                                               (i.e. sources = sources_r2 @ mixtures_mc), and this is mixtures_mc @ mixtures_mc.T.  The correlations 
+                                               are then computed without making the sources.  
+        memory_budget | float or None | If provided, sources_r2 is read in blocks of pixels of about this many bytes (as float64).  
+                                        Useful if sources_r2 is on disk.  If None, blocks of about the size of the returned matrix are used.  
+        dtype | string or numpy dtype | 'float64' or 'float32'.  The precision the correlations are accumulated and returned in.  
+    Returns:
+        S | rank 2 array | n_sources x n_sources, the absolute correlation between each pair of sources.  
+    History:
+        2026_10_18 | AG | Written.  Makes only the similarities (one n_sources x n_sources matrix), using a blocked syrk.  
+    """
+    import numpy as np
+    from scipy.linalg import blas
+    
+    dtype = np.dtype(dtype)
+    n_sources, n_pixels = sources_r2.shape
+    
+    if mixtures_gram is not None:                                                                       # the sources are coefficients, so only small matrices are needed
+        S = sources_r2 @ mixtures_gram @ sources_r2.T                                                   # covariances between the sources (up to a constant), which have zero mean as the mixtures do.  
+        sources_norm = np.sqrt(np.diag(S))
+        S /= sources_norm[:, np.newaxis]
+        S /= sources_norm[np.newaxis, :]                                                                # now correlations
+        S = S.astype(dtype, copy = False)
+    else:
+        if memory_budget is None:
+            n_pixels_block = max(n_sources, 4096)                                                       # blocks no bigger than S (unless S is small), so the copies of them don't dominate the memory used.  
+        else:
+            n_pixels_block = int(max(1, memory_budget // (8 * n_sources)))                              # number of pixels of all the sources that can be read at once.  
+        
+        # 1: get the mean and norm (once mean centered) of each source
+        sources_mean, sources_norm, pixel_blocks = sources_mean_and_norm(sources_r2, n_pixels_block)
+        
+        # 2: accumulate the correlations (upper triangle only) using the normalised sources
+        if dtype == np.float32:
+            syrk = blas.ssyrk
+        else:
+            syrk = blas.dsyrk
+        S = np.zeros((n_sources, n_sources), dtype = dtype, order = 'F')                                # Fortran order, so that syrk can update it in place.  
+        for pixel_block in pixel_blocks:
+            sources_block = np.array(sources_r2[:, pixel_block], dtype = dtype)                          # copy of this block of pixels
+            sources_block -= sources_mean[:, np.newaxis].astype(dtype)
+            sources_block /= sources_norm[:, np.newaxis].astype(dtype)                                  # mean centered, and normalised so the correlation is just the dot product.  
+            S = syrk(1.0, sources_block.T, beta = 1.0, c = S, trans = 1, lower = 0, overwrite_c = 1)     # S += sources_block @ sources_block.T, as sources_block.T is Fortran ordered no copy is needed.  
+        
+        # 3: copy the upper triangle to the lower triangle, in blocks of rows so that no large temporary arrays are needed.  
+        for row_start in range(0, n_sources, 1000):
+            row_stop = min(row_start + 1000, n_sources)
+            S[row_start:row_stop, :row_start] = S[:row_start, row_start:row_stop].T
+            S[row_start:row_stop, row_start:row_stop] = np.triu(S[row_start:row_stop, row_start:row_stop]) + np.triu(S[row_start:row_stop, row_start:row_stop], 1).T
+        S = S.T                                                                                         # as symmetric, the transpose is the same matrix, but C ordered.  
+        
+    np.abs(S, out = S)                                                                                  # correlations of 1 and -1 are equivalent for our case
+    np.minimum(S, 1, out = S)                                                                           # as per np.corrcoef
+    return S
  
 
 
+def sources_mean_and_norm(sources_r2, n_pixels_block):
+    """ Get the mean of each source, and its norm once mean centered, by reading the sources in blocks of pixels.  
+    Inputs:
+        sources_r2 | rank 2 array | sources as row vectors.  Can be a numpy memmap (see sources_store).  
+        n_pixels_block | int | number of pixels of all the sources that are read at once.  
+    Returns:
+        sources_mean | rank 1 array | mean of each source.  
+        sources_norm | rank 1 array | norm of each source once mean centered.  
+        pixel_blocks | list of slices | the blocks of pixels that were used.  
+    History:
+        2026_10_18 | AG | Written, so that knn_similarity_graph and pairwise_similarity normalise the sources in the same way.  
+    """
+    import numpy as np
+    
+    n_sources, n_pixels = sources_r2.shape
+    pixel_blocks = [slice(pixel_start, pixel_start + n_pixels_block) for pixel_start in range(0, n_pixels, n_pixels_block)]
+    sources_sum = np.zeros(n_sources)
+    sources_sum_squares = np.zeros(n_sources)
+    for pixel_block in pixel_blocks:
+        sources_block = np.asarray(sources_r2[:, pixel_block], dtype = np.float64)
+        sources_sum += np.sum(sources_block, axis = 1)
+        sources_sum_squares += np.einsum('ij,ij->i', sources_block, sources_block)
+    sources_mean = sources_sum / n_pixels
+    sources_norm = np.sqrt(sources_sum_squares - n_pixels * sources_mean**2)
+    return sources_mean, sources_norm, pixel_blocks
+    
+
+
+def knn_similarity_graph(sources_r2, n_neighbours, mixtures_gram = None, approximate = False, memory_budget = 1e9, dtype = 'float64'):
+    """ Compute the absolute value of the correlation (as per pairwise_similarity) between each source and only its n_neighbours most similar 
+    sources, as a sparse matrix.  This is O(n_sources x n_neighbours) in memory, rather than O(n_sources**2).  The neighbours can either be 
+    found exactly (by comparing all the sources, in blocks), or approximately by comparing random projections of the sources and then computing 
+    the similarities exactly for only the best 3 x n_neighbours candidates.  The graph is made symmetric (i.e. if a is a neighbour of b, b is also
+    a neighbour of a), and if it has more than one connected component these are joined by edges of similarity 0.  
+    Inputs:
+        sources_r2 | rank 2 array | sources as row vectors.  Can be a numpy memmap (see sources_store).  
+        n_neighbours | int | number of neighbours to find for each source.  
+        mixtures_gram | rank 2 array or None | see pairwise_similarity.  
+        approximate | boolean | If True, the neighbours are found using random projections of the sources (see above).  
+        memory_budget | float | sources_r2 is read in blocks of about this many bytes (and the blocks of similarities computed are also about this size).  
+        dtype | string or numpy dtype | 'float64' or 'float32'.  The precision the correlations are computed in.  
+    Returns:
+        S | sparse csr matrix | n_sources x n_sources, the absolute correlation between each source and its neighbours.  The diagonal is not stored.  
+    History:
+        2026_10_18 | AG | Written
+    """
+    import numpy as np
+    from scipy import sparse
+    from scipy.sparse.csgraph import connected_components
+    
+    def neighbours_from_similarities(S_rows, row_start, n_neighbours):
+        """ Given a block of rows of the similarity matrix (for sources row_start onwards), find the n_neighbours most similar in each row 
+        (excluding the source itself).  
+        """
+        n_rows = S_rows.shape[0]
+        S_rows[np.arange(n_rows), np.arange(row_start, row_start + n_rows)] = -np.inf                            # so a source is never its own neighbour
+        neighbour_args = np.argpartition(-S_rows, n_neighbours - 1, axis = 1)[:, :n_neighbours]                  # most similar n_neighbours in each row (unsorted)
+        return neighbour_args, np.take_along_axis(S_rows, neighbour_args, axis = 1)
+    
+    dtype = np.dtype(dtype)
+    n_sources, n_pixels = sources_r2.shape
+    n_neighbours = int(min(n_neighbours, n_sources - 1))
+    n_rows_block = int(max(1, memory_budget // (8 * n_sources)))                                                # number of rows of the full similarity matrix that are computed at once
+    
+    # 1: Get a representation of each source (as a row vector) in which the dot product between them is their correlation.  
+    if mixtures_gram is not None:                                                                               # the sources are coefficients, so only small matrices are needed
+        gram_vals, gram_vecs = np.linalg.eigh(mixtures_gram)
+        sources_features = sources_r2 @ (gram_vecs * np.sqrt(np.abs(gram_vals)))                                # sources_features @ sources_features.T = sources_r2 @ mixtures_gram @ sources_r2.T
+        sources_features /= np.linalg.norm(sources_features, axis = 1)[:, np.newaxis]
+        sources_features = sources_features.astype(dtype)
+    else:
+        n_pixels_block = int(max(1, memory_budget // (8 * n_sources)))                                          # number of pixels of all the sources that can be read at once.  
+        sources_mean, sources_norm, pixel_blocks = sources_mean_and_norm(sources_r2, n_pixels_block)
+        
+        def normalised_sources_block(pixel_block, rows = slice(None)):
+            """ Get a block of pixels of the sources, mean centered and normalised so the correlations are just dot products.  
+            """
+            sources_block = np.array(sources_r2[rows, pixel_block], dtype = dtype)
+            sources_block -= sources_mean[rows, np.newaxis].astype(dtype)
+            sources_block /= sources_norm[rows, np.newaxis].astype(dtype)
+            return sources_block
+        
+        if approximate:
+            n_projection = int(min(n_pixels, max(64, 2 * n_neighbours)))                                         # number of dimensions of the random projection
+            random_state = np.random.RandomState(np.random.randint(0, 2**31 - 1))
+            sources_features = np.zeros((n_sources, n_projection), dtype = dtype)
+            for pixel_block in pixel_blocks:
+                sources_block = normalised_sources_block(pixel_block)
+                projection = random_state.normal(size = (sources_block.shape[1], n_projection)).astype(dtype)
+                sources_features += sources_block @ projection                                                   # dot products are approximately preserved (up to a constant)
+            sources_features /= np.linalg.norm(sources_features, axis = 1)[:, np.newaxis]                       # which is removed by normalising again.  
+        else:
+            sources_features = None                                                                              # the sources themselves are used, read in blocks.  
+
+    # 2: Find the neighbours of each source
+    if approximate and (mixtures_gram is None):
+        n_candidates = int(min(3 * n_neighbours, n_sources - 1))                                                # candidates from the random projections, for which the similarities are then computed exactly.  
+    else:
+        n_candidates = n_neighbours
+    neighbour_args = np.zeros((n_sources, n_candidates), dtype = np.int64)
+    neighbour_S = np.zeros((n_sources, n_candidates), dtype = dtype)
+    for row_start in range(0, n_sources, n_rows_block):
+        rows = slice(row_start, min(row_start + n_rows_block, n_sources))
+        if sources_features is not None:
+            S_rows = np.abs(sources_features[rows] @ sources_features.T)
+        else:
+            S_rows = np.zeros((rows.stop - rows.start, n_sources), dtype = dtype)
+            for pixel_block in pixel_blocks:
+                sources_block = normalised_sources_block(pixel_block)
+                S_rows += sources_block[rows] @ sources_block.T
+            np.abs(S_rows, out = S_rows)
+        neighbour_args[rows], neighbour_S[rows] = neighbours_from_similarities(S_rows, row_start, n_candidates)
+    
+    if approximate and (mixtures_gram is None):                                                                 # compute the similarities to the candidates exactly, then keep the best.  
+        neighbour_S = np.zeros((n_sources, n_candidates), dtype = dtype)
+        n_rows_refine = int(max(1, memory_budget // (8 * n_candidates * n_pixels_block)))                       # number of sources whose candidates can be compared at once.  
+        for pixel_block in pixel_blocks:
+            sources_block = normalised_sources_block(pixel_block)
+            for row_start in range(0, n_sources, n_rows_refine):
+                rows = slice(row_start, min(row_start + n_rows_refine, n_sources))
+                neighbour_S[rows] += np.einsum('ip,icp->ic', sources_block[rows], sources_block[neighbour_args[rows]])
+        np.abs(neighbour_S, out = neighbour_S)
+        best_candidates = np.argpartition(-neighbour_S, n_neighbours - 1, axis = 1)[:, :n_neighbours]
+        neighbour_args = np.take_along_axis(neighbour_args, best_candidates, axis = 1)
+        neighbour_S = np.take_along_axis(neighbour_S, best_candidates, axis = 1)
+    np.minimum(neighbour_S, 1, out = neighbour_S)                                                               # as per np.corrcoef
+    
+    # 3: Make the graph symmetric, with each edge only once.  
+    rows_all = np.concatenate((np.repeat(np.arange(n_sources), n_neighbours), np.ravel(neighbour_args)))
+    cols_all = np.concatenate((np.ravel(neighbour_args), np.repeat(np.arange(n_sources), n_neighbours)))
+    S_all = np.concatenate((np.ravel(neighbour_S), np.ravel(neighbour_S)))
+    _, edge_args = np.unique(rows_all * n_sources + cols_all, return_index = True)                             # each edge (i.e. i to j) once, sorted by row then column
+    rows_all, cols_all, S_all = rows_all[edge_args], cols_all[edge_args], S_all[edge_args]
+    
+    # 4: Join any disconnected parts of the graph (so that it can be used by HDBSCAN), by an edge of similarity 0 between the first source in each.  
+    edges = sparse.csr_matrix((np.ones(rows_all.shape[0]), (rows_all, cols_all)), shape = (n_sources, n_sources))
+    n_components, component_labels = connected_components(edges, directed = False)
+    if n_components > 1:
+        component_firsts = np.unique(component_labels, return_index = True)[1]                                  # first source in each component
+        rows_all = np.concatenate((rows_all, component_firsts[:-1], component_firsts[1:]))
+        cols_all = np.concatenate((cols_all, component_firsts[1:], component_firsts[:-1]))
+        S_all = np.concatenate((S_all, np.zeros(2 * (n_components - 1), dtype = dtype)))                        # similarity of 0, but stored (unlike all the similarities between sources that aren't neighbours)
+    S = sparse.csr_matrix((S_all, (rows_all, cols_all)), shape = (n_sources, n_sources))
+    S.sort_indices()
+    return S
+
+
+
 #%%
 
-def sources_list_to_r2_r3(sources, mask = None):
+def sources_list_to_r2_r3(sources, mask = None, out = None):
     """A function to convert a list of the outputs of multiple ICA runs (which are lists) into rank 2 and rank 3 arrays.  
     Inputs:
         sources | list | list of runs of ica (e.g. 10, or 20 etc.), each item would be n_sources x n_pixels
         mask | boolean | Only needed for two_d.  Converts row vector back to masked array.  
+        out | rank 3 array or None | if provided (e.g. a memmap of n_sources_total x height x width), sources_r3 is written to this rather than 
+                                     a new array.  For many large sources, lazy_sources_r3 can be used instead to make each image only when it's needed.  
     Outputs:
         sources_r2 | rank 2 array | each source as a row vector (e.g. n_sources_total x n_pixels)
         sources_r3 | rank 3 masked array | each source as a rank 2 image. (e.g. n_souces_total x source_height x source_width )
@@ -1317,28 +2302,15 @@ def sources_list_to_r2_r3(sources, mask = None):
         2018_06_29 | MEG | Written
         2020/08/27 | MEG | Update to handle both 1d and 2d signals.  
         2020/09/11 | MEG | Change sources_r3 so that it's now a masked array (sources_r3_ma)
-       
+        2026_10_18 | AG | Join the runs with np.concatenate, and make sources_r3 with one scatter (mask_pixels.scatter_ma) rather than a loop over the sources.  Add out, so sources_r3 can be a memmap.  
     
     """
     import numpy as np
-    import numpy.ma as ma
-    from icasar.aux1 import col_to_ma
-    
-    
-    n_converge_needed = len(sources)
-    n_comp = np.size(sources[0], axis = 0)
-    n_pixels = np.size(sources[0], axis = 1)
+    from icasar.aux1 import mask_pixels
     
-    sources_r2 = np.zeros(((n_converge_needed * n_comp), n_pixels))                # convert from list to one big array
-    for i in range(n_converge_needed):    
-        sources_r2[i*n_comp:((i*n_comp) + n_comp), :] = sources[i]
-    n_sources_total = np.size(sources_r2, axis = 0)
-
+    sources_r2 = np.concatenate(sources, axis = 0)                                          # convert from list to one big array
     if mask is not None:
-        sources_r3 = ma.zeros((col_to_ma(sources_r2[0,:], mask).shape))[np.newaxis, :, :]               # get the size of one image (so rank 2)
-        sources_r3 = ma.repeat(sources_r3, n_sources_total, axis = 0)                                    # and then extend to make rank 3
-        for i in range(n_sources_total):
-            sources_r3[i,:,:] = col_to_ma(sources_r2[i,:], mask)   
+        sources_r3 = mask_pixels(mask).scatter_ma(sources_r2, out)
     else:
         sources_r3 = None
     return sources_r2, sources_r3
@@ -1347,32 +2319,116 @@ def sources_list_to_r2_r3(sources, mask = None):
 
 #%%
 
-def cluster_quality_index(labels, S):
+class sources_store():
+    """ A store for the sources recovered by all the runs of FastICA, as a single rank 2 array (n_sources_total x n_pixels) that is 
+    filled as each run converges.  This avoids keeping a list of the sources from each run as well as copies of these as rank 2 and 
+    rank 3 arrays, and the array can be a numpy memmap (so is on disk, and only the parts being used are read into RAM) and float32.  
+    Inputs:
+        n_sources_total | int | number of sources that will be stored (e.g. n_comp x n_runs)
+        n_pixels | int | number of pixels in each source.  
+        path | Path or None | If provided, the sources are stored in this .npy file, which can be opened again with np.load(path, mmap_mode = 'r').  
+                              If None, they are stored in RAM.  
+        dtype | string or numpy dtype | e.g. 'float32' to halve the size of the sources.  
+    History:
+        2026_10_18 | AG | Written
+    """
+    def __init__(self, n_sources_total, n_pixels, path = None, dtype = 'float64'):
+        import numpy as np
+        if path is None:
+            self.sources_all = np.zeros((n_sources_total, n_pixels), dtype = dtype)
+        else:
+            self.sources_all = np.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = (n_sources_total, n_pixels))
+        self.n_sources = 0                                                                          # number of sources that have been stored so far.  
+        
+    def append(self, sources):
+        """ Store the sources from one run (n_comp x n_pixels), and return a view of them in the store.  
+        """
+        n_comp = sources.shape[0]
+        self.sources_all[self.n_sources : self.n_sources + n_comp, :] = sources
+        self.n_sources += n_comp
+        return self.sources_all[self.n_sources - n_comp : self.n_sources, :]
+    
+    @property
+    def sources_r2(self):
+        """ All the sources that have been stored, as row vectors.  
+        """
+        return self.sources_all[:self.n_sources, :]
+    
+    def flush(self):
+        """ Write any changes to disk (if a memmap).  
+        """
+        if hasattr(self.sources_all, 'flush'):
+            self.sources_all.flush()
+
+
+
+#%%
+
+def cluster_quality_index(labels, S, similarity_sums = None):
     """
     A function to calculate the cluster quality index (Iq).  If a cluster has only one element in it,
     the cluster quality index is set to nan (np.nan)
     Inputs:
         labels | rank 1 array | label number for each data point
-        S | rank 2 array | similiarit between each data point 
+        S | rank 2 array | similiarit between each data point.  Can be sparse (e.g. from knn_similarity_graph), in which case missing similarities are 0.  
+        similarity_sums | tuple or None | the outputs of cluster_similarity_sums, if they have already been computed.  
     Returns:
         Iq | list | cluster quality index 
     2018_05_28 | written
     2018_05_30 | if clusters have only one point in them, set Iq to 0
+    2026_10_18 | also work with a sparse S (e.g. from knn_similarity_graph), in which missing similarities are 0 and the diagonal isn't stored.  
+    2026_10_18 | compute from the sums of the similarities in and between clusters (cluster_similarity_sums), rather than looping through the clusters.  
     """
     import numpy as np
-   
-    Iq = []                                                                                         # initiate cluster quality index
-    for i in np.unique(labels):                                                                     # loop through each label (there will be as many loops here as there are clusters)
-        labels_1cluster = np.ravel(np.argwhere(labels == i))
-        if np.size(labels_1cluster) < 2:                                                            # check if cluster has only one point in it
-            Iq_temp = np.nan
-        else:
-            S_intra = np.copy(S[labels_1cluster, :][:,labels_1cluster])                                 # The similarties between the items in the cluster
-            S_intra = np.where(np.eye(np.size(S_intra, axis = 0)) == 1, np.nan, S_intra)                # change the diagonals to nans
-            S_inter = np.copy(S[labels_1cluster, :])                                                    # The similarties between the items in the cluster and those out of the cluster
-            S_inter = np.delete(S_inter, labels_1cluster, axis = 1)                                     # horizontal axis remove similarities with itself
-            Iq_temp = np.nanmean(S_intra) - np.mean(S_inter)                                         # Iq is the difference between the mean of the distances inside the cluster, and the mean distance between items in the cluster and out of the cluster
-        Iq.append(Iq_temp)                                                                          # append whichever value of Iq (np.nan or a numeric value)
-    return Iq
+    
+    if similarity_sums is None:
+        similarity_sums = cluster_similarity_sums(labels, S)
+    _, S_intra_sums, S_inter_sums, n_points_clusters = similarity_sums
+    n_points = S.shape[0]
+    
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        S_intra_means = S_intra_sums / (n_points_clusters * (n_points_clusters - 1))                            # mean similarity between items in each cluster (excluding items with themselves)
+        S_inter_means = S_inter_sums / (n_points_clusters * (n_points - n_points_clusters))                     # mean similarity between items in each cluster and those out of it (nan if there are none)
+    Iq = S_intra_means - S_inter_means                                                                          # Iq is the difference between the mean of the distances inside the cluster, and the mean distance between items in the cluster and out of the cluster
+    Iq[n_points_clusters < 2] = np.nan                                                                          # clusters with only one point in have no Iq
+    return list(Iq)
+
+
+
+def cluster_similarity_sums(labels, S):
+    """ For each cluster, compute the sums of the similarities between items in it, and between items in it and those not in it, and for each item, 
+    the sum of its similarities with the items in its cluster.  These are computed using products of S with a (sparse) indicator matrix of the 
+    labels, so no parts of S are copied.  
+    Inputs:
+        labels | rank 1 array | label number for each data point
+        S | rank 2 array | similiarit between each data point, so symmetric.  Can be sparse (e.g. from knn_similarity_graph), in which case missing similarities are 0.  
+    Returns:
+        S_point_intra_sums | rank 1 array | for each item, the sum of its similarities with all the items in its cluster (including itself).  
+        S_intra_sums | rank 1 array | for each cluster (in the order of np.unique(labels)), the sum of the similarities between items in it (excluding items with themselves).  
+        S_inter_sums | rank 1 array | for each cluster, the sum of the similarities between items in it and items not in it.  
+        n_points_clusters | rank 1 array | for each cluster, the number of items in it.  
+    History:
+        2026_10_18 | AG | Written
+    """
+    import numpy as np
+    from scipy import sparse
+    
+    n_points = S.shape[0]
+    cluster_labels, label_args, n_points_clusters = np.unique(labels, return_inverse = True, return_counts = True)
+    label_args = np.ravel(label_args)
+    indicator = sparse.csr_matrix((np.ones(n_points, dtype = S.dtype), (label_args, np.arange(n_points))),
+                                  shape = (cluster_labels.shape[0], n_points))                                # n_clusters x n_points, 1 if the point is in the cluster.  Same dtype as S, so that S isn't copied.  
+    S_cluster_sums = indicator @ S                                                                          # n_clusters x n_points, the sum of the similarities between each point and all the points in each cluster
+    if sparse.issparse(S_cluster_sums):
+        S_cluster_sums = S_cluster_sums.toarray()
+    S_cluster_sums = np.asarray(S_cluster_sums, dtype = np.float64)
+    
+    S_point_intra_sums = S_cluster_sums[label_args, np.arange(n_points)]                                   # similarity between each point and the points in its own cluster.  
+    S_cluster_total_sums = np.sum(S_cluster_sums, axis = 1)                                                # similarity between the points in each cluster and all points.  
+    S_intra_sums_diagonal = np.bincount(label_args, weights = np.asarray(S.diagonal(), dtype = np.float64), minlength = cluster_labels.shape[0])  
+    S_intra_sums = np.bincount(label_args, weights = S_point_intra_sums, minlength = cluster_labels.shape[0])
+    S_inter_sums = S_cluster_total_sums - S_intra_sums
+    S_intra_sums -= S_intra_sums_diagonal                                                                   # remove the similarities of points with themselves (not stored if S is sparse)
+    return S_point_intra_sums, S_intra_sums, S_inter_sums, n_points_clusters
 
   
@@ -0,0 +1,71 @@
+#-------------------------------------------------------------------
+# Date: 2026/10/18
+# Function:
+#   Time the iterations of parallel FastICA (fastica_MEG, with whiten = False as in ICASAR), and
+#   measure the memory they allocate, for increasing numbers of samples (pixels).  The previous
+#   version of the loop (which made new arrays for W @ X, g and gprime each iteration, used
+#   np.diag(...) @ W, np.asmatrix in the decorrelation, and always recorded the history) is
+#   copied below, so the two can be compared.  tol = 0 so that both perform maxit - 1 iterations.
+#   The memory is the peak traced by tracemalloc, above the data.
+#-------------------------------------------------------------------
+import time
+import tracemalloc
+import numpy as np
+from scipy import linalg
+
+from icasar.blind_signal_separation import fastica_MEG
+
+n_samples_all = [10000, 100000, 1000000]
+n_comp = 5
+maxit = 51                                                                                  # so 50 iterations are performed
+dtypes = ['float64', 'float32']
+
+
+def ica_par_previous(X, maxit, w_init, alpha = 1.0):
+    """ The parallel FastICA loop as it was, with logcosh, and tol = 0.  """
+    def _sym_decorrelation(W):
+        s, u = linalg.eigh(W @ W.T)
+        u, W = [np.asmatrix(e) for e in (u, W)]
+        W = (u * np.diag(1.0/np.sqrt(s)) * u.T) * W
+        return np.asarray(W)
+    n, p = X.shape
+    W = _sym_decorrelation(w_init)
+    hist_lim = np.zeros((1, maxit))
+    hist_W = np.zeros((w_init.size, maxit))
+    it = 0
+    while it < (maxit-1):
+        wtx = W.astype(X.dtype, copy = False) @ X
+        gwtx = np.tanh(alpha * wtx)
+        g_wtx = alpha * (1 - (np.tanh(alpha * wtx))**2)
+        W1 = (gwtx @ X.T)/float(p) - ((np.diag(g_wtx.mean(axis=1))) @ W)
+        W1 = _sym_decorrelation(W1)
+        lim = max(abs(abs(np.diag(W1 @ W.T)) - 1))
+        W = W1
+        it += 1
+        hist_lim[0,it] = lim
+        hist_W[:,it] = np.ravel(W)
+    return W
+
+
+def ica_par_current(X, maxit, w_init):
+    return fastica_MEG(X, n_comp, whiten = False, maxit = maxit, tol = 0, w_init = w_init, verbose = False)[0]
+
+
+print(f"{'n_samples':>10}{'dtype':>9}{'previous (ms/it)':>18}{'current (ms/it)':>17}{'previous (MB)':>15}{'current (MB)':>14}{'max |W diff|':>14}")
+for n_samples in n_samples_all:
+    for dtype in dtypes:
+        rng = np.random.RandomState(0)
+        X = (rng.laplace(size = (n_comp, n_samples)) / np.sqrt(2)).astype(dtype)           # unit variance, like whitened data
+        w_init = rng.normal(size = (n_comp, n_comp))
+        results = {}
+        for name, ica_par in [('previous', ica_par_previous), ('current', ica_par_current)]:
+            ica_par(X, 3, w_init)                                                           # warm up
+            tracemalloc.start()
+            t_start = time.perf_counter()
+            W = ica_par(X, maxit, w_init)
+            t_iteration = (time.perf_counter() - t_start) / (maxit - 1)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = (W, t_iteration, peak)
+        print(f"{n_samples:>10}{dtype:>9}{1e3 * results['previous'][1]:>18.2f}{1e3 * results['current'][1]:>17.2f}"
+              f"{results['previous'][2] / 1e6:>15.1f}{results['current'][2] / 1e6:>14.1f}{np.max(np.abs(results['previous'][0] - results['current'][0])):>14.1e}")
@@ -0,0 +1,64 @@
+#-------------------------------------------------------------------
+# Date: 2026/10/18
+# Function:
+#   Make a synthetic set of LiCSBAS outputs (cum.h5, the LiCSBAS mask, the DEM, and the E N U files) for
+#   a large frame in a temporary folder, then open it with LiCSBAS_to_ICASAR for the whole frame and for
+#   a small crop (e.g. a volcano), printing the time and peak memory (as traced by tracemalloc) of each.
+#   The cropped outputs are also checked against cropping the whole frame.
+#-------------------------------------------------------------------
+import time
+import tempfile
+import tracemalloc
+from pathlib import Path
+from datetime import date, timedelta
+import numpy as np
+import h5py as h5
+
+from icasar.icasar_funcs import LiCSBAS_to_ICASAR
+
+ny, nx = 2000, 2500
+n_acq = 40
+crop_pixels = (1200, 1400, 800, 1000)                                                       # x start x stop y start y stop
+
+with tempfile.TemporaryDirectory() as temp_folder:
+    # 1: make the LiCSBAS outputs
+    LiCSBAS_out_folder = Path(temp_folder)
+    (LiCSBAS_out_folder / 'TS_GEOCml1' / 'results').mkdir(parents = True)
+    (LiCSBAS_out_folder / 'GEOCml1').mkdir()
+    rng = np.random.RandomState(0)
+    with h5.File(LiCSBAS_out_folder / 'TS_GEOCml1' / 'cum.h5', 'w') as cumh5:
+        cumh5['imdates'] = np.array([(date(2020, 1, 1) + timedelta(days = 12 * acq_n)).strftime('%Y%m%d').encode() for acq_n in range(n_acq)])
+        cum = cumh5.create_dataset('cum', shape = (n_acq, ny, nx), dtype = np.float32)
+        cum_acq = np.zeros((ny, nx), dtype = np.float32)
+        for acq_n in range(n_acq):                                                          # one acquisition at a time, in mm
+            cum_acq += rng.randn(ny, nx).astype(np.float32)
+            cum_acq[:100, :] = np.nan                                                       # e.g. incoherent in all acquisitions
+            cum[acq_n] = cum_acq
+        cumh5['refarea'] = b'500:510/600:610'
+        for name, value in zip(['corner_lon', 'corner_lat', 'post_lon', 'post_lat'], [14.0, 41.0, 0.001, -0.001]):
+            cumh5[name] = value
+    np.ones((ny, nx), dtype = np.float32).tofile(LiCSBAS_out_folder / 'TS_GEOCml1' / 'results' / 'mask')
+    hgt = rng.rand(ny, nx).astype(np.float32)
+    hgt[-100:, :] = np.nan                                                                   # e.g. the sea
+    hgt.tofile(LiCSBAS_out_folder / 'GEOCml1' / 'hgt')
+    for component in ['E', 'N', 'U']:
+        rng.rand(ny, nx).astype(np.float32).tofile(LiCSBAS_out_folder / 'GEOCml1' / f"{component}.geo")
+    with open(LiCSBAS_out_folder / 'GEOCml1' / 'slc.mli.par', 'w') as f:
+        f.write(f"range_samples:   {nx}\nazimuth_lines:   {ny}\n")
+    print(f"{n_acq} acquisitions of {ny} x {nx} pixels ({n_acq * ny * nx * 4 / 1e6:.0f}MB in cum.h5).  ")
+
+    # 2: open it
+    results = {}
+    for name, crop in [('whole frame', None), ('cropped', crop_pixels)]:
+        tracemalloc.start()
+        t_start = time.time()
+        displacement_r2, _, _ = LiCSBAS_to_ICASAR(LiCSBAS_out_folder, crop_pixels = crop)
+        results[name] = displacement_r2
+        print(f"{name:>12}: {time.time() - t_start:.1f}s, with a peak memory of {tracemalloc.get_traced_memory()[1] / 1e6:.0f}MB.  ")
+        tracemalloc.stop()
+
+whole, cropped = results['whole frame'], results['cropped']
+window = (slice(crop_pixels[2], crop_pixels[3]), slice(crop_pixels[0], crop_pixels[1]))
+whole_cropped = np.zeros((n_acq - 1, ny, nx))
+whole_cropped[:, ~whole['mask']] = whole['incremental']
+print(f"Cropped outputs are the same as cropping the whole frame: {np.array_equal(whole_cropped[:, window[0], window[1]][:, ~cropped['mask']], cropped['incremental'])}")
@@ -0,0 +1,65 @@
+#-------------------------------------------------------------------
+# Date: 2026/10/18
+# Function:
+#   Time converting many sources from row vectors to images, using the previous loop (col_to_ma for each
+#   source) and mask_pixels (which does them all in one step), both to a new masked array and into a
+#   memmap on disk.  The time to make single images with lazy_sources_r3 (as the hover callback of
+#   plot_2d_interactive_fig does) is also printed, as is the peak memory (traced by tracemalloc) of making the masked arrays, and the results are checked against the loop.
+#-------------------------------------------------------------------
+import time
+import tracemalloc
+import tempfile
+from pathlib import Path
+import numpy as np
+import numpy.ma as ma
+
+from icasar.aux1 import col_to_ma, mask_pixels, lazy_sources_r3
+
+ny, nx = 1000, 1000
+n_sources = 100
+
+
+def sources_r3_previous(sources_r2, mask):
+    """ How sources_list_to_r2_r3 and r2_to_r3 made the rank 3 masked array.  """
+    sources_r3 = ma.repeat(ma.zeros(mask.shape)[np.newaxis, :, :], sources_r2.shape[0], axis = 0)
+    for i in range(sources_r2.shape[0]):
+        sources_r3[i, :, :] = col_to_ma(sources_r2[i, :], mask)
+    return sources_r3
+
+
+rng = np.random.RandomState(0)
+yy, xx = np.mgrid[0:ny, 0:nx]
+mask = ((xx - 400)**2 + (yy - 600)**2) < 200**2                                             # e.g. a lake
+mask[:100, :] = True                                                                        # and the sea
+sources_r2 = rng.randn(n_sources, np.sum(~mask)).astype(np.float32)
+print(f"{n_sources} sources of {sources_r2.shape[1]} pixels ({ny} x {nx} images).  ")
+
+tracemalloc.start()
+t_start = time.perf_counter()
+r3_previous = sources_r3_previous(sources_r2, mask)
+print(f"{'col_to_ma loop':>24}: {time.perf_counter() - t_start:.2f}s, with a peak memory of {tracemalloc.get_traced_memory()[1] / 1e6:.0f}MB")
+tracemalloc.reset_peak()
+
+t_start = time.perf_counter()
+pixels = mask_pixels(mask)
+r3_new = pixels.scatter_ma(sources_r2)
+print(f"{'mask_pixels':>24}: {time.perf_counter() - t_start:.2f}s, with a peak memory of {(tracemalloc.get_traced_memory()[1] - r3_previous.nbytes - r3_previous.mask.nbytes) / 1e6:.0f}MB")
+tracemalloc.stop()
+
+with tempfile.TemporaryDirectory() as temp_folder:
+    out = np.lib.format.open_memmap(Path(temp_folder) / 'sources_r3.npy', mode = 'w+', dtype = np.float32, shape = (n_sources, ny, nx))
+    t_start = time.perf_counter()
+    r3_memmap = pixels.scatter_ma(sources_r2, out)
+    out.flush()
+    print(f"{'mask_pixels (to memmap)':>24}: {time.perf_counter() - t_start:.2f}s")
+    same_memmap = np.array_equal(ma.getdata(r3_memmap), ma.getdata(r3_previous))
+    del r3_memmap, out
+
+sources_lazy = lazy_sources_r3(sources_r2, mask)
+t_start = time.perf_counter()
+for source_n in range(n_sources):
+    sources_lazy[source_n]
+print(f"{'lazy_sources_r3':>24}: {1e3 * (time.perf_counter() - t_start) / n_sources:.1f}ms per source")
+
+print(f"Same as the loop: {np.array_equal(ma.getdata(r3_new), ma.getdata(r3_previous)) and np.array_equal(r3_new.mask, r3_previous.mask)} (masked array), "
+      f"{same_memmap} (memmap), {np.array_equal(sources_lazy[5].filled(0), r3_previous[5].filled(0))} (lazy_sources_r3)")
@@ -0,0 +1,73 @@
+#-------------------------------------------------------------------
+# Date: 2026/10/18
+# Function:
+#   Compare the runs of FastICA made by ICASAR with and without minibatch_param (first iterating with
+#   random selections of the pixels), for several batch sizes.  For each, the time taken by the runs
+#   and the correlation of each centrotype with the most similar one found without minibatches
+#   are printed.  The data are those of example_spatial_01.py (synthetic_data.pkl, if it's in this
+#   folder), and a larger synthetic frame of a million pixels with as many signals as components (so that
+#   each centrotype is a signal, rather than a cluster of noise that can be any rotation).  The runs without
+#   bootstrapping are batched, and share their selections of the pixels.  The sources are kept as the coefficients
+#   that make them from the mixtures (sources_as_coefficients in ICASAR), so they fit in memory.
+#-------------------------------------------------------------------
+import time
+import pickle
+from pathlib import Path
+import numpy as np
+
+from icasar.icasar_funcs import perform_multiple_ICA_runs, bootstrapped_sources_to_centrotypes, sources_list_to_r2_r3
+from icasar.blind_signal_separation import PCA_meg2
+
+n_comp = 5
+bootstrapping_param = (40, 10)
+ica_param = (1e-4, 150)
+hdbscan_param = (20, 10)
+tsne_param = (30, 12)
+minibatch_params = [None, (2000, 4), (10000, 4), (50000, 4), (10000, 1)]                    # None is without minibatches, which the others are compared to.
+
+
+def synthetic_frame(n_ifgs = 40, ny = 1000, nx = 1000):
+    """ Five spatial signals (two deformation patterns, a ramp, something like a turbulent atmosphere, and a step) mixed with random time courses, plus noise.  """
+    rng = np.random.RandomState(0)
+    yy, xx = np.mgrid[0:ny, 0:nx] / ny
+    signals = np.stack((np.exp(-((xx - 0.4)**2 + (yy - 0.5)**2) / 0.01), np.exp(-((xx - 0.8)**2 + (yy - 0.2)**2) / 0.002), yy,
+                        np.sin(8 * xx) * np.cos(6 * yy), (xx > 0.6).astype(float)))
+    signals_r2 = np.reshape(signals, (signals.shape[0], -1))
+    return rng.randn(n_ifgs, signals.shape[0]) @ signals_r2 + 0.05 * rng.randn(n_ifgs, ny * nx)
+
+
+datasets = {}
+if Path('synthetic_data.pkl').exists():
+    with open('synthetic_data.pkl', 'rb') as f:
+        A_dc = pickle.load(f)
+        S_synth = pickle.load(f)
+        N_dc = pickle.load(f)
+    datasets['example_spatial_01'] = A_dc @ S_synth + N_dc
+else:
+    print(f"synthetic_data.pkl (the data for example_spatial_01.py) wasn't found, so only the synthetic frame will be used.  ")
+datasets['synthetic_frame'] = synthetic_frame()
+
+for dataset_name, X in datasets.items():
+    X_mc = X - np.mean(X, axis = 1)[:, np.newaxis]
+    _, _, whiten_mat, dewhiten_mat, _, _, X_white = PCA_meg2(X_mc)
+    print(f"\n{dataset_name}: {X_mc.shape[0]} interferograms of {X_mc.shape[1]} pixels.  ")
+    results = []
+    for minibatch_param in minibatch_params:
+        np.random.seed(0)
+        t_start = time.time()
+        S_hist, _ = perform_multiple_ICA_runs(n_comp, X_mc, bootstrapping_param, ica_param, X_white, dewhiten_mat, ica_verbose = 'short',
+                                              sources_as_coefficients = True, whiten_matrix = whiten_mat, minibatch_param = minibatch_param)
+        t_runs = time.time() - t_start
+        sources_r2, _ = sources_list_to_r2_r3(S_hist)
+        S_best = bootstrapped_sources_to_centrotypes(sources_r2, hdbscan_param, tsne_param, mixtures_mc = X_mc, tsne_mode = 'lazy')[0]
+        results.append((minibatch_param, t_runs, S_best))
+
+    print(f"\n{'minibatch_param':>16}{'time (s)':>10}{'speed up':>10}   correlation of each centrotype with the most similar one without minibatches")
+    S_reference = results[0][2]
+    for minibatch_param, t_runs, S_best in results:
+        if (S_best is None) or (S_reference is None):
+            correlations = 'no clusters found'
+        else:
+            correlations = np.max(np.abs(np.corrcoef(S_reference, S_best)[:S_reference.shape[0], S_reference.shape[0]:]), axis = 1)
+            correlations = ' '.join([f"{correlation:.4f}" for correlation in correlations])
+        print(f"{str(minibatch_param):>16}{t_runs:>10.1f}{results[0][1] / t_runs:>10.1f}   {correlations}")
@@ -0,0 +1,76 @@
+#-------------------------------------------------------------------
+# Date: 2026/10/18
+# Function:
+#   Time fitting new interferograms with sources_projector (one at a time, and in batches), and compare
+#   it to calling bss_components_inversion for each interferogram.  The interferograms are made from
+#   known time courses, so the time courses that are recovered are checked, both for interferograms
+#   with the same mask as the sources and with a different one (which the sources are remasked for).
+#   The misfits of the last interferograms (which have some new deformation added) are also printed with
+#   how unusual they are (z_scores).  Last, sources that aren't independent (more float32 sources than dimensions, as when
+#   HDBSCAN finds more clusters than n_comp) are checked to still fit the interferograms.
+#-------------------------------------------------------------------
+import time
+import numpy as np
+
+from icasar.icasar_funcs import sources_projector
+from icasar.aux1 import bss_components_inversion
+
+ny, nx = 500, 600
+n_sources = 5
+n_ifgs = 200
+
+# 1: make the sources (with a mask), and the interferograms from them
+rng = np.random.RandomState(0)
+mask = np.zeros((ny, nx), dtype = bool)
+mask[:50, :] = True                                                                         # e.g. the sea
+sources = rng.randn(n_sources, np.sum(~mask))
+sources -= np.mean(sources, axis = 1)[:, np.newaxis]
+tcs = rng.randn(n_sources, n_ifgs)
+ifgs = tcs.T @ sources + 0.01 * rng.randn(n_ifgs, sources.shape[1])
+yy, xx = np.mgrid[0:ny, 0:nx]
+deformation = np.exp(-((xx - 300)**2 + (yy - 250)**2) / 500)[~mask]                         # new deformation, in the last few interferograms
+ifgs[-3:, :] += 5 * deformation
+
+# 2: fit them
+projector = sources_projector(sources, mask)
+t_start = time.perf_counter()
+results = [projector.fit(ifg) for ifg in ifgs]
+t_single = (time.perf_counter() - t_start) / n_ifgs
+tcs_projector = np.concatenate([result[0] for result in results], axis = 1)
+z_scores = np.concatenate([result[2] for result in results])
+
+t_start = time.perf_counter()
+tcs_batch, _, _ = projector.fit(ifgs, update_statistics = False)
+t_batch = (time.perf_counter() - t_start) / n_ifgs
+
+t_start = time.perf_counter()
+tcs_previous = np.concatenate([bss_components_inversion(sources, [ifg[np.newaxis, :]])[0]['tcs'] for ifg in ifgs], axis = 1)
+t_previous = (time.perf_counter() - t_start) / n_ifgs
+
+print(f"Time for each interferogram: {1e3 * t_single:.3f}ms (one at a time), {1e3 * t_batch:.3f}ms (in a batch), "
+      f"and {1e3 * t_previous:.3f}ms (bss_components_inversion).  ")
+print(f"Largest difference to the true time courses: {np.max(np.abs(tcs_projector[:, :-3] - tcs[:, :-3])):.2e}, "
+      f"and between the projector and bss_components_inversion: {np.max(np.abs(tcs_projector - tcs_previous)):.2e}")
+print(f"z_scores of the misfits of the last 6 interferograms (the last 3 have new deformation): {' '.join([f'{z_score:.1f}' for z_score in z_scores[-6:]])}")
+
+# 3: interferograms with a different mask
+mask_ifgs = np.copy(mask)
+mask_ifgs[:50, :] = False                                                                   # pixels that aren't in the sources
+mask_ifgs[:, :100] = True                                                                   # and pixels that are
+sources_r2 = np.zeros((n_sources, ny * nx))
+sources_r2[:, np.ravel(~mask)] = sources
+ifgs_new_mask = (tcs[:, :10].T @ sources_r2)[:, np.ravel(~mask_ifgs)]
+for n_fit in ['first', 'second']:
+    t_start = time.perf_counter()
+    tcs_new_mask, _, _ = projector.fit(ifgs_new_mask, mask_ifgs, update_statistics = False)
+    print(f"With a different mask ({n_fit} time): {1e3 * (time.perf_counter() - t_start):.1f}ms for 10 interferograms, largest difference "
+          f"to the true time courses {np.max(np.abs(tcs_new_mask - tcs[:, :10])):.2e}")
+
+# 4: more sources than dimensions (so g.T @ g is singular, or only just positive definite in float32)
+n_dims = 3
+sources_dependent = (rng.randn(n_sources, n_dims) @ rng.randn(n_dims, sources.shape[1])).astype(np.float32)
+sources_dependent -= np.mean(sources_dependent, axis = 1)[:, np.newaxis]
+ifgs_dependent = (rng.randn(10, n_sources) @ sources_dependent).astype(np.float32)
+inversion = bss_components_inversion(sources_dependent, [ifgs_dependent])[0]
+print(f"With {n_sources} float32 sources in {n_dims} dimensions: largest difference to the interferograms "
+      f"{np.max(np.abs(inversion['model'] - (ifgs_dependent - np.mean(ifgs_dependent)).T)):.2e}, misfit {inversion['l2_norm']:.2e}")
@@ -0,0 +1,56 @@
+#-------------------------------------------------------------------
+# Date: 2026/10/18
+# Function:
+#   Compare PCA and whitening of a frame of interferograms stored in a .npy file opened as a memmap,
+#   using PCA_meg2 (which needs the whole frame in memory) and pca_streaming (which reads it in blocks
+#   of pixels).  The time, peak memory (as traced by tracemalloc, which includes the frame once it's
+#   read by PCA_meg2), and the largest difference between the whitened data (after matching the signs
+#   of the components) are printed.
+#-------------------------------------------------------------------
+import time
+import tempfile
+import tracemalloc
+from pathlib import Path
+import numpy as np
+
+from icasar.blind_signal_separation import PCA_meg2, pca_streaming
+
+n_ifgs = 40
+n_pixels = 2000000
+n_comp = 3                                                                                  # as there are three signals (the noise components have similar variances, so could be any rotation of each other)
+dtype = 'float32'                                                                           # as the ifgs from LiCSBAS are float32
+
+with tempfile.TemporaryDirectory() as temp_folder:
+    # 1: make the frame on disk (a few signals mixed with random time courses, plus noise), one block of pixels at a time.
+    rng = np.random.RandomState(0)
+    ifgs_path = Path(temp_folder) / 'ifgs.npy'
+    ifgs = np.lib.format.open_memmap(ifgs_path, mode = 'w+', dtype = dtype, shape = (n_ifgs, n_pixels))
+    tcs = rng.randn(n_ifgs, 3)
+    for pixel_start in range(0, n_pixels, 2**18):
+        n_block = min(2**18, n_pixels - pixel_start)
+        ifgs[:, pixel_start : pixel_start + n_block] = tcs @ rng.randn(3, n_block) + 0.05 * rng.randn(n_ifgs, n_block)
+    ifgs.flush()
+    del ifgs
+    print(f"{n_ifgs} interferograms of {n_pixels} pixels ({n_ifgs * n_pixels * np.dtype(dtype).itemsize / 1e6:.0f}MB on disk).  ")
+
+    # 2: whiten them both ways
+    results = {}
+    for name in ['PCA_meg2', 'pca_streaming']:
+        ifgs = np.load(ifgs_path, mmap_mode = 'r')
+        tracemalloc.start()
+        t_start = time.time()
+        if name == 'PCA_meg2':
+            vecs, _, _, _, _, _, x_white = PCA_meg2(np.asarray(ifgs), n_comp = n_comp)
+        else:
+            pca = pca_streaming(ifgs, n_comp)
+            vecs, x_white = pca.vecs, pca.project(pca.whiten_mat)
+        t_pca = time.time() - t_start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = (vecs, x_white)
+        print(f"{name:>14}: {t_pca:.1f}s, with a peak memory of {peak / 1e6:.0f}MB.  ")
+        del ifgs
+
+signs = np.sign(np.sum(results['PCA_meg2'][0] * results['pca_streaming'][0], axis = 0))      # eigenvectors can have either sign
+difference = np.max(np.abs(signs[:, np.newaxis] * results['PCA_meg2'][1] - results['pca_streaming'][1]))
+print(f"Largest difference between the whitened data: {difference:.2e}")
@@ -0,0 +1,52 @@
+#-------------------------------------------------------------------
+# Date: 2026/10/18
+# Function:
+#   Time the methods of computing the 2d manifold of the sources (tsne_method in ICASAR)
+#   for increasing numbers of sources.  The sources are synthetic (clusters of noisy copies
+#   of a few signals, like those recovered by many runs of FastICA), and the same nearest
+#   neighbour graph (as used for clustering with knn_param) is used by all the methods except
+#   'barnes_hut', which uses all the distances so is only run for the smaller numbers of sources.
+#   Methods whose optional package (openTSNE or umap-learn) isn't installed are skipped.
+#-------------------------------------------------------------------
+import time
+import numpy as np
+
+from icasar.icasar_funcs import knn_similarity_graph, pairwise_similarity, tsne_embedding
+
+n_sources_all = [1000, 2000, 5000, 10000, 20000]                                           # numbers of sources to time
+n_sources_dense_max = 5000                                                                  # 'barnes_hut' needs all n_sources x n_sources distances
+n_pixels = 2000
+n_clusters = 10
+tsne_param = (30, 12)                                                                       # perplexity, early exaggeration (ICASAR's default)
+methods = ['barnes_hut', 'barnes_hut_knn', 'fft', 'umap']
+
+n_neighbours = int(3 * tsne_param[0] + 1) + 1                                               # as required by TSNE
+results = {method : [] for method in methods}
+for n_sources in n_sources_all:
+    rng = np.random.RandomState(0)
+    signals = rng.randn(n_clusters, n_pixels)
+    sources_r2 = signals[rng.randint(0, n_clusters, n_sources)] + rng.randn(n_sources, n_pixels)
+
+    D_knn = knn_similarity_graph(sources_r2, n_neighbours)                                  # similarities, made into distances as in sources_distances
+    np.subtract(1, D_knn.data, out = D_knn.data)
+    np.maximum(D_knn.data, np.finfo(D_knn.dtype).eps, out = D_knn.data)
+    if n_sources <= n_sources_dense_max:
+        D = np.subtract(1, pairwise_similarity(sources_r2))
+
+    for method in methods:
+        if (method == 'barnes_hut') and (n_sources > n_sources_dense_max):
+            results[method].append(np.nan)
+            continue
+        try:
+            np.random.seed(0)
+            t_start = time.time()
+            tsne_embedding(D if method == 'barnes_hut' else D_knn, tsne_param, tsne_method = method)
+            results[method].append(time.time() - t_start)
+        except ImportError as error:
+            print(f"Skipping '{method}' as it requires a package that isn't installed ({error}).  ")
+            results[method].append(np.nan)
+    print(f"{n_sources} sources: " + ", ".join([f"{method} {results[method][-1]:.1f}s" for method in methods if np.isfinite(results[method][-1])]))
+
+print(f"\n{'n_sources':>10}" + "".join([f"{method:>16}" for method in methods]))
+for n_source_n, n_sources in enumerate(n_sources_all):
+    print(f"{n_sources:>10}" + "".join([f"{results[method][n_source_n]:>15.1f}s" if np.isfinite(results[method][n_source_n]) else f"{'-':>16}" for method in methods]))
@@ -0,0 +1,63 @@
+#-------------------------------------------------------------------
+# Date: 2026/10/18
+# Function:
+#   Check that ICASAR with dtype = 'float32' recovers the same sources as with the default
+#   dtype = 'float64'.  The data are synthetic (a few spatial signals mixed with random time
+#   courses, plus noise), and each float64 centrotype is compared to the most similar float32
+#   one.  An exception is raised if any correlation is below the tolerance.  The time and peak
+#   memory (as traced by tracemalloc) of each run are also printed.
+#-------------------------------------------------------------------
+import time
+import tempfile
+import tracemalloc
+from pathlib import Path
+import numpy as np
+
+from icasar.icasar_funcs import ICASAR
+
+n_ifgs = 40
+ny, nx = 200, 250
+correlation_tolerance = 0.999                                                               # minimum correlation between matching float64 and float32 centrotypes
+ICASAR_settings = {'n_comp' : 3,                                                         # as there are three signals
+                   'bootstrapping_param' : (100, 20),
+                   'hdbscan_param' : (35, 10),
+                   'tsne_param' : (30, 12),
+                   'figures' : 'none',
+                   'ica_verbose' : 'short'}
+
+# 1: make the synthetic time series of incremental ifgs
+rng = np.random.RandomState(0)
+yy, xx = np.mgrid[0:ny, 0:nx] / ny
+signals = np.stack((np.exp(-((xx - 0.4)**2 + (yy - 0.5)**2) / 0.01),                         # deformation
+                    yy,                                                                     # a ramp
+                    np.sin(8 * xx) * np.cos(6 * yy)))                                       # and something like a turbulent atmosphere
+signals_r2 = np.reshape(signals, (signals.shape[0], -1))
+ifgs_r2 = rng.randn(n_ifgs, signals.shape[0]) @ signals_r2 + 0.05 * rng.randn(n_ifgs, ny * nx)
+acq_dates = [np.datetime64('2020-01-01') + np.timedelta64(12 * n_acq, 'D') for n_acq in range(n_ifgs + 1)]
+ifg_dates = [f"{str(acq_dates[n_ifg]).replace('-', '')}_{str(acq_dates[n_ifg + 1]).replace('-', '')}" for n_ifg in range(n_ifgs)]
+spatial_data = {'mask'         : np.zeros((ny, nx), dtype = bool),
+                'ifg_dates_dc' : ifg_dates}
+
+# 2: run ICASAR in both precisions
+results = {}
+for dtype in ['float64', 'float32']:
+    spatial_data['ifgs_dc'] = ifgs_r2.astype(dtype)                                         # as the ifgs from LiCSBAS are float32
+    np.random.seed(0)
+    tracemalloc.start()
+    t_start = time.time()
+    with tempfile.TemporaryDirectory() as out_folder:
+        S_ica = ICASAR(spatial_data = dict(spatial_data), out_folder = Path(out_folder), dtype = dtype, **ICASAR_settings)[0]
+    results[dtype] = S_ica
+    print(f"\n{dtype}: {S_ica.shape[0]} sources recovered in {time.time() - t_start:.1f}s, with a peak memory of {tracemalloc.get_traced_memory()[1] / 1e6:.0f}MB.  \n")
+    tracemalloc.stop()
+
+# 3: match the centrotypes and compare them
+correlations = np.abs(np.corrcoef(results['float64'], results['float32'].astype(np.float64))[:results['float64'].shape[0], results['float64'].shape[0]:])
+best_correlations = np.max(correlations, axis = 1)                                          # for each float64 centrotype, the most similar float32 one
+for n_source, best_correlation in enumerate(best_correlations):
+    print(f"float64 source {n_source}: correlation with the most similar float32 source is {best_correlation:.6f}")
+if results['float64'].shape[0] != results['float32'].shape[0]:
+    raise Exception(f"{results['float64'].shape[0]} sources were recovered with float64, but {results['float32'].shape[0]} with float32.  ")
+if np.min(best_correlations) < correlation_tolerance:
+    raise Exception(f"At least one of the float32 sources doesn't match the float64 ones (correlation tolerance {correlation_tolerance}).  ")
+print(f"The float32 and float64 sources match.  ")